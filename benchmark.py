@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+#
+# This file is part of django-xmpp-http-upload (https://github.com/mathiasertl/django-xmpp-http-upload).
+#
+# django-xmpp-http-upload is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# django-xmpp-http-upload is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-xmpp-http-upload. If
+# not, see <http://www.gnu.org/licenses/>.
+
+"""Micro-benchmarks for the request hot paths.
+
+Benchmarks run against a temporary test database, results are written as JSON. Use the ``compare`` command
+to compare the results of two runs (e.g. of two different commits).
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+import django
+
+_rootdir = os.path.dirname(os.path.realpath(__file__))
+_benchmarks = ['get_config', 'slot', 'get_urls', 'put', 'get', 'cleanup']
+_units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def size_list(value):
+    sizes = []
+    for size in value.split(','):
+        size = size.strip().upper()
+        if size[-1] in _units:
+            sizes.append(int(size[:-1]) * _units[size[-1]])
+        else:
+            sizes.append(int(size))
+    return sizes
+
+
+parser = argparse.ArgumentParser(description="Run micro-benchmarks.")
+subparsers = parser.add_subparsers(help='commands', dest='command')
+run_parser = subparsers.add_parser('run', help='Run benchmarks.')
+run_parser.add_argument('--database', choices=['sqlite', 'postgresql'], default='sqlite',
+                        help="Database to use (default: %(default)s). For PostgreSQL, use the DATABASE_NAME, "
+                        "DATABASE_USER, DATABASE_PASSWORD, DATABASE_HOST and DATABASE_PORT environment "
+                        "variables to configure the connection.")
+run_parser.add_argument('-o', '--output', metavar='FILE', help="Write results to FILE (default: stdout).")
+run_parser.add_argument('--repeat', type=int, default=5, metavar='N',
+                        help="Repeat every benchmark N times (default: %(default)s).")
+run_parser.add_argument('--acls', type=int, default=1000, metavar='N',
+                        help="Number of ACLs for the get_config benchmark (default: %(default)s).")
+run_parser.add_argument('--uploads', type=int, default=100000, metavar='N',
+                        help="Existing uploads of the user in the slot benchmark (default: %(default)s).")
+run_parser.add_argument('--cleanup-rows', type=int, default=100000, metavar='N',
+                        help="Expired rows for the cleanup benchmark (default: %(default)s).")
+run_parser.add_argument('--sizes', type=size_list, default='1K,1M,64M', metavar='SIZE[,SIZE...]',
+                        help="Body sizes for the put and get benchmarks, e.g. 1K,1M,1G "
+                        "(default: %(default)s).")
+run_parser.add_argument('benchmark', nargs='*', metavar='BENCHMARK',
+                        help="Benchmarks to run, any of %s (default: all)." % ', '.join(_benchmarks))
+
+compare_parser = subparsers.add_parser('compare', help='Compare the results of two runs.')
+compare_parser.add_argument('old', help="Results of the old run.")
+compare_parser.add_argument('new', help="Results of the new run.")
+compare_parser.add_argument('--threshold', type=float, default=10, metavar='PERCENT',
+                            help="Report regressions of more then PERCENT (default: %(default)s).")
+
+args = parser.parse_args()
+if args.command == 'run':
+    for name in args.benchmark:
+        if name not in _benchmarks:
+            parser.error('%s: Unknown benchmark.' % name)
+
+
+def measure(func, repeat, number=1, setup=None, teardown=None):
+    """Return a list of the average time (in seconds) ``func`` takes, measured ``repeat`` times.
+
+    If given, ``setup`` is called before every measurement (but not timed) and its return value is passed
+    to ``func`` and ``teardown``.
+    """
+    timings = []
+    for i in range(repeat):
+        value = setup() if setup is not None else None
+
+        start = time.perf_counter()
+        for j in range(number):
+            func(value)
+        timings.append((time.perf_counter() - start) / number)
+
+        if teardown is not None:
+            teardown(value)
+    return timings
+
+
+def result(name, params, timings, size=None):
+    data = {
+        'id': '%s[%s]' % (name, ','.join('%s=%s' % (k, v) for k, v in sorted(params.items()))),
+        'name': name,
+        'params': params,
+        'timings': timings,
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'mean': statistics.mean(timings),
+        'stdev': statistics.stdev(timings) if len(timings) > 1 else 0.0,
+    }
+    if size is not None:
+        data['throughput'] = size / data['median']  # bytes per second
+    return data
+
+
+def bulk_create(count, jid='user@example.com', size=1024):
+    """Create ``count`` uploads (with non-existing files) for the given JID."""
+    from xmpp_http_upload.models import Upload
+
+    batch_size = 500  # SQLite does not support more terms in a compound SELECT
+    for start in range(0, count, batch_size):
+        Upload.objects.bulk_create([
+            Upload(jid=jid, name='example.txt', size=size, hash='%032d' % i,
+                   file='http_upload/%032d/example.txt' % i)
+            for i in range(start, min(start + batch_size, count))
+        ])
+
+
+def bench_get_config():
+    from django.test import override_settings
+    from xmpp_http_upload.utils import get_config
+
+    # worst case: the last rule is the one that matches
+    acls = [(r'^user%s@example\.com$' % i, {}) for i in range(args.acls)] + [('.*', False)]
+    with override_settings(XMPP_HTTP_UPLOAD_ACCESS=acls):
+        timings = measure(lambda v: get_config('nobody@example.net'), args.repeat, number=100)
+    yield result('get_config', {'acls': args.acls}, timings)
+
+
+def bench_slot():
+    from django.test import RequestFactory
+    from django.test import override_settings
+    from xmpp_http_upload.models import Slot
+    from xmpp_http_upload.models import Upload
+    from xmpp_http_upload.views import RequestSlotView
+
+    jid = 'user@example.com'
+    delta = timedelta(days=3650)
+    acls = [('.*', {
+        'max_total_size': 2 ** 62,
+        'bytes_per_timedelta': {'delta': delta, 'bytes': 2 ** 62},
+        'uploads_per_timedelta': {'delta': delta, 'uploads': 2 ** 62},
+    })]
+    bulk_create(args.uploads, jid=jid)
+
+    request = RequestFactory().get('/slot/', {'jid': jid, 'name': 'example.txt', 'size': 1024})
+    view = RequestSlotView.as_view()
+
+    def func(value):
+        assert view(request).status_code == 200
+
+    with override_settings(XMPP_HTTP_UPLOAD_ACCESS=acls):
+        timings = measure(func, args.repeat, number=10)
+    Slot.objects.all().delete()
+    Upload.objects.all().delete()
+    yield result('slot', {'uploads': args.uploads}, timings)
+
+
+def bench_get_urls():
+    from django.test import RequestFactory
+    from xmpp_http_upload.models import Slot
+
+    slot = Slot(jid='user@example.com', name='exämple.txt', size=1024, hash='0' * 32)
+    request = RequestFactory().get('/slot/')
+    yield result('get_urls', {}, measure(lambda v: slot.get_urls(request), args.repeat, number=1000))
+
+
+def _create_slot(size):
+    from django.utils.crypto import get_random_string
+    from xmpp_http_upload.models import Slot
+
+    return Slot.objects.create(jid='user@example.com', name='example.bin', size=size,
+                               hash=get_random_string(32))
+
+
+def _remove_upload(slot):
+    from xmpp_http_upload.models import Upload
+
+    for upload in Upload.objects.filter(hash=slot.hash):
+        upload.remove_file()
+        upload.delete()
+
+
+def bench_put():
+    from django.test import Client
+
+    client = Client()
+    for size in args.sizes:
+        body = b'x' * size
+
+        def func(upload):
+            response = client.put(upload.get_absolute_url(), body, content_type='application/octet-stream')
+            assert response.status_code == 201
+
+        timings = measure(func, args.repeat, setup=lambda: _create_slot(size), teardown=_remove_upload)
+        yield result('put', {'size': size}, timings, size=size)
+
+
+def bench_get():
+    from django.core.files.base import ContentFile
+    from django.test import Client
+    from django.test import override_settings
+    from xmpp_http_upload.models import Upload
+
+    client = Client()
+    for size in args.sizes:
+        slot = _create_slot(size)
+        upload = Upload.from_slot(slot)
+        upload.file.save(upload.name, ContentFile(b'x' * size))
+        slot.delete()
+
+        def func(value):
+            response = client.get(upload.get_absolute_url())
+            assert response.status_code == 200
+            for chunk in response.streaming_content:
+                pass
+            response.close()
+
+        with override_settings(XMPP_HTTP_UPLOAD_WEBSERVER_DOWNLOAD=False):
+            timings = measure(func, args.repeat)
+        _remove_upload(upload)
+        yield result('get', {'size': size}, timings, size=size)
+
+
+def bench_cleanup():
+    from django.utils import timezone
+    from xmpp_http_upload.models import Upload
+
+    def setup():
+        # files do not exist, but cleanup() will still try to remove them
+        bulk_create(args.cleanup_rows)
+        Upload.objects.update(created=timezone.now() - timedelta(days=365))
+
+    timings = measure(lambda v: Upload.objects.cleanup(), args.repeat, setup=setup)
+    yield result('cleanup', {'rows': args.cleanup_rows}, timings)
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=_rootdir, check=True, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL).stdout.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(names):
+    work_dir = os.path.join(_rootdir, 'demo')
+    sys.path.insert(0, work_dir)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "demo.test_settings")
+    os.environ['DATABASE'] = args.database
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        os.environ['MEDIA_ROOT'] = tempdir
+        django.setup()
+
+        from django.db import connection
+        from django.test.utils import setup_test_environment
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0)
+
+        results = []
+        try:
+            for name in names:
+                for data in globals()['bench_%s' % name]():
+                    print('%-30s median: %.6fs' % (data['id'], data['median']), file=sys.stderr)
+                    results.append(data)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        return {
+            'commit': get_commit(),
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'results': results,
+        }
+
+
+def compare(old, new, threshold):
+    """Print a comparison of two runs, returns ``True`` if any benchmark regressed."""
+    old_results = {r['id']: r for r in old['results']}
+    regression = False
+
+    print('%-30s %12s %12s %8s' % ('benchmark', 'old', 'new', 'change'))
+    for data in new['results']:
+        if data['id'] not in old_results:
+            continue
+        old_median = old_results[data['id']]['median']
+        change = (data['median'] - old_median) / old_median * 100
+        marker = ''
+        if change > threshold:
+            marker = ' REGRESSION'
+            regression = True
+        print('%-30s %11.6fs %11.6fs %+7.1f%%%s' % (data['id'], old_median, data['median'], change, marker))
+    return regression
+
+
+if args.command == 'run':
+    output = run_benchmarks(args.benchmark or _benchmarks)
+    if args.output:
+        with open(args.output, 'w') as stream:
+            json.dump(output, stream, indent=4)
+    else:
+        json.dump(output, sys.stdout, indent=4)
+
+elif args.command == 'compare':
+    with open(args.old) as stream:
+        old = json.load(stream)
+    with open(args.new) as stream:
+        new = json.load(stream)
+
+    if compare(old, new, args.threshold):
+        sys.exit(1)
+else:
+    parser.print_help()
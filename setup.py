@@ -17,7 +17,6 @@ from setuptools import setup
 version = '1.0.0'
 requires = [
     'Django>=2.2',
-    'djangorestframework>=3.9',
 ]
 
 setup(
@@ -30,6 +29,7 @@ setup(
     install_requires=requires,
     license="GNU General Public License (GPL) v3",
     packages=find_packages(),
+    package_data={'xmpp_http_upload': ['templates/admin/xmpp_http_upload/*.html']},
     classifiers=[
         "Development Status :: 4 - Beta",
         "Environment :: Web Environment",
@@ -1,35 +1,317 @@
+import logging
+
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
+from django.core.exceptions import PermissionDenied
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Count
+from django.db.models import Max
+from django.db.models import Sum
+from django.http import Http404
+from django.http import QueryDict
+from django.template.defaultfilters import filesizeformat
+from django.template.response import TemplateResponse
+from django.urls import path
+from django.urls import reverse
+from django.utils.functional import cached_property
+from django.utils.html import format_html
 from django.utils.translation import gettext_lazy as _
 
+from . import jobs
+from .models import Slot
 from .models import Upload
+from .shards import for_each_shard
+from .shards import get_aliases
+from .utils import get_cache
+from .utils import try_cache
+
+log = logging.getLogger(__name__)
+
+CURSOR_VAR = 'before'
+SHARD_VAR = 'shard'
+
+
+def get_shard(request):
+    """Get the shard selected in the changelist, also from the preserved filters of other admin views."""
+    shard = request.GET.get(SHARD_VAR)
+    if shard is None:
+        shard = QueryDict(request.GET.get('_changelist_filters', '')).get(SHARD_VAR)
+
+    aliases = get_aliases()
+    return shard if shard in aliases else aliases[0]
+
+
+def estimate_count(queryset):
+    """Get the estimated number of rows of an unfiltered ``queryset`` from the table statistics.
+
+    Returns ``None`` if the queryset is filtered or the database does not provide an estimate.
+    """
+    if queryset.query.where:
+        return None
+
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        sql = 'SELECT reltuples FROM pg_class WHERE relname = %s'
+    elif connection.vendor == 'mysql':
+        sql = 'SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() ' \
+              'AND table_name = %s'
+    else:
+        return None
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [queryset.model._meta.db_table])
+        row = cursor.fetchone()
+    if row is None or row[0] is None or row[0] < 0:  # PostgreSQL returns -1 if never analyzed
+        return None
+    return int(row[0])
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator that uses the estimated row count for large unfiltered tables instead of ``COUNT(*)``."""
+
+    exact_threshold = 10000  # smaller tables are counted exactly
+
+    @cached_property
+    def count(self):
+        estimate = estimate_count(self.object_list)
+        if estimate is None or estimate < self.exact_threshold:
+            return super().count
+        return estimate
+
+
+class KeysetChangeList(ChangeList):
+    """Changelist that pages by primary key (``?before=<pk>``) instead of ``OFFSET``.
+
+    If rows are sharded, the changelist shows one shard (``?shard=<alias>``) at a time.
+    """
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(CURSOR_VAR, None)
+        lookup_params.pop(SHARD_VAR, None)
+        return lookup_params
+
+    def get_results(self, request):
+        self.shard = get_shard(request)
+        queryset = self.queryset
+        try:
+            self.cursor = int(request.GET.get(CURSOR_VAR, 0))
+        except ValueError:
+            raise IncorrectLookupParameters
+        if self.cursor:
+            queryset = queryset.filter(pk__lt=self.cursor)
+
+        # fetch one more row to know if there is a next page
+        result_list = list(queryset[:self.list_per_page + 1])
+        self.multi_page = len(result_list) > self.list_per_page
+        self.result_list = result_list[:self.list_per_page]
+        self.next_cursor = self.result_list[-1].pk if self.multi_page else None
+
+        self.paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        self.result_count = self.paginator.count
+        self.full_result_count = None
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.can_show_all = False
+
+    @property
+    def next_url(self):
+        return self.get_query_string({CURSOR_VAR: self.next_cursor})
+
+    @property
+    def newest_url(self):
+        return self.get_query_string(remove=[CURSOR_VAR])
+
+    @property
+    def shard_urls(self):
+        """Links to every shard, empty if rows are not sharded."""
+        aliases = get_aliases()
+        if aliases == [None]:
+            return []
+        return [(alias, self.get_query_string({SHARD_VAR: alias}, remove=[CURSOR_VAR]), alias == self.shard)
+                for alias in aliases]
+
+    def get_ordering(self, request, queryset):
+        return ['-pk']  # required by the cursor
+
+
+class ScalableAdminMixin:
+    """Admin options for tables with millions of rows.
 
+    The changelist uses keyset pagination and estimated counts, and only searches for an exact JID (if
+    the search term contains an "@") or a JID prefix, both of which can use the index on the ``jid``
+    column.
+    """
 
-class UploadedListFilter(admin.SimpleListFilter):
-    title = _('Uploaded')
-    parameter_name = 'uploaded'
+    change_list_template = 'admin/xmpp_http_upload/change_list.html'
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    search_fields = ('jid', )
+    sortable_by = ()
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).using(get_shard(request))
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        if '@' in search_term:
+            return queryset.filter(jid=search_term), False
+
+        # a range instead of LIKE, so that the index is used with any collation
+        return queryset.filter(jid__gte=search_term, jid__lt='%s\uffff' % search_term), False
+
+    def file_size(self, obj):
+        return filesizeformat(obj.size)
+    file_size.short_description = _('Size')
+
+
+class ExpiredListFilter(admin.SimpleListFilter):
+    title = _('Expired')
+    parameter_name = 'expired'
 
     def lookups(self, request, model_admin):
         return (
-            ('2', _('Expired')),
             ('1', _('Yes')),
             ('0', _('No'))
         )
 
     def queryset(self, request, queryset):
         value = self.value()
-        if value == '2':
+        if value == '1':
             return queryset.expired()
-        elif value == '1':
-            return queryset.uploaded()
         elif value == '0':
             return queryset.for_upload()
         return queryset
 
 
+@admin.register(Slot)
+class SlotAdmin(ScalableAdminMixin, admin.ModelAdmin):
+    list_filter = (ExpiredListFilter, )
+    list_display = ('jid', 'name', 'file_size', 'created', )
+    list_display_links = ('jid', 'name', )
+
+
 @admin.register(Upload)
-class UploadAdmin(admin.ModelAdmin):
-    ordering = ('-created', 'jid', )
-    list_filter = (UploadedListFilter, )
-    search_fields = ('jid', 'name', )
-    list_display = ('jid', 'name', 'created', )
+class UploadAdmin(ScalableAdminMixin, admin.ModelAdmin):
+    list_display = ('jid', 'name', 'file_size', 'created', 'uploaded', )
     list_display_links = ('jid', 'name', )
+    actions = ['delete_with_files', 'delete_jids']
+    usage_limit = 100  # JIDs shown in the usage summary
+    usage_cache_timeout = 300  # seconds the usage summary of all JIDs is cached
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        return [
+            path('usage/', self.admin_site.admin_view(self.usage_view), name='%s_%s_usage' % info),
+            path('jobs/<str:job_id>/', self.admin_site.admin_view(self.job_view), name='%s_%s_job' % info),
+        ] + super().get_urls()
+
+    def get_actions(self, request):
+        actions = super().get_actions(request)
+        actions.pop('delete_selected', None)  # would not remove files and times out for many uploads
+        return actions
+
+    def delete_model(self, request, obj):
+        # also removes copies and metadata, which downloads would otherwise still use
+        jobs.delete_batch([obj], using=obj._state.db)
+
+    def delete_queryset(self, request, queryset):
+        jobs.delete_batch(list(queryset), using=queryset.db)
+
+    def start_delete(self, request, description, pks=None, jids=None):
+        job = jobs.start_delete(description, pks=pks, jids=jids, using=get_shard(request))
+        url = reverse('admin:xmpp_http_upload_upload_job', kwargs={'job_id': job.id})
+        self.message_user(request, format_html(
+            '{} in the background, see <a href="{}">progress</a>.', description, url))
+
+    def delete_with_files(self, request, queryset):
+        pks = list(queryset.values_list('pk', flat=True))
+        self.start_delete(request, 'Deleting %s uploads' % len(pks), pks=pks)
+    delete_with_files.short_description = _('Delete selected uploads with their files')
+    delete_with_files.allowed_permissions = ('delete', )
+
+    def delete_jids(self, request, queryset):
+        jids = sorted(set(queryset.values_list('jid', flat=True)))
+        self.start_delete(request, 'Deleting all uploads of %s' % ', '.join(jids), jids=jids)
+    delete_jids.short_description = _('Delete all uploads of the JIDs of the selected uploads')
+    delete_jids.allowed_permissions = ('delete', )
+
+    def job_view(self, request, job_id):
+        if not self.has_delete_permission(request):
+            raise PermissionDenied
+
+        job = jobs.Job(job_id).get()
+        if job is None:
+            raise Http404
+        context = dict(
+            self.admin_site.each_context(request),
+            title=job['description'],
+            opts=self.model._meta,
+            job=job,
+        )
+        return TemplateResponse(request, 'admin/xmpp_http_upload/job.html', context)
+
+    def changelist_view(self, request, extra_context=None):
+        extra_context = extra_context or {}
+        extra_context['usage_url'] = reverse('admin:xmpp_http_upload_upload_usage')
+        return super().changelist_view(request, extra_context=extra_context)
+
+    def get_shard_usage(self, using, jid=None, limit=None):
+        qs = Upload.objects.using(using)
+        if jid:
+            qs = qs.filter(jid=jid)
+        qs = qs.values('jid').annotate(uploads=Count('pk'), bytes=Sum('size'), last=Max('created'))
+        qs = qs.order_by('-bytes', 'jid')
+        return list(qs if limit is None else qs[:limit])
+
+    def get_usage(self, jid=None):
+        """Get the uploads, bytes and the last upload per JID, ordered by bytes.
+
+        If rows are sharded, the usage of all JIDs is merged before the top JIDs are selected, as a JID may
+        use a little space in every shard.
+        """
+        limit = self.usage_limit if len(get_aliases()) == 1 else None
+        usage = {}
+        for rows in for_each_shard(self.get_shard_usage, jid, limit):
+            for row in rows:
+                if row['jid'] in usage:
+                    total = usage[row['jid']]
+                    total['uploads'] += row['uploads']
+                    total['bytes'] += row['bytes']
+                    total['last'] = max(total['last'], row['last'])
+                else:
+                    usage[row['jid']] = row
+        return sorted(usage.values(), key=lambda row: (-row['bytes'], row['jid']))[:self.usage_limit]
+
+    def usage_view(self, request):
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+
+        jid = request.GET.get('jid', '').strip()
+        if jid:  # uses the index on the JID
+            usage = self.get_usage(jid)
+        else:  # the summary of all JIDs reads all uploads
+            key = 'xmpp-http-upload:admin:usage'
+            usage = try_cache(lambda: get_cache().get(key), None, log, 'Cannot get usage from cache.')
+            if usage is None:
+                usage = self.get_usage()
+                try_cache(lambda: get_cache().set(key, usage, self.usage_cache_timeout), None, log,
+                          'Cannot add usage to cache.')
+
+        context = dict(
+            self.admin_site.each_context(request),
+            title=_('Usage per JID'),
+            opts=self.model._meta,
+            jid=jid,
+            usage=usage,
+            usage_limit=self.usage_limit,
+            usage_cache_timeout=self.usage_cache_timeout,
+        )
+        return TemplateResponse(request, 'admin/xmpp_http_upload/usage.html', context)
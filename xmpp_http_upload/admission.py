@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-http-upload
+# (https://github.com/mathiasertl/django-xmpp-http-upload).
+#
+# django-xmpp-http-upload is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# django-xmpp-http-upload is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# django-xmpp-http-upload.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Server-wide admission control for uploads.
+
+Uploads in progress (and their declared size) are counted in the cache configured by
+``XMPP_HTTP_UPLOAD_CACHE``, so the limits apply to all processes and nodes. Counters are kept in
+generations of ``timeout`` seconds, and only the current and the previous generation are counted. If a
+process dies during an upload, its admission thus expires after at most two generations.
+
+The same mechanism limits the concurrent uploads of a single JID (see the ``max_concurrent_uploads``
+setting in ``XMPP_HTTP_UPLOAD_ACCESS``).
+"""
+
+import logging
+import time
+
+from django.conf import settings
+
+from .utils import cache_key
+from .utils import get_cache
+from .utils import try_cache
+
+log = logging.getLogger(__name__)
+
+_ADMISSION_DEFAULTS = {
+    'max_uploads': None,  # concurrent uploads
+    'max_bytes': None,  # declared bytes of concurrent uploads
+    'retry_after': 30,
+    'timeout': 3600,
+}
+
+
+def get_admission_config():
+    config = dict(_ADMISSION_DEFAULTS)
+    config.update(getattr(settings, 'XMPP_HTTP_UPLOAD_ADMISSION', {}))
+    return config
+
+
+class Admission:
+    """Admission of a single upload of ``size`` bytes.
+
+    By default, the server-wide limits of the ``XMPP_HTTP_UPLOAD_ADMISSION`` setting apply. If ``jid`` is
+    given, at most ``max_uploads`` concurrent uploads of this JID are admitted instead.
+    """
+
+    def __init__(self, size, jid=None, max_uploads=None):
+        self.size = size
+        self.config = get_admission_config()
+        self.timeout = self.config['timeout']
+        self.keys = None  # keys incremented by a successful acquire()
+
+        if jid is None:
+            self.prefix = 'xmpp-http-upload:admission'
+            self.max_uploads = self.config['max_uploads']
+            self.max_bytes = self.config['max_bytes']
+        else:
+            self.prefix = cache_key('admission', jid)
+            self.max_uploads = max_uploads
+            self.max_bytes = None
+
+    @property
+    def enabled(self):
+        return bool(self.max_uploads or self.max_bytes)
+
+    def get_keys(self, generation):
+        return ('%s:uploads:%s' % (self.prefix, generation), '%s:bytes:%s' % (self.prefix, generation))
+
+    def get_usage(self, values, keys):
+        uploads_key, bytes_key = keys
+        return max(0, values.get(uploads_key, 0)), max(0, values.get(bytes_key, 0))
+
+    def exceeds(self, uploads, size):
+        """Return ``True`` if ``uploads`` concurrent uploads totalling ``size`` bytes exceed the limits."""
+        if self.max_uploads and uploads > self.max_uploads:
+            return True
+        return bool(self.max_bytes and size > self.max_bytes)
+
+    def check(self):
+        """Check if the upload would currently be admitted, without counting it."""
+        if not self.enabled:
+            return True
+
+        generation = int(time.time() // self.timeout)
+        current, previous = self.get_keys(generation), self.get_keys(generation - 1)
+        values = try_cache(lambda: get_cache().get_many(current + previous), None, log,
+                           'Cannot use cache for admission control, admitting upload.')
+        if values is None:
+            return True
+
+        current_uploads, current_size = self.get_usage(values, current)
+        previous_uploads, previous_size = self.get_usage(values, previous)
+        uploads = current_uploads + previous_uploads + 1
+        return not self.exceeds(uploads, current_size + previous_size + self.size)
+
+    def acquire(self):
+        """Count the upload as in progress, returns ``False`` if this would exceed the limits."""
+        if not self.enabled:
+            return True
+
+        usage = try_cache(self.count, None, log, 'Cannot use cache for admission control, admitting upload.')
+        if usage is None:
+            return True
+
+        uploads, size = usage
+        if self.exceeds(uploads, size):
+            self.release()
+            return False
+        return True
+
+    def count(self):
+        """Count the upload in the current generation, returns the uploads and bytes including it."""
+        cache = get_cache()
+        generation = int(time.time() // self.timeout)
+        uploads_key, bytes_key = keys = self.get_keys(generation)
+        previous = self.get_keys(generation - 1)
+
+        cache.add(uploads_key, 0, self.timeout * 2)
+        cache.add(bytes_key, 0, self.timeout * 2)
+        uploads = cache.incr(uploads_key)
+        size = cache.incr(bytes_key, self.size)
+        self.keys = keys
+
+        previous_uploads, previous_size = self.get_usage(cache.get_many(previous), previous)
+        return max(0, uploads) + previous_uploads, max(0, size) + previous_size
+
+    def release(self):
+        """Release a successful :py:meth:`acquire`."""
+        if self.keys is None:
+            return
+
+        uploads_key, bytes_key = self.keys
+        self.keys = None
+
+        def decr():
+            cache = get_cache()
+            cache.decr(uploads_key)
+            cache.decr(bytes_key, self.size)
+
+        # fails if the generation expired or the cache is unavailable
+        try_cache(decr, None, log, 'Cannot release admission of upload.')
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-http-upload
+# (https://github.com/mathiasertl/django-xmpp-http-upload).
+#
+# django-xmpp-http-upload is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# django-xmpp-http-upload is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# django-xmpp-http-upload.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Cluster mode: spread stored files over multiple nodes with local disks.
+
+Every node listed in the ``nodes`` value of the ``XMPP_HTTP_UPLOAD_CLUSTER`` setting owns the files whose
+hash maps to it on a consistent hash ring. New slots are assigned to their owner and their URLs point to
+that node. A node receiving a request for a file stored on another node redirects the client there (or lets
+the webserver proxy the request, if ``proxy_prefix`` is set).
+
+If nodes join or leave the ring, the :py:class:`Rebalancer` of every node pushes the files it stores but
+no longer owns to their new owner.
+"""
+
+import hashlib
+import logging
+import time
+import urllib.request
+
+from django.conf import settings
+from django.core import signing
+from django.http import HttpResponse
+from django.urls import reverse
+
+from . import shards
+from .utils import Throttle
+from .utils import get_cache
+from .utils import remove_later
+from .utils import ring_lookup
+
+log = logging.getLogger(__name__)
+
+_CLUSTER_DEFAULTS = {
+    'nodes': {},  # name -> base URL of every node in the ring
+    'retired': {},  # name -> base URL of nodes that left the ring but still store files
+    'node': None,  # name of this node
+    'proxy_prefix': None,  # internal webserver location to proxy requests to other nodes
+    'batch_size': 100,
+    'interval': 60,
+    'timeout': 60,  # seconds to push a single file to another node
+    'bytes_per_second': None,  # limit the bandwidth used to push files
+}
+
+_salt = 'xmpp_http_upload.cluster'
+
+
+def get_cluster_config():
+    config = dict(_CLUSTER_DEFAULTS)
+    config.update(getattr(settings, 'XMPP_HTTP_UPLOAD_CLUSTER', {}))
+    return config
+
+
+def enabled():
+    return bool(get_cluster_config()['nodes'])
+
+
+def get_node():
+    """Name of this node, ``None`` if cluster mode is disabled."""
+    config = get_cluster_config()
+    if not config['nodes']:
+        return None
+    return config['node']
+
+
+def get_owner(hash):
+    """Get the node owning the file with the given ``hash``."""
+    return ring_lookup(sorted(get_cluster_config()['nodes']), hash)
+
+
+def get_node_url(node):
+    """Base URL of ``node``, ``None`` if the node is unknown."""
+    config = get_cluster_config()
+    return config['nodes'].get(node) or config['retired'].get(node)
+
+
+def is_remote(instance):
+    """``True`` if the file of a slot or upload is stored on another node."""
+    node = get_node()
+    return node is not None and bool(instance.node) and instance.node != node
+
+
+def redirect(request, node):
+    """Response sending the request to ``node``, ``None`` if the node is unknown."""
+    config = get_cluster_config()
+    base = get_node_url(node)
+    if base is None:
+        return None
+
+    response = HttpResponse(status=307)  # unlike 302, clients must not change PUT to GET
+    if config['proxy_prefix']:
+        prefix = config['proxy_prefix'].rstrip('/')
+        response['X-Accel-Redirect'] = '%s/%s%s' % (prefix, node, request.get_full_path())
+    else:
+        response['Location'] = '%s%s' % (base.rstrip('/'), request.get_full_path())
+    return response
+
+
+def get_token(upload, node):
+    """Token authorizing to push ``upload`` to ``node``."""
+    return signing.dumps({'hash': upload.hash, 'name': upload.name, 'node': node}, salt=_salt)
+
+
+def load_token(token, hash, name):
+    """Get the node a file is pushed to, raises ``BadSignature`` if the token is invalid."""
+    data = signing.loads(token, salt=_salt, max_age=get_cluster_config()['timeout'])
+    if data['hash'] != hash or data['name'] != name:
+        raise signing.BadSignature('Token is for a different file.')
+    return data['node']
+
+
+class Rebalancer:
+    """Push files stored on this node to their owner.
+
+    All parameters default to the respective value in the ``XMPP_HTTP_UPLOAD_CLUSTER`` setting. After a
+    complete pass, the rebalancer remembers the nodes in the ring (in the cache configured by
+    ``XMPP_HTTP_UPLOAD_CACHE``) and does nothing until they change, as new slots are always assigned to
+    their owner.
+    """
+
+    def __init__(self, node=None, batch_size=None, interval=None):
+        config = get_cluster_config()
+        self.node = node or config['node']
+        self.batch_size = batch_size or config['batch_size']
+        self.interval = config['interval'] if interval is None else interval
+        self.timeout = config['timeout']
+        self.bytes_per_second = config['bytes_per_second']
+        self.key = 'xmpp-http-upload:rebalance:%s' % self.node
+
+    def get_ring(self):
+        nodes = sorted(get_cluster_config()['nodes'])
+        return hashlib.sha256(' '.join(nodes).encode('utf-8')).hexdigest()
+
+    def push(self, upload, owner):
+        """Push a file to its owner, returns ``True`` if the owner stored it."""
+        url = '%s%s' % (get_node_url(owner).rstrip('/'), reverse(
+            'xmpp-http-upload:cluster', kwargs={'hash': upload.hash, 'filename': upload.name}))
+        throttle = Throttle(self.bytes_per_second)
+
+        def read(stream):
+            for chunk in iter(lambda: stream.read(64 * 1024), b''):
+                throttle(len(chunk))
+                yield chunk
+
+        stream = upload.open_file()
+        if stream is None:
+            log.error('Cannot push %s to %s, the file cannot be read.', upload.file.name, owner)
+            return False
+
+        try:
+            with stream:
+                request = urllib.request.Request(url, data=read(stream), method='PUT', headers={
+                    'Content-Length': str(upload.size),
+                    'Content-Type': upload.type or 'application/octet-stream',
+                    'X-Cluster-Token': get_token(upload, owner),
+                })
+                with urllib.request.urlopen(request, timeout=self.timeout):
+                    pass
+        except OSError:  # also includes HTTP errors
+            log.exception('Cannot push %s to %s.', upload.file.name, owner)
+            return False
+
+        # The owner now stores its own copy. The instance is stale, so copies (found by the name of the file,
+        # which the owner may reuse) are left alone. Metadata is only written for files stored under the path
+        # of their URL, which the owner does not use if the nodes share a disk.
+        from .metadata import remove as remove_metadata
+
+        remove_metadata(upload)
+        remove_later(*upload.get_local_paths())  # downloads may still be about to read the file
+        return True
+
+    def rebalance(self, force=False):
+        """Do one pass over all files of this node, unless the ring did not change since the last pass.
+
+        Returns the number of moved files and of files that could not be moved.
+        """
+        from .models import Upload
+
+        stats = {'moved': 0, 'failed': 0}
+        ring = self.get_ring()
+        if not force and get_cache().get(self.key) == ring:
+            return stats
+
+        for using in shards.get_aliases():
+            last_pk = 0
+            qs = Upload.objects.using(using).uploaded().filter(node=self.node).order_by('pk')
+            while True:
+                batch = list(qs.filter(pk__gt=last_pk)[:self.batch_size])
+                if not batch:
+                    break
+
+                for upload in batch:
+                    owner = get_owner(upload.hash)
+                    if owner != self.node:
+                        stats['moved' if self.push(upload, owner) else 'failed'] += 1
+                last_pk = batch[-1].pk
+
+        if not stats['failed']:  # otherwise try again in the next pass
+            get_cache().set(self.key, ring, None)
+        return stats
+
+    def run(self, passes=None, callback=None, force=False):
+        """Rebalance continuously, sleeping ``interval`` seconds between passes.
+
+        If ``force`` is ``True``, the first pass checks all files even if the ring did not change.
+        """
+        done = 0
+        while True:
+            stats = self.rebalance(force=force and done == 0)
+            if callback is not None:
+                callback(stats)
+
+            done += 1
+            if passes is not None and done >= passes:
+                return
+            time.sleep(self.interval)
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-http-upload
+# (https://github.com/mathiasertl/django-xmpp-http-upload).
+#
+# django-xmpp-http-upload is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# django-xmpp-http-upload is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# django-xmpp-http-upload.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compress uploads of compressible content types in the background.
+
+Uploads whose type matches one of the ``types`` in the ``XMPP_HTTP_UPLOAD_COMPRESSION`` setting are
+compressed with gzip after the upload finished. The compressed file either replaces the original (the
+``file`` field then names the compressed file and ``encoding`` is ``"gzip"``) or, if ``keep_original``
+is set or the webserver serves files, is stored next to the original with a ".gz" suffix, so e.g.
+nginx's ``gzip_static`` can serve it. ``compressed_size`` is the size of the compressed file, ``None``
+if there is no compressed file.
+
+Downloads are served compressed with ``Content-Encoding: gzip`` if the client accepts it, otherwise a
+replaced original is decompressed on the fly. If a compressed file next to the original cannot be read
+(it is not copied to the mirrors), the original is served uncompressed.
+"""
+
+import fnmatch
+import gzip
+import logging
+import os
+import re
+import shutil
+
+from django.conf import settings
+
+from . import metadata
+from . import mirrors
+from .utils import BackgroundExecutor
+from .utils import remove_later
+from .utils import ws_download
+
+log = logging.getLogger(__name__)
+
+_COMPRESSION_DEFAULTS = {
+    'types': [],  # e.g. ['text/*', 'application/json']
+    'min_size': 1024,  # smaller uploads are not compressed
+    'max_ratio': 0.9,  # discard compressed files larger than this fraction of the original
+    'level': 6,
+    'keep_original': False,
+    'backend': 'thread',  # or "celery"
+}
+
+_accepts_gzip = re.compile(r'\bgzip\b')
+
+# uploads of the "thread" backend are compressed one after another
+_executor = BackgroundExecutor()
+
+
+def get_compression_config():
+    config = dict(_COMPRESSION_DEFAULTS)
+    config.update(getattr(settings, 'XMPP_HTTP_UPLOAD_COMPRESSION', {}))
+    return config
+
+
+def should_compress(upload):
+    """Return ``True`` if ``upload`` should be compressed. Uploads in pack files are never compressed."""
+    config = get_compression_config()
+    if upload.offset is not None or upload.size < config['min_size']:
+        return False
+
+    content_type = (upload.type or '').split(';')[0].strip().lower()
+    return any(fnmatch.fnmatchcase(content_type, pattern) for pattern in config['types'])
+
+
+def accepts_gzip(request):
+    return bool(_accepts_gzip.search(request.META.get('HTTP_ACCEPT_ENCODING', '')))
+
+
+class DecompressedFile:
+    """A read-only file object decompressing a gzip-compressed file.
+
+    It deliberately has no ``fileno()``, so WSGI servers do not send the compressed file with
+    ``sendfile()``.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.gzip = gzip.GzipFile(fileobj=file, mode='rb')
+
+    def read(self, size=-1):
+        return self.gzip.read(size)
+
+    def close(self):
+        self.gzip.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_compressed(upload):
+    """Open the compressed file of an upload, ``None`` if it cannot be read."""
+    if upload.encoding == 'gzip':
+        return mirrors.open_copy(upload)
+
+    try:
+        return open('%s.gz' % upload.path, 'rb')
+    except OSError:
+        log.exception('Cannot read the compressed file of %s.', upload.file.name)
+        return None
+
+
+def compress(source, destination, level):
+    """Compress ``source`` so that ``destination`` never contains a partial file, returns its size."""
+    tmp = '%s.tmp' % destination
+    with open(source, 'rb') as src, gzip.GzipFile(tmp, 'wb', compresslevel=level, mtime=0) as dst:
+        shutil.copyfileobj(src, dst)
+    os.replace(tmp, destination)
+    return os.path.getsize(destination)
+
+
+def compress_stored(upload, using=None, keep_original=False, level=6, max_ratio=0.9):
+    """Compress the stored file of ``upload`` (and update ``upload``), see the module documentation.
+
+    The row is only updated if the file was not moved in the meantime, e.g. to another node. Returns the
+    size of the compressed file, ``None`` if the upload was not compressed.
+    """
+    from .models import Upload
+
+    original = upload.file.name
+    path = '%s.gz' % upload.path
+    size = compress(upload.path, path, level)
+
+    qs = Upload.objects.using(using).filter(pk=upload.pk, file=original, cold=upload.cold)
+    fields = {'compressed_size': size}
+    if size > upload.size * max_ratio:
+        updated = 0
+    elif keep_original:
+        updated = qs.update(**fields)
+    else:
+        fields.update(file='%s.gz' % original, encoding='gzip', mirrors=0)
+        updated = qs.update(**fields)
+        if updated:  # copies of the original are made again
+            remove_later(upload.path)  # downloads may still be about to open the original
+            mirrors.remove_copies(original)
+
+    if not updated:
+        os.remove(path)
+        return None
+    metadata.remove(upload)  # compressed uploads are served using the database
+    for field, value in fields.items():
+        setattr(upload, field, value)
+    return size
+
+
+def compress_upload(pk, using=None):
+    """Compress an upload and copy it to the mirrors afterwards (see :py:func:`schedule`).
+
+    Returns the size of the compressed file, ``None`` if the upload was not compressed.
+    """
+    from .models import Upload
+
+    config = get_compression_config()
+    upload = Upload.objects.using(using).uploaded().filter(pk=pk, compressed_size__isnull=True).first()
+    size = None
+    if upload is not None and should_compress(upload):
+        size = compress_stored(upload, using, keep_original=config['keep_original'] or ws_download(),
+                               level=config['level'], max_ratio=config['max_ratio'])
+
+    if mirrors.get_roots():
+        mirrors.mirror_upload(pk, using=using)
+    return size
+
+
+def schedule(upload):
+    """Process a new upload in the background: compress it (if enabled), then copy it to the mirrors."""
+    if not should_compress(upload):
+        mirrors.schedule(upload)
+        return
+
+    using = upload._state.db
+    if get_compression_config()['backend'] == 'celery':
+        from .tasks import compress_http_upload
+
+        compress_http_upload.delay(upload.pk, using=using)
+    else:
+        _executor.submit(compress_upload, upload.pk, using)
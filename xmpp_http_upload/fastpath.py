@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-http-upload
+# (https://github.com/mathiasertl/django-xmpp-http-upload).
+#
+# django-xmpp-http-upload is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# django-xmpp-http-upload is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# django-xmpp-http-upload.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A WSGI application serving only the slot and max_size endpoints.
+
+Requests to these endpoints are small but would pay for the full middleware stack and URL resolving of the
+project. The application returned by :py:func:`get_fast_path_application` calls the views directly, so it
+shares ACLs, quotas and models with the main application. Mount it separately, e.g. in a second uWSGI
+instance for the ``slot/`` and ``max_size/`` paths below ``prefix``.
+"""
+
+import django
+from django.core.handlers.exception import response_for_exception
+from django.core.handlers.wsgi import WSGIHandler
+from django.http import HttpResponseNotFound
+
+
+class FastPathHandler(WSGIHandler):
+    """WSGI handler dispatching to the slot and max_size views without any middleware."""
+
+    def __init__(self, prefix='/http_upload/'):
+        from .views import MaxSizeView  # views can only be imported once apps are loaded
+        from .views import RequestSlotView
+
+        super().__init__()
+        self.routes = {
+            '%sslot/' % prefix: RequestSlotView.as_view(),
+            '%smax_size/' % prefix: MaxSizeView.as_view(),
+        }
+
+    def load_middleware(self):
+        pass  # skip all middleware of the project
+
+    def get_response(self, request):
+        view = self.routes.get(request.path_info)
+        if view is None:
+            return HttpResponseNotFound()
+        try:
+            return view(request)
+        except Exception as e:
+            return response_for_exception(request, e)
+
+
+def get_fast_path_application(prefix='/http_upload/'):
+    """Get the WSGI application, like :py:func:`django.core.wsgi.get_wsgi_application`.
+
+    ``prefix`` is the path the URLs of this app are included at in the project.
+    """
+    django.setup(set_prefix=False)
+    return FastPathHandler(prefix)
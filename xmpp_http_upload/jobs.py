@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-http-upload
+# (https://github.com/mathiasertl/django-xmpp-http-upload).
+#
+# django-xmpp-http-upload is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# django-xmpp-http-upload is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# django-xmpp-http-upload.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Background jobs started from the admin interface.
+
+Jobs run either as Celery tasks or in a background thread of the web server process (see the ``backend``
+value of the ``XMPP_HTTP_UPLOAD_JOBS`` setting). The progress of a job is stored in the cache configured
+by ``XMPP_HTTP_UPLOAD_CACHE``, so it can be shown no matter which process runs the job.
+"""
+
+import logging
+import uuid
+
+from django.conf import settings
+
+from .cluster import is_remote
+from .models import Slot
+from .models import Upload
+from .reaper import get_reaper_config
+from .shards import for_each_shard
+from .shards import get_aliases
+from .utils import BackgroundExecutor
+from .utils import Throttle
+from .utils import get_cache
+
+log = logging.getLogger(__name__)
+
+_JOBS_DEFAULTS = {
+    'backend': 'thread',  # or "celery"
+    'batch_size': 100,
+    'timeout': 86400,  # seconds the progress of a job is kept
+}
+
+# jobs of the "thread" backend run one after another
+_executor = BackgroundExecutor()
+
+
+def get_jobs_config():
+    config = dict(_JOBS_DEFAULTS)
+    config.update(getattr(settings, 'XMPP_HTTP_UPLOAD_JOBS', {}))
+    return config
+
+
+class Job:
+    """The progress of a background job."""
+
+    def __init__(self, id):
+        self.id = id
+        self.key = 'xmpp-http-upload:job:%s' % id
+        self.timeout = get_jobs_config()['timeout']
+
+    @classmethod
+    def create(cls, description, total):
+        job = cls(uuid.uuid4().hex)
+        job.update(description=description, total=total, done=0, status='queued')
+        return job
+
+    def get(self):
+        """Get the progress as dictionary, ``None`` if the job does not exist (anymore)."""
+        return get_cache().get(self.key)
+
+    def update(self, **kwargs):
+        data = self.get() or {'id': self.id}
+        data.update(kwargs)
+        get_cache().set(self.key, data, self.timeout)
+
+
+def _jid_batches(jids, batch_size):
+    """Get the uploads of ``jids`` in batches, one shard after another. Slots are deleted right away."""
+    for alias in get_aliases():
+        slots = Slot.objects.using(alias).filter(jid__in=jids)
+        for slot in slots.local().only('hash', 'name'):
+            slot.remove_partial_file()
+        slots.local().delete()
+        slots.expire()  # slots of other nodes in cluster mode
+
+        qs = Upload.objects.using(alias).filter(jid__in=jids).order_by('pk')
+        last_pk = 0
+        while True:
+            batch = list(qs.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+            yield alias, batch
+            last_pk = batch[-1].pk
+
+
+def delete_batch(uploads, using=None, io=None):
+    """Delete uploads of the shard ``using`` with their files, calling ``io`` for every removed file.
+
+    In cluster mode, uploads stored on another node are expired instead, so the cleanup or the reaper of
+    that node removes them with their files.
+    """
+    local = [upload for upload in uploads if not is_remote(upload)]
+    for upload in local:
+        if io is not None:
+            io(2)  # unlink the file and remove its directory
+        upload.remove_file()
+
+    qs = Upload.objects.using(using)
+    qs.filter(pk__in=[upload.pk for upload in local]).delete()
+    qs.filter(pk__in=[upload.pk for upload in uploads if is_remote(upload)]).expire()
+
+
+def delete_uploads(job_id, pks=None, jids=None, using=None):
+    """Delete uploads (with their files) by primary key or all uploads and slots of the given JIDs.
+
+    Primary keys refer to rows on the shard ``using``, JIDs are deleted on all shards. Rows are deleted
+    in batches under the ``rows_per_second`` and ``iops`` budget of the reaper. In cluster mode, uploads
+    and slots of other nodes are left to these nodes (see :py:func:`delete_batch`).
+    """
+    job = Job(job_id)
+    config = get_reaper_config()
+    rows = Throttle(config['rows_per_second'])
+    io = Throttle(config['iops'])
+    batch_size = get_jobs_config()['batch_size']
+
+    if pks is not None:
+        chunks = (pks[i:i + batch_size] for i in range(0, len(pks), batch_size))
+        batches = ((using, list(Upload.objects.using(using).filter(pk__in=chunk))) for chunk in chunks)
+    else:
+        batches = _jid_batches(jids, batch_size)
+
+    done = 0
+    job.update(status='running')
+    try:
+        for alias, batch in batches:
+            rows(len(batch))
+            delete_batch(batch, using=alias, io=io)
+            done += len(batch)
+            job.update(done=done)
+    except Exception as e:
+        log.exception('Job %s failed.', job_id)
+        job.update(status='failed', error=str(e))
+        raise
+    job.update(status='done')
+
+
+def start_delete(description, pks=None, jids=None, using=None):
+    """Start a background job deleting uploads, see :py:func:`delete_uploads`."""
+    if pks is not None:
+        total = len(pks)
+    else:
+        total = sum(for_each_shard(lambda alias: Upload.objects.using(alias).filter(jid__in=jids).count()))
+    job = Job.create(description, total)
+
+    if get_jobs_config()['backend'] == 'celery':
+        from .tasks import delete_http_uploads
+
+        delete_http_uploads.delay(job.id, pks=pks, jids=jids, using=using)
+    else:
+        _executor.submit(delete_uploads, job.id, pks=pks, jids=jids, using=using)
+    return job
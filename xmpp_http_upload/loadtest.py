@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-http-upload
+# (https://github.com/mathiasertl/django-xmpp-http-upload).
+#
+# django-xmpp-http-upload is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# django-xmpp-http-upload is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# django-xmpp-http-upload.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Load generator simulating XMPP users, used by the ``loadtest_http_uploads`` management command."""
+
+import http.client
+import math
+import random
+import threading
+import time
+from collections import Counter
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+from urllib.parse import urlsplit
+
+from django.core.servers.basehttp import ThreadedWSGIServer
+from django.core.servers.basehttp import WSGIRequestHandler
+from django.core.wsgi import get_wsgi_application
+from django.db import connection
+
+
+def percentile(values, pct):
+    """Get the percentile (nearest rank) of a sorted, non-empty list."""
+    return values[max(0, int(math.ceil(pct / 100 * len(values))) - 1)]
+
+
+def get_endpoint(method, path):
+    if method == 'PUT':
+        return 'put'
+    elif path.endswith('/slot/'):
+        return 'slot'
+    return 'get'
+
+
+class Stats:
+    """Thread-safe collection of request statistics per endpoint."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.errors = Counter()
+        self.abandoned = Counter()
+        self.bytes = Counter()
+        self.queries = Counter()
+        self.counted = Counter()  # requests where we counted queries
+
+    def record(self, endpoint, latency, status=None, size=0):
+        with self.lock:
+            self.latencies[endpoint].append(latency)
+            self.statuses[endpoint][status] += 1
+            self.bytes[endpoint] += size
+            if status is None or status >= 400:
+                self.errors[endpoint] += 1
+
+    def record_abandoned(self, endpoint):
+        with self.lock:
+            self.abandoned[endpoint] += 1
+
+    def record_queries(self, endpoint, count):
+        with self.lock:
+            self.queries[endpoint] += count
+            self.counted[endpoint] += 1
+
+    def report(self, duration):
+        report = {}
+        for endpoint in sorted(self.latencies):
+            latencies = sorted(self.latencies[endpoint])
+            requests = len(latencies)
+            data = {
+                'requests': requests,
+                'abandoned': self.abandoned[endpoint],
+                'errors': self.errors[endpoint],
+                'error_rate': self.errors[endpoint] / requests,
+                'statuses': {str(k): v for k, v in self.statuses[endpoint].items()},
+                'requests_per_second': requests / duration,
+                'bytes_per_second': self.bytes[endpoint] / duration,
+                'p50': percentile(latencies, 50),
+                'p90': percentile(latencies, 90),
+                'p99': percentile(latencies, 99),
+                'max': latencies[-1],
+                'queries': None,
+                'queries_per_request': None,
+            }
+            if self.counted[endpoint]:
+                data['queries'] = self.queries[endpoint]
+                data['queries_per_request'] = self.queries[endpoint] / self.counted[endpoint]
+            report[endpoint] = data
+        return report
+
+
+class QueryCountingApplication:
+    """WSGI application wrapper counting database queries per endpoint."""
+
+    def __init__(self, application, stats):
+        self.application = application
+        self.stats = stats
+
+    def __call__(self, environ, start_response):
+        endpoint = get_endpoint(environ['REQUEST_METHOD'], environ['PATH_INFO'])
+        queries = []
+
+        def counter(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(counter):
+            response = self.application(environ, start_response)
+        self.stats.record_queries(endpoint, len(queries))
+        return response
+
+
+class QuietWSGIRequestHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class LocalServer(threading.Thread):
+    """A threaded WSGI server running this Django project in the current process."""
+
+    def __init__(self, stats, host='127.0.0.1', port=0):
+        super().__init__(daemon=True)
+        application = QueryCountingApplication(get_wsgi_application(), stats)
+        self.httpd = ThreadedWSGIServer((host, port), QuietWSGIRequestHandler)
+        self.httpd.set_app(application)
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.httpd.server_address[:2]
+
+    def run(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class LoadGenerator:
+    """Simulate ``users`` XMPP users, each uploading ``uploads`` files.
+
+    A fraction of uploads is sent slowly (``slow``) or abandoned (``abandon``) half way through. Every
+    successful upload is downloaded ``fanout`` times in parallel, simulating a group chat.
+    """
+
+    chunk_size = 8192
+
+    def __init__(self, slot_url, users=10, uploads=10, sizes=(1024, ), slow=0.1, abandon=0.05,
+                 fanout=3, slow_delay=0.01, jid='loadtest-%d@localhost', timeout=60, seed=None,
+                 stats=None):
+        self.slot_url = slot_url
+        self.users = users
+        self.uploads = uploads
+        self.sizes = sizes
+        self.slow = slow
+        self.abandon = abandon
+        self.fanout = fanout
+        self.slow_delay = slow_delay
+        self.jid = jid
+        self.timeout = timeout
+        self.random = random.Random(seed)
+        self.stats = stats or Stats()
+        self.downloads = None
+
+    def get_jids(self):
+        return [self.jid % i for i in range(self.users)]
+
+    def request(self, method, url, body=None, slow=False, abandon=False):
+        """Send a request, returns the response body or ``None`` if the request failed."""
+        parsed = urlsplit(url)
+        path = parsed.path
+        if parsed.query:
+            path = '%s?%s' % (path, parsed.query)
+        endpoint = get_endpoint(method, parsed.path)
+
+        if parsed.scheme == 'https':  # pragma: no cover - no TLS in the test suite
+            conn = http.client.HTTPSConnection(parsed.netloc, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(parsed.netloc, timeout=self.timeout)
+
+        start = time.monotonic()
+        try:
+            conn.putrequest(method, path)
+            if body is not None:
+                conn.putheader('Content-Type', 'application/octet-stream')
+                conn.putheader('Content-Length', str(len(body)))
+            conn.endheaders()
+
+            if body is not None:
+                end = len(body) // 2 if abandon else len(body)
+                for offset in range(0, end, self.chunk_size):
+                    conn.send(body[offset:min(offset + self.chunk_size, end)])
+                    if slow:
+                        time.sleep(self.slow_delay)
+                if abandon:
+                    self.stats.record_abandoned(endpoint)
+                    return None
+
+            response = conn.getresponse()
+            content = response.read()
+        except (OSError, http.client.HTTPException):
+            self.stats.record(endpoint, time.monotonic() - start)
+            return None
+        finally:
+            conn.close()
+
+        size = len(content) + (len(body) if body is not None else 0)
+        self.stats.record(endpoint, time.monotonic() - start, response.status, size)
+        if response.status >= 400:
+            return None
+        return content
+
+    def download(self, url):
+        self.request('GET', url)
+
+    def user(self, jid):
+        for i in range(self.uploads):
+            size = self.random.choice(self.sizes)
+            params = {'jid': jid, 'name': 'loadtest-%s.bin' % i, 'size': size}
+            content = self.request('GET', '%s?%s' % (self.slot_url, urlencode(params)))
+            if content is None:
+                continue
+
+            put_url, get_url = content.decode('utf-8').split()
+            roll = self.random.random()
+            abandon = roll < self.abandon
+            slow = not abandon and roll < self.abandon + self.slow
+
+            if self.request('PUT', put_url, body=b'x' * size, slow=slow, abandon=abandon) is None:
+                continue
+
+            for j in range(self.fanout):
+                self.downloads.submit(self.download, get_url)
+
+    def run(self):
+        """Run the load test, returns the duration in seconds."""
+        start = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=max(1, self.users * self.fanout)) as downloads:
+            self.downloads = downloads
+            threads = [threading.Thread(target=self.user, args=(jid, )) for jid in self.get_jids()]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        return time.monotonic() - start
@@ -19,6 +19,7 @@ from __future__ import unicode_literals
 from django.core.management.base import BaseCommand
 
 from xmpp_http_upload.models import Upload
+from xmpp_http_upload.shards import for_each_shard
 
 
 class Command(BaseCommand):
@@ -43,4 +44,5 @@ class Command(BaseCommand):
         timeout = None
         if options['timeout'] is not None:
             timeout = options['timeout'] * 86400
-        Upload.objects.cleanup(slots=slots, files=files, timeout=timeout)
+        for_each_shard(lambda alias: Upload.objects.using(alias).cleanup(
+            slots=slots, files=files, timeout=timeout))
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-http-upload
+# (https://github.com/mathiasertl/django-xmpp-http-upload).
+#
+# django-xmpp-http-upload is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# django-xmpp-http-upload is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# django-xmpp-http-upload.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand
+
+from xmpp_http_upload.packs import Compactor
+from xmpp_http_upload.utils import parse_size
+
+
+class Command(BaseCommand):
+    help = 'Reclaim the space of removed uploads in pack files. Run only one instance at a time (per node).'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--min-garbage', type=float, metavar='FRACTION',
+            help='Compact pack files with at least FRACTION (e.g. "0.5") unused bytes.')
+        parser.add_argument(
+            '--bytes-per-second', type=parse_size, metavar='SIZE',
+            help='Maximum number of bytes copied per second, e.g. "50M".')
+
+    def handle(self, *args, **options):
+        stats = Compactor(
+            min_garbage=options['min_garbage'], bytes_per_second=options['bytes_per_second']).compact()
+        if options['verbosity'] >= 2:
+            self.stdout.write('Removed %(removed)s pack files, moved %(moved)s uploads.' % stats)
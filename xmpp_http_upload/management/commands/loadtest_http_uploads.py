@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-http-upload
+# (https://github.com/mathiasertl/django-xmpp-http-upload).
+#
+# django-xmpp-http-upload is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# django-xmpp-http-upload is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# django-xmpp-http-upload.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+
+from django.core.management.base import BaseCommand
+from django.urls import reverse
+
+from xmpp_http_upload.loadtest import LoadGenerator
+from xmpp_http_upload.loadtest import LocalServer
+from xmpp_http_upload.loadtest import Stats
+from xmpp_http_upload.models import Slot
+from xmpp_http_upload.models import Upload
+from xmpp_http_upload.shards import for_each_shard
+from xmpp_http_upload.utils import parse_size
+
+
+class Command(BaseCommand):
+    help = '''Simulate XMPP users requesting slots, uploading files and downloading them in group chats.
+
+If no URL is given, a threaded server is started in this process, this also allows counting database
+queries per endpoint. Note that users are subject to the XMPP_HTTP_UPLOAD_ACCESS setting of the server.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--url', metavar='URL',
+            help='URL of the slot API of a running server, e.g. "http://127.0.0.1:8000/http_upload/slot/".')
+        parser.add_argument(
+            '--users', type=int, default=10, metavar='N', help='Number of simulated users (default: 10).')
+        parser.add_argument(
+            '--uploads', type=int, default=10, metavar='N', help='Uploads per user (default: 10).')
+        parser.add_argument(
+            '--sizes', type=lambda v: [parse_size(s) for s in v.split(',')], default=[1024, 65536, 1048576],
+            metavar='SIZE[,SIZE...]', help='Upload sizes to choose from (default: 1K,64K,1M).')
+        parser.add_argument(
+            '--slow', type=float, default=0.1, metavar='FRACTION',
+            help='Fraction of uploads that are sent slowly (default: 0.1).')
+        parser.add_argument(
+            '--abandon', type=float, default=0.05, metavar='FRACTION',
+            help='Fraction of uploads that are abandoned half way through (default: 0.05).')
+        parser.add_argument(
+            '--fanout', type=int, default=3, metavar='N',
+            help='Number of downloads of every upload, simulating a group chat (default: 3).')
+        parser.add_argument(
+            '--jid', default='loadtest-%d@localhost', metavar='TEMPLATE',
+            help='Template for JIDs of the simulated users (default: %(default)s).')
+        parser.add_argument('--seed', type=int, help='Seed for the random number generator.')
+        parser.add_argument(
+            '--cleanup', default=False, action='store_true',
+            help='Remove uploads of simulated users from the database afterwards.')
+        parser.add_argument(
+            '--json', default=False, action='store_true', help='Output results as JSON.')
+
+    def print_report(self, report, duration):
+        self.stdout.write('Duration: %.2f seconds' % duration)
+        self.stdout.write('%-8s %8s %9s %7s %9s %10s %8s %8s %8s %9s' % (
+            'endpoint', 'requests', 'abandoned', 'errors', 'req/s', 'KiB/s', 'p50', 'p90', 'p99',
+            'queries'))
+        for endpoint, data in report.items():
+            queries = '-'
+            if data['queries_per_request'] is not None:
+                queries = '%.2f' % data['queries_per_request']
+            self.stdout.write('%-8s %8d %9d %6.2f%% %9.2f %10.2f %7.3fs %7.3fs %7.3fs %9s' % (
+                endpoint, data['requests'], data['abandoned'], data['error_rate'] * 100,
+                data['requests_per_second'], data['bytes_per_second'] / 1024, data['p50'], data['p90'],
+                data['p99'], queries))
+
+    def cleanup(self, using, jids):
+        Slot.objects.using(using).filter(jid__in=jids).delete()
+        for upload in Upload.objects.using(using).filter(jid__in=jids):
+            upload.remove_file()
+            upload.delete()
+
+    def handle(self, *args, **options):
+        stats = Stats()
+        server = None
+        url = options['url']
+        if url is None:
+            server = LocalServer(stats)
+            server.start()
+            url = server.url + reverse('xmpp-http-upload:slot')
+
+        generator = LoadGenerator(
+            url, users=options['users'], uploads=options['uploads'], sizes=options['sizes'],
+            slow=options['slow'], abandon=options['abandon'], fanout=options['fanout'], jid=options['jid'],
+            seed=options['seed'], stats=stats)
+        try:
+            duration = generator.run()
+        finally:
+            if server is not None:
+                server.stop()
+
+        if options['cleanup']:
+            for_each_shard(self.cleanup, generator.get_jids())
+
+        report = stats.report(duration)
+        if options['json']:
+            self.stdout.write(json.dumps({'duration': duration, 'endpoints': report}, indent=4))
+        else:
+            self.print_report(report, duration)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-http-upload
+# (https://github.com/mathiasertl/django-xmpp-http-upload).
+#
+# django-xmpp-http-upload is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# django-xmpp-http-upload is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# django-xmpp-http-upload.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from xmpp_http_upload.mirrors import get_roots
+from xmpp_http_upload.mirrors import mirror_missing
+from xmpp_http_upload.shards import for_each_shard
+
+
+class Command(BaseCommand):
+    help = 'Copy uploaded files to the secondary roots that do not have a copy yet, e.g. after adding a root.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify', default=False, action='store_true',
+            help='Also check that recorded copies exist, e.g. after replacing a disk.')
+        parser.add_argument(
+            '--batch-size', type=int, default=100, metavar='N',
+            help='Number of uploads to check at once (default: %(default)s).')
+
+    def handle(self, *args, **options):
+        if not get_roots():
+            raise CommandError('No secondary roots configured, see the XMPP_HTTP_UPLOAD_MIRRORS setting.')
+
+        copies = sum(for_each_shard(lambda alias: mirror_missing(
+            using=alias, verify=options['verify'], batch_size=options['batch_size'])))
+        if options['verbosity'] >= 2:
+            self.stdout.write('Made %s copies.' % copies)
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-http-upload
+# (https://github.com/mathiasertl/django-xmpp-http-upload).
+#
+# django-xmpp-http-upload is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# django-xmpp-http-upload is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# django-xmpp-http-upload.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand
+
+from xmpp_http_upload.pipeline import run_pending
+from xmpp_http_upload.shards import for_each_shard
+
+
+class Command(BaseCommand):
+    help = 'Run the post-upload pipeline for uploads whose stages are due, e.g. after a restart.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=100, metavar='N',
+            help='Number of events to load at once (default: %(default)s).')
+
+    def handle(self, *args, **options):
+        results = for_each_shard(run_pending, options['batch_size'])
+        if options['verbosity'] >= 2:
+            stats = {key: sum(r[key] for r in results) for key in ('processed', 'failed')}
+            self.stdout.write('Processed %(processed)s uploads, %(failed)s failed.' % stats)
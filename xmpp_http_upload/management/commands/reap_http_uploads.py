@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-http-upload
+# (https://github.com/mathiasertl/django-xmpp-http-upload).
+#
+# django-xmpp-http-upload is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# django-xmpp-http-upload is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# django-xmpp-http-upload.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand
+
+from xmpp_http_upload.reaper import Reaper
+
+
+class Command(BaseCommand):
+    help = 'Continuously remove expired slots and files in small, rate-limited batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once', default=False, action='store_true',
+            help='Do only a single pass and exit.')
+        parser.add_argument(
+            '--interval', type=int, metavar='SECONDS',
+            help='Seconds to wait between passes.')
+        parser.add_argument(
+            '--batch-size', type=int, metavar='N',
+            help='Number of rows to remove at once.')
+        parser.add_argument(
+            '--rows-per-second', type=int, metavar='N',
+            help='Maximum number of database rows to remove per second.')
+        parser.add_argument(
+            '--iops', type=int, metavar='N',
+            help='Maximum number of file system operations per second.')
+        parser.add_argument(
+            '--partition-size', type=int, metavar='N',
+            help='Number of primary keys per partition, all nodes must use the same value.')
+
+    def print_stats(self, stats):
+        if self.verbosity >= 2:
+            self.stdout.write('Removed %(slots)s expired slots and %(files)s files.' % stats)
+        if self.verbosity >= 3 and stats['skipped']:
+            self.stdout.write('Partitions leased by other nodes: %s' % ', '.join(
+                str(p) for p in stats['skipped']))
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        reaper = Reaper(
+            batch_size=options['batch_size'], rows_per_second=options['rows_per_second'],
+            iops=options['iops'], partition_size=options['partition_size'], interval=options['interval'])
+
+        try:
+            reaper.run(passes=1 if options['once'] else None, callback=self.print_stats)
+        except KeyboardInterrupt:  # pragma: no cover - only for interactive use
+            pass
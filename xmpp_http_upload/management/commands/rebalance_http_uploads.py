@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-http-upload
+# (https://github.com/mathiasertl/django-xmpp-http-upload).
+#
+# django-xmpp-http-upload is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# django-xmpp-http-upload is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# django-xmpp-http-upload.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from xmpp_http_upload.cluster import Rebalancer
+from xmpp_http_upload.cluster import get_node
+
+
+class Command(BaseCommand):
+    help = 'Push files stored on this node to their owner in cluster mode, e.g. after nodes joined or left.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once', default=False, action='store_true',
+            help='Do only a single pass and exit.')
+        parser.add_argument(
+            '--force', default=False, action='store_true',
+            help='Check all files even if the nodes did not change since the last pass.')
+        parser.add_argument(
+            '--interval', type=int, metavar='SECONDS',
+            help='Seconds to wait between passes.')
+        parser.add_argument(
+            '--batch-size', type=int, metavar='N',
+            help='Number of uploads to check at once.')
+
+    def print_stats(self, stats):
+        if self.verbosity >= 2:
+            self.stdout.write('Moved %(moved)s files, %(failed)s failed.' % stats)
+
+    def handle(self, *args, **options):
+        if get_node() is None:
+            raise CommandError('Cluster mode is not enabled, see the XMPP_HTTP_UPLOAD_CLUSTER setting.')
+
+        self.verbosity = options['verbosity']
+        rebalancer = Rebalancer(batch_size=options['batch_size'], interval=options['interval'])
+
+        try:
+            rebalancer.run(passes=1 if options['once'] else None, callback=self.print_stats,
+                           force=options['force'])
+        except KeyboardInterrupt:  # pragma: no cover - only for interactive use
+            pass
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-http-upload
+# (https://github.com/mathiasertl/django-xmpp-http-upload).
+#
+# django-xmpp-http-upload is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# django-xmpp-http-upload is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# django-xmpp-http-upload.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import threading
+
+from django.core.management.base import BaseCommand
+
+from xmpp_http_upload.scrub import Checkpoint
+from xmpp_http_upload.scrub import Scrubber
+from xmpp_http_upload.shards import for_each_shard
+from xmpp_http_upload.shards import get_aliases
+from xmpp_http_upload.utils import parse_size
+
+
+class Command(BaseCommand):
+    help = 'Verify the SHA-256 digests of uploaded files. Missing or corrupt files are printed as JSON lines.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes', type=int, default=1, metavar='N',
+            help='Number of processes used to hash files, per shard (default: %(default)s).')
+        parser.add_argument(
+            '--bytes-per-second', type=parse_size, metavar='SIZE',
+            help='Maximum number of bytes read per second by all processes, e.g. "50M".')
+        parser.add_argument(
+            '--batch-size', type=int, default=100, metavar='N',
+            help='Number of files hashed between two checkpoints (default: %(default)s).')
+        parser.add_argument(
+            '--checkpoint', metavar='FILE',
+            help='Continue from and save progress to FILE (with the shard appended, if sharded).')
+        parser.add_argument(
+            '--max-duration', type=int, metavar='SECONDS',
+            help='Do not start another batch after SECONDS seconds.')
+
+    def report(self, data):
+        with self.lock:  # shards are scrubbed in parallel
+            self.stdout.write(json.dumps(data, sort_keys=True))
+
+    def scrub(self, alias, options):
+        path = options['checkpoint']
+        if path is not None and alias is not None:
+            path = '%s.%s' % (path, alias)
+
+        bytes_per_second = options['bytes_per_second']
+        if bytes_per_second:  # shared by all shards
+            bytes_per_second /= len(get_aliases())
+
+        scrubber = Scrubber(
+            processes=options['processes'], bytes_per_second=bytes_per_second,
+            batch_size=options['batch_size'], checkpoint=Checkpoint(path),
+            max_duration=options['max_duration'], using=alias)
+        return scrubber.scrub(callback=self.report)
+
+    def handle(self, *args, **options):
+        self.lock = threading.Lock()
+        results = for_each_shard(self.scrub, options)
+        stats = {key: sum(r[key] for r in results)
+                 for key in ('ok', 'updated', 'missing', 'corrupt', 'error')}
+        stats['complete'] = all(r['complete'] for r in results)
+
+        if options['verbosity'] >= 2:
+            stats['complete'] = 'complete' if stats['complete'] else 'incomplete'
+            self.stderr.write(
+                'Scrub %(complete)s: %(ok)s ok, %(updated)s new digests, %(missing)s missing, %(corrupt)s '
+                'corrupt, %(error)s unreadable.' % stats)
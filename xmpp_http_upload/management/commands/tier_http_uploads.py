@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-http-upload
+# (https://github.com/mathiasertl/django-xmpp-http-upload).
+#
+# django-xmpp-http-upload is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# django-xmpp-http-upload is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# django-xmpp-http-upload.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from xmpp_http_upload.shards import for_each_shard
+from xmpp_http_upload.shards import get_aliases
+from xmpp_http_upload.tiering import Tierer
+from xmpp_http_upload.utils import parse_size
+
+
+class Command(BaseCommand):
+    help = 'Move uploads that were not downloaded for some days to cold storage.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, metavar='N',
+            help='Move uploads not downloaded for N days (default: the XMPP_HTTP_UPLOAD_TIERING setting).')
+        parser.add_argument(
+            '--batch-size', type=int, metavar='N',
+            help='Number of uploads to check at once.')
+        parser.add_argument(
+            '--bytes-per-second', type=parse_size, metavar='SIZE',
+            help='Maximum number of bytes read per second by all shards, e.g. "50M".')
+
+    def tier(self, alias, options):
+        bytes_per_second = options['bytes_per_second']
+        if bytes_per_second:  # shared by all shards
+            bytes_per_second /= len(get_aliases())
+
+        return Tierer(days=options['days'], batch_size=options['batch_size'],
+                      bytes_per_second=bytes_per_second, using=alias).run()
+
+    def handle(self, *args, **options):
+        if options['days'] is None and Tierer().days is None:
+            raise CommandError('Tiering is not enabled, see the XMPP_HTTP_UPLOAD_TIERING setting.')
+
+        results = for_each_shard(self.tier, options)
+        if options['verbosity'] >= 2:
+            stats = {key: sum(r[key] for r in results) for key in ('moved', 'failed')}
+            self.stdout.write('Moved %(moved)s uploads to cold storage, %(failed)s failed.' % stats)
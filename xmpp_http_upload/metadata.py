@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-http-upload
+# (https://github.com/mathiasertl/django-xmpp-http-upload).
+#
+# django-xmpp-http-upload is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# django-xmpp-http-upload is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# django-xmpp-http-upload.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Store the metadata of uploads next to their files, so downloads do not need the database.
+
+If the ``XMPP_HTTP_UPLOAD_METADATA`` setting is enabled, the primary key, JID, content type, size, digest
+and expiry of an upload are written as JSON to the extended attribute ``user.xmpp_http_upload`` of the
+stored file, or to a sidecar file with a ".meta" suffix if the filesystem does not support extended
+attributes (or ``xattrs`` is ``False``). Downloads use the metadata if the file is stored under the path
+given by the URL, so they keep working while the database is unavailable.
+
+Only uncompressed, unpacked files in ``MEDIA_ROOT`` have metadata: when an upload is compressed or moved
+to cold storage, its metadata is removed and downloads use the database again. Metadata is never written
+if the web server serves downloads (``XMPP_HTTP_UPLOAD_WEBSERVER_DOWNLOAD``): downloads would not use it,
+and the web server would serve sidecar files, which contain the JID of the uploader, to anyone.
+"""
+
+import errno
+import json
+import logging
+import os
+import time
+
+from django.conf import settings
+
+from .cluster import get_node
+from .utils import ws_download
+
+log = logging.getLogger(__name__)
+
+_METADATA_DEFAULTS = {
+    'enabled': False,
+    'xattrs': True,  # use extended attributes if the filesystem supports them
+}
+
+_attribute = 'user.xmpp_http_upload'
+_upload_base = getattr(settings, 'XMPP_HTTP_UPLOAD_ROOT', 'http_upload')
+_share_timeout = int(getattr(settings, 'XMPP_HTTP_UPLOAD_SHARE_TIMEOUT', 86400 * 30))
+
+
+def get_metadata_config():
+    config = dict(_METADATA_DEFAULTS)
+    config.update(getattr(settings, 'XMPP_HTTP_UPLOAD_METADATA', {}))
+    return config
+
+
+def enabled():
+    return get_metadata_config()['enabled'] and ws_download() is False
+
+
+def get_path(hash, name):
+    """Path of the file of the upload with the given URL."""
+    from .packs import get_storage
+
+    return get_storage().path(os.path.join(_upload_base, hash, name))
+
+
+def _set_xattr(path, data):
+    """Store ``data`` in an extended attribute, returns ``False`` if the filesystem does not support it."""
+    if not hasattr(os, 'setxattr'):  # pragma: no cover - only on Linux
+        return False
+    try:
+        os.setxattr(path, _attribute, data)
+    except OSError as e:
+        if e.errno != errno.ENOTSUP:
+            raise
+        return False
+    return True
+
+
+def write(upload):
+    """Write the metadata of ``upload``, if enabled and the file is stored under the path of its URL."""
+    config = get_metadata_config()
+    if not enabled() or upload.offset is not None or upload.cold:
+        return
+    if upload.compressed_size is not None:
+        return
+
+    path = upload.path
+    if path != get_path(upload.hash, upload.name):  # the storage picked another name
+        return
+
+    data = json.dumps({
+        'id': upload.pk,
+        'db': upload._state.db,
+        'jid': upload.jid,
+        'type': upload.type,
+        'size': upload.size,
+        'sha256': upload.sha256,
+        'expires': int(upload.created.timestamp()) + _share_timeout,
+    }, separators=(',', ':'), sort_keys=True).encode('utf-8')
+
+    try:
+        if config['xattrs'] and _set_xattr(path, data):
+            return
+        tmp = '%s.meta.tmp' % path
+        with open(tmp, 'wb') as stream:
+            stream.write(data)
+        os.replace(tmp, '%s.meta' % path)
+    except OSError:  # downloads use the database instead
+        log.exception('%s: Cannot write metadata.', path)
+
+
+def read(path):
+    """Read the metadata of the file at ``path``, ``None`` if it has none."""
+    data = None
+    if get_metadata_config()['xattrs'] and hasattr(os, 'getxattr'):
+        try:
+            data = os.getxattr(path, _attribute)
+        except OSError:  # no attribute, not supported or no file
+            pass
+    if data is None:
+        try:
+            with open('%s.meta' % path, 'rb') as stream:
+                data = stream.read()
+        except FileNotFoundError:
+            return None
+
+    try:
+        return json.loads(data.decode('utf-8'))
+    except ValueError:  # e.g. a truncated sidecar file
+        return None
+
+
+def load(hash, name):
+    """Get an unsaved :py:class:`~xmpp_http_upload.models.Upload` from the metadata of a stored file.
+
+    Returns ``None`` if the file has no (valid) metadata, does not match it or is expired.
+    """
+    from .models import Upload
+    from .models import get_upload_path
+
+    path = get_path(hash, name)
+    data = read(path)
+    if data is None or data['expires'] <= time.time():
+        return None
+    try:
+        if os.stat(path).st_size != data['size']:
+            return None
+    except FileNotFoundError:
+        return None
+
+    upload = Upload(pk=data['id'], jid=data['jid'], name=name, hash=hash, size=data['size'],
+                    type=data['type'], sha256=data['sha256'], node=get_node() or '')
+    upload.file.name = get_upload_path(upload, name)
+    upload._state.adding = False
+    upload._state.db = data['db']
+    return upload
+
+
+def remove(upload):
+    """Remove the metadata of ``upload``, also if metadata is disabled by now."""
+    path = get_path(upload.hash, upload.name)
+    if hasattr(os, 'removexattr'):  # pragma: no branch - only on Linux
+        try:
+            os.removexattr(path, _attribute)
+        except OSError:  # no attribute, not supported or no file
+            pass
+    try:
+        os.remove('%s.meta' % path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-http-upload
+# (https://github.com/mathiasertl/django-xmpp-http-upload).
+#
+# django-xmpp-http-upload is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# django-xmpp-http-upload is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# django-xmpp-http-upload.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Prometheus metrics.
+
+Metrics are only collected if `prometheus_client <https://github.com/prometheus/client_python>`_ is
+installed. If you use a WSGI server with multiple processes, set the ``prometheus_multiproc_dir``
+environment variable as described in the prometheus_client documentation.
+"""
+
+import functools
+import logging
+import os
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db.models import CharField
+from django.db.models import F
+from django.db.models import Sum
+from django.db.models import Value
+from django.db.models.functions import StrIndex
+from django.db.models.functions import Substr
+
+from .shards import for_each_shard
+from .utils import get_cache
+from .utils import try_cache
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+    from prometheus_client.core import GaugeMetricFamily
+except ImportError:  # pragma: no cover
+    prometheus_client = None
+
+log = logging.getLogger(__name__)
+_STORAGE_KEY = 'xmpp-http-upload:metrics:storage'
+
+
+def storage_interval():
+    return getattr(settings, 'XMPP_HTTP_UPLOAD_METRICS_STORAGE_INTERVAL', 60)
+
+
+class _NoopMetric:
+    """Stand-in for metrics if prometheus_client is not installed."""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def observe(self, amount):
+        pass
+
+    @contextmanager
+    def time(self):
+        yield
+
+    @contextmanager
+    def track_inprogress(self):
+        yield
+
+
+def _metric(cls, name, documentation, **kwargs):
+    if prometheus_client is None:
+        return _NoopMetric()
+    return getattr(prometheus_client, cls)(name, documentation, **kwargs)
+
+
+SLOT_REQUESTS = _metric(
+    'Counter', 'xmpp_http_upload_slot_requests_total',
+    'Slot requests by HTTP status code and reason.', labelnames=['status', 'reason'])
+REQUEST_LATENCY = _metric(
+    'Histogram', 'xmpp_http_upload_request_duration_seconds',
+    'Time spent handling a request (until the response starts).', labelnames=['view'])
+UPLOAD_BYTES = _metric(
+    'Counter', 'xmpp_http_upload_uploaded_bytes_total', 'Bytes received with successful uploads.')
+UPLOAD_THROUGHPUT = _metric(
+    'Histogram', 'xmpp_http_upload_upload_throughput_bytes_per_second', 'Throughput of uploads.',
+    buckets=[2 ** i for i in range(10, 31, 2)] + [float('inf')])
+UPLOADS_IN_PROGRESS = _metric(
+    'Gauge', 'xmpp_http_upload_uploads_in_progress', 'Uploads currently in progress.',
+    multiprocess_mode='livesum')
+ADMISSION_REJECTED = _metric(
+    'Counter', 'xmpp_http_upload_admission_rejected_total',
+    'Requests rejected because too many uploads are in progress.', labelnames=['view'])
+CLEANUP_DURATION = _metric(
+    'Histogram', 'xmpp_http_upload_cleanup_batch_duration_seconds',
+    'Time spent removing a batch of slots or files.', labelnames=['kind'])
+CLEANUP_REMOVED = _metric(
+    'Counter', 'xmpp_http_upload_cleanup_removed_total', 'Number of removed slots or files.',
+    labelnames=['kind'])
+
+
+def timed(view):
+    """Decorator to record the latency of a view method."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with REQUEST_LATENCY.labels(view=view).time():
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class StorageCollector:
+    """Collects the bytes stored per domain from the database at scrape time.
+
+    The totals are kept in the cache (see :py:func:`~xmpp_http_upload.utils.get_cache`) for
+    ``XMPP_HTTP_UPLOAD_METRICS_STORAGE_INTERVAL`` seconds, so frequent scrapes do not query all uploads.
+    """
+
+    def get_totals(self, using):
+        from .models import Upload
+
+        domain = Substr(F('jid'), StrIndex(F('jid'), Value('@')) + 1, output_field=CharField())
+        qs = Upload.objects.using(using).uploaded().annotate(domain=domain).values('domain').annotate(
+            total=Sum('size')).order_by('domain')
+        return list(qs)
+
+    def get_storage(self):
+        totals = {}
+        for rows in for_each_shard(self.get_totals):
+            for row in rows:
+                totals[row['domain']] = totals.get(row['domain'], 0) + row['total']
+        return totals
+
+    def collect(self):
+        totals = try_cache(lambda: get_cache().get(_STORAGE_KEY), None, log,
+                           'Cannot get storage metrics from cache.')
+        if totals is None:
+            totals = self.get_storage()
+            try_cache(lambda: get_cache().set(_STORAGE_KEY, totals, storage_interval()), None, log,
+                      'Cannot add storage metrics to cache.')
+
+        metric = GaugeMetricFamily('xmpp_http_upload_storage_bytes', 'Bytes stored per domain.',
+                                   labels=['domain'])
+        for domain in sorted(totals):
+            metric.add_metric([domain], totals[domain])
+        yield metric
+
+
+def enabled():
+    return prometheus_client is not None and getattr(settings, 'XMPP_HTTP_UPLOAD_METRICS', False)
+
+
+def generate_latest():
+    """Generate the output for the metrics view."""
+
+    if os.environ.get('prometheus_multiproc_dir'):
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+
+    storage = prometheus_client.CollectorRegistry()
+    storage.register(StorageCollector())
+    return prometheus_client.generate_latest(registry) + prometheus_client.generate_latest(storage)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-http-upload
+# (https://github.com/mathiasertl/django-xmpp-http-upload).
+#
+# django-xmpp-http-upload is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# django-xmpp-http-upload is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# django-xmpp-http-upload.  If not, see <http://www.gnu.org/licenses/>.
+
+import cProfile
+import heapq
+import logging
+import os
+import random
+import threading
+import time
+
+from django.db import connections
+
+from .profiling import Profile
+from .profiling import get_profile
+from .profiling import get_profiling_config
+from .profiling import set_profile
+
+log = logging.getLogger(__name__)
+
+
+class ProfilingMiddleware:
+    """Profile a sample of the requests to the views of this app.
+
+    Sampled requests are logged with their per-phase timings and database queries and get a
+    ``Server-Timing`` response header. Optionally, they are also profiled with :py:mod:`cProfile` and the
+    profiles of the slowest requests are written to a directory. The number of database queries of every
+    request is checked against the (optional) budget for the view. See the ``XMPP_HTTP_UPLOAD_PROFILING``
+    setting for configuration.
+    """
+
+    app_name = 'xmpp-http-upload'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.lock = threading.Lock()
+        self.slowest = []  # heap of (duration, path) of dumped profiles
+
+    def __call__(self, request):
+        try:
+            response = self.get_response(request)
+        finally:
+            profile = get_profile()
+            if profile is not None:
+                set_profile(None)
+                for connection in connections.all():
+                    connection.execute_wrappers.remove(profile.execute)
+                if profile.profiler is not None:
+                    profile.profiler.disable()
+                profile.finish()
+
+        if profile is not None:
+            self.process_profile(request, response, profile)
+        return response
+
+    def get_view_name(self, request):
+        match = request.resolver_match
+        if match.url_name == 'share':  # PUT and GET share the same view
+            return request.method.lower()
+        return match.url_name
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if self.app_name not in request.resolver_match.app_names:
+            return
+
+        config = get_profiling_config()
+        view = self.get_view_name(request)
+        sampled = random.random() < config['sample_rate']
+        if not sampled and view not in config['query_budgets']:
+            return
+
+        profile = Profile(view, sampled)
+        if sampled and config['cprofile']:
+            profile.profiler = cProfile.Profile()
+            profile.profiler.enable()
+
+        for connection in connections.all():  # uploads may be stored in shards
+            connection.execute_wrappers.append(profile.execute)
+        set_profile(profile)
+
+    def process_profile(self, request, response, profile):
+        config = get_profiling_config()
+
+        budget = config['query_budgets'].get(profile.view)
+        if budget is not None and len(profile.queries) > budget:
+            log.warning('%s %s: %s queries exceed the budget of %s queries.', request.method, request.path,
+                        len(profile.queries), budget)
+
+        if not profile.sampled:
+            return
+
+        timing = profile.server_timing()
+        response['Server-Timing'] = timing
+        log.info('%s %s: %s', request.method, request.path, timing)
+
+        if profile.profiler is not None and config['cprofile_dir']:
+            self.dump(profile, config['cprofile_dir'], config['slowest'])
+
+    def dump(self, profile, directory, slowest):
+        """Dump the cProfile stats if the request is among the ``slowest`` requests so far."""
+
+        with self.lock:
+            if len(self.slowest) >= slowest and profile.duration <= self.slowest[0][0]:
+                return
+
+            path = os.path.join(directory, '%s-%s-%.3f.prof' % (profile.view, time.time(), profile.duration))
+            profile.profiler.dump_stats(path)
+            heapq.heappush(self.slowest, (profile.duration, path))
+
+            if len(self.slowest) > slowest:
+                duration, path = heapq.heappop(self.slowest)
+                os.remove(path)
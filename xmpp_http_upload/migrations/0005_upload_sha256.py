@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-19 15:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xmpp_http_upload', '0004_auto_20170309_2201'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='upload',
+            name='sha256',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
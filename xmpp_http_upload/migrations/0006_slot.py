@@ -0,0 +1,61 @@
+# Generated by Django 3.0.14 on 2026-10-19 15:24
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def move_slots(apps, schema_editor):
+    """Move uploads without a file to the new slot table."""
+    Slot = apps.get_model('xmpp_http_upload', 'Slot')
+    Upload = apps.get_model('xmpp_http_upload', 'Upload')
+
+    qs = Upload.objects.filter(models.Q(file='') | models.Q(file__isnull=True))
+    for upload in qs.iterator():
+        slot = Slot.objects.create(jid=upload.jid, name=upload.name, size=upload.size, type=upload.type,
+                                   hash=upload.hash, sha256=upload.sha256)
+        Slot.objects.filter(pk=slot.pk).update(created=upload.created)  # created is auto_now_add
+    qs.delete()
+
+
+def move_uploads(apps, schema_editor):
+    """Move slots back to the upload table."""
+    Slot = apps.get_model('xmpp_http_upload', 'Slot')
+    Upload = apps.get_model('xmpp_http_upload', 'Upload')
+
+    for slot in Slot.objects.iterator():
+        upload = Upload.objects.create(jid=slot.jid, name=slot.name, size=slot.size, type=slot.type,
+                                       hash=slot.hash, sha256=slot.sha256)
+        Upload.objects.filter(pk=upload.pk).update(created=slot.created)
+    Slot.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xmpp_http_upload', '0005_upload_sha256'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Slot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('jid', models.CharField(max_length=256)),
+                ('name', models.CharField(max_length=256)),
+                ('size', models.PositiveIntegerField()),
+                ('type', models.CharField(blank=True, max_length=255, null=True)),
+                ('hash', models.CharField(max_length=64)),
+                ('sha256', models.CharField(blank=True, max_length=64, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.AlterField(
+            model_name='upload',
+            name='created',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.RunPython(move_slots, move_uploads),
+    ]
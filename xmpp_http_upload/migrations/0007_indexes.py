@@ -0,0 +1,29 @@
+# Generated by Django 3.0.14 on 2026-10-19 15:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xmpp_http_upload', '0006_slot'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='slot',
+            index=models.Index(fields=['jid', 'created'], name='xmpp_http_u_jid_55c492_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='slot',
+            index=models.Index(fields=['created'], name='xmpp_http_u_created_af672a_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='upload',
+            index=models.Index(fields=['jid', 'created'], name='xmpp_http_u_jid_0cc784_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='upload',
+            index=models.Index(fields=['created'], name='xmpp_http_u_created_282449_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.0.14 on 2026-10-19 15:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xmpp_http_upload', '0007_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='slot',
+            name='node',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='upload',
+            name='node',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddIndex(
+            model_name='upload',
+            index=models.Index(fields=['node'], name='xmpp_http_u_node_7a8c18_idx'),
+        ),
+    ]
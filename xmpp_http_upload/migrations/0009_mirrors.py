@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-19 15:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xmpp_http_upload', '0008_node'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='upload',
+            name='mirrors',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
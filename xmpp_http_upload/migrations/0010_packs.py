@@ -0,0 +1,22 @@
+# Generated by Django 3.0.14 on 2026-10-19 15:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xmpp_http_upload', '0009_mirrors'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='upload',
+            name='offset',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='upload',
+            index=models.Index(condition=models.Q(offset__isnull=False), fields=['file'], name='xmpp_http_upload_pack_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.0.14 on 2026-10-19 16:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xmpp_http_upload', '0010_packs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='upload',
+            name='compressed_size',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='upload',
+            name='encoding',
+            field=models.CharField(blank=True, default='', editable=False, max_length=16),
+        ),
+    ]
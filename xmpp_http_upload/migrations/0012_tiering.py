@@ -0,0 +1,23 @@
+# Generated by Django 3.0.14 on 2026-10-19 16:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xmpp_http_upload', '0011_compression'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='upload',
+            name='accessed',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='upload',
+            name='cold',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+    ]
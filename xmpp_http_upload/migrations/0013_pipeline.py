@@ -0,0 +1,31 @@
+# Generated by Django 3.0.14 on 2026-10-19 16:19
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xmpp_http_upload', '0012_tiering'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('upload_pk', models.BigIntegerField()),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+                ('stage', models.PositiveSmallIntegerField(default=0)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('failed', models.BooleanField(default=False)),
+                ('error', models.TextField(blank=True, default='')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='uploadevent',
+            index=models.Index(fields=['failed', 'run_after'], name='xmpp_http_u_failed_f43568_idx'),
+        ),
+    ]
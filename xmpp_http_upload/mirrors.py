@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-http-upload
+# (https://github.com/mathiasertl/django-xmpp-http-upload).
+#
+# django-xmpp-http-upload is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# django-xmpp-http-upload is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# django-xmpp-http-upload.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Asynchronous copies of uploaded files on secondary storage roots.
+
+After a successful upload, the file is copied to every directory listed in the ``roots`` value of the
+``XMPP_HTTP_UPLOAD_MIRRORS`` setting in the background. The ``mirrors`` field of an upload is a bit mask
+of the roots that have a copy, so never remove or reorder roots, only append new ones. Downloads read
+from a random healthy copy and fail over to the other copies. Uploads stored in pack files (see
+:py:mod:`~xmpp_http_upload.packs`) are not copied.
+"""
+
+import logging
+import os
+import random
+import shutil
+import time
+
+from django.conf import settings
+from django.db.models import F
+
+from .utils import BackgroundExecutor
+
+log = logging.getLogger(__name__)
+
+_MIRRORS_DEFAULTS = {
+    'roots': [],
+    'backend': 'thread',  # or "celery"
+    'retry_after': 60,  # seconds a root is skipped after an error
+}
+
+# copies of the "thread" backend are made one after another
+_executor = BackgroundExecutor()
+
+# roots with errors in this process, and when to use them again
+_unhealthy = {}
+
+
+def get_mirrors_config():
+    config = dict(_MIRRORS_DEFAULTS)
+    config.update(getattr(settings, 'XMPP_HTTP_UPLOAD_MIRRORS', {}))
+    return config
+
+
+def get_roots():
+    return list(get_mirrors_config()['roots'])
+
+
+def is_healthy(root):
+    return _unhealthy.get(root, 0) <= time.monotonic()
+
+
+def mark_unhealthy(root):
+    _unhealthy[root] = time.monotonic() + get_mirrors_config()['retry_after']
+
+
+def get_copies(upload):
+    """Get the root (``None`` for the primary storage) and path of all copies of an upload."""
+    copies = [(None, upload.path)]
+    for index, root in enumerate(get_roots()):
+        if upload.mirrors & (1 << index):
+            copies.append((root, os.path.join(root, upload.file.name)))
+    return copies
+
+
+def open_copy(upload):
+    """Open a random copy of an uploaded file on a healthy root, ``None`` if no copy can be read.
+
+    Copies on unhealthy roots are only tried if all other copies fail.
+    """
+    copies = get_copies(upload)
+    random.shuffle(copies)
+    copies.sort(key=lambda copy: copy[0] is not None and not is_healthy(copy[0]))
+
+    for root, path in copies:
+        try:
+            return open(path, 'rb')
+        except FileNotFoundError:
+            if root is not None:
+                index = get_roots().index(root)
+                type(upload).objects.using(upload._state.db).filter(
+                    pk=upload.pk, mirrors=upload.mirrors).update(mirrors=upload.mirrors & ~(1 << index))
+            schedule(upload)  # restore the missing copy
+        except OSError:
+            log.exception('Cannot read %s.', path)
+            if root is not None:
+                mark_unhealthy(root)
+    return None
+
+
+def copy_file(source, destination):
+    """Copy a file so that ``destination`` never contains a partial copy."""
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    tmp = '%s.tmp' % destination
+    shutil.copyfile(source, tmp)
+    os.replace(tmp, destination)
+
+
+def remove_copies(name):
+    """Remove the copies of the file ``name`` (relative to the storage) and their (then empty) directories."""
+    for root in get_roots():
+        path = os.path.join(root, name)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        except OSError:  # never fail to delete an upload because of a secondary root
+            log.exception('Cannot remove %s.', path)
+            continue
+
+        directory = os.path.dirname(path)
+        if not os.listdir(directory):
+            os.rmdir(directory)
+
+
+def mirror_upload(pk, using=None):
+    """Copy an upload to all (healthy) roots that do not have a copy yet, returns the number of copies.
+
+    If the primary copy is missing, it is restored from a secondary copy.
+    """
+    from .models import Upload
+
+    upload = Upload.objects.using(using).uploaded().filter(pk=pk, offset__isnull=True).first()
+    if upload is None:  # removed in the meantime or stored in a pack file
+        return 0
+
+    copies = [path for root, path in get_copies(upload) if os.path.isfile(path)]
+    if not copies:
+        log.error('%s: No copy of the file exists.', upload.file.name)
+        return 0
+    if copies[0] != upload.path:
+        copy_file(copies[0], upload.path)
+
+    mirrors = 0
+    for index, root in enumerate(get_roots()):
+        if upload.mirrors & (1 << index) or not is_healthy(root):
+            continue
+
+        try:
+            copy_file(upload.path, os.path.join(root, upload.file.name))
+        except OSError:
+            log.exception('Cannot copy %s to %s.', upload.file.name, root)
+            mark_unhealthy(root)
+        else:
+            mirrors |= 1 << index
+
+    if mirrors:
+        Upload.objects.using(using).filter(pk=pk).update(mirrors=F('mirrors').bitor(mirrors))
+    return bin(mirrors).count('1')
+
+
+def mirror_missing(using=None, verify=False, batch_size=100):
+    """Copy all uploads of the shard ``using`` that are missing on one of the roots, e.g. after adding a root.
+
+    If ``verify`` is ``True``, also check if the recorded copies still exist, e.g. after replacing a disk.
+    Returns the number of copies made.
+    """
+    from .models import Upload
+
+    roots = get_roots()
+    complete = (1 << len(roots)) - 1
+    qs = Upload.objects.using(using).uploaded().local().filter(offset__isnull=True)
+    qs = qs.order_by('pk').only('pk', 'file', 'mirrors')
+    if not verify:
+        qs = qs.exclude(mirrors=complete)
+
+    copies = 0
+    last_pk = 0
+    for batch in iter(lambda: list(qs.filter(pk__gt=last_pk)[:batch_size]), []):
+        last_pk = batch[-1].pk
+        for upload in batch:
+            missing = 0
+            for index, root in enumerate(roots):
+                if verify and upload.mirrors & (1 << index) and \
+                        not os.path.exists(os.path.join(root, upload.file.name)):
+                    missing |= 1 << index
+            if missing:
+                Upload.objects.using(using).filter(pk=upload.pk).update(mirrors=F('mirrors').bitand(~missing))
+            if upload.mirrors & ~missing != complete:
+                copies += mirror_upload(upload.pk, using=using)
+    return copies
+
+
+def schedule(upload):
+    """Copy an upload to the secondary roots in the background."""
+    config = get_mirrors_config()
+    if not config['roots']:
+        return
+
+    using = upload._state.db
+    if config['backend'] == 'celery':
+        from .tasks import mirror_http_upload
+
+        mirror_http_upload.delay(upload.pk, using=using)
+    else:
+        _executor.submit(mirror_upload, upload.pk, using)
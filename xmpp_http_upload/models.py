@@ -22,8 +22,19 @@ from urllib.parse import urlsplit
 from django.conf import settings
 from django.db import models
 from django.urls import reverse
-
+from django.utils import timezone
+
+from .cluster import get_node_url
+from .compression import DecompressedFile
+from .metadata import remove as remove_metadata
+from .mirrors import open_copy
+from .mirrors import remove_copies
+from .packs import open_packed
+from .querysets import SlotQuerySet
 from .querysets import UploadQuerySet
+from .tiering import get_cold_root
+from .utils import remove_files
+from .utils import remove_partial_file
 from .utils import ws_download
 
 _upload_base = getattr(settings, 'XMPP_HTTP_UPLOAD_ROOT', 'http_upload')
@@ -37,12 +48,8 @@ def get_upload_path(instance, filename):
     return os.path.join(_upload_base, instance.hash, filename)
 
 
-class Upload(models.Model):
-    objects = UploadQuerySet.as_manager()
-
-    # housekeeping
-    created = models.DateTimeField(auto_now_add=True)
-    updated = models.DateTimeField(auto_now=True)
+class BaseUpload(models.Model):
+    """Fields and methods common to :py:class:`Slot` and :py:class:`Upload`."""
 
     # Populated when a slot is requested
     jid = models.CharField(max_length=256)
@@ -51,9 +58,19 @@ class Upload(models.Model):
     type = models.CharField(max_length=255, null=True, blank=True)
     hash = models.CharField(max_length=64)
 
-    # Populated when the file is uploaded
-    file = models.FileField(upload_to=get_upload_path, null=True, blank=True, max_length=255)
-    uploaded = models.DateTimeField(null=True, blank=True)
+    # SHA-256 hex digest of the file. For a slot, this is the digest passed by the client, if any.
+    sha256 = models.CharField(max_length=64, null=True, blank=True)
+
+    # Node storing the file in cluster mode (see xmpp_http_upload.cluster)
+    node = models.CharField(max_length=64, blank=True, default='')
+
+    class Meta:
+        abstract = True
+
+    def get_partial_path(self):
+        """Path of the file while it is being uploaded (see ``XMPP_HTTP_UPLOAD_PROGRESSIVE_DOWNLOAD``)."""
+        storage = Upload._meta.get_field('file').storage
+        return '%s.part' % storage.path(get_upload_path(self, self.name))
 
     def get_absolute_url(self):
         return reverse('xmpp-http-upload:share',
@@ -62,6 +79,8 @@ class Upload(models.Model):
     def get_urls(self, request):
         location = self.get_absolute_url()
         upload_url = get_upload_url()
+        if self.node:
+            upload_url = get_node_url(self.node).rstrip('/')
         if upload_url is None:
             put_url = request.build_absolute_uri(location)
         else:
@@ -85,3 +104,138 @@ class Upload(models.Model):
             get_url = get_url.replace('http://', 'https://')
 
         return put_url, get_url
+
+
+class Slot(BaseUpload):
+    """A slot that was requested but not yet uploaded.
+
+    Slots are short-lived, so they are kept in their own table. On a successful upload, the slot is
+    replaced by an :py:class:`Upload`.
+    """
+    objects = SlotQuerySet.as_manager()
+
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['jid', 'created']),  # quotas and admin search
+            models.Index(fields=['created']),  # expired slots
+        ]
+
+    def remove_partial_file(self):
+        """Remove the partial file left behind by an aborted upload, if any.
+
+        Returns ``False`` if there is no partial file or if an upload is still writing it.
+        """
+        return remove_partial_file(self.get_partial_path())
+
+
+class Upload(BaseUpload):
+    """An uploaded file."""
+    objects = UploadQuerySet.as_manager()
+
+    # housekeeping - created is the time the slot was requested
+    created = models.DateTimeField(default=timezone.now, editable=False)
+    updated = models.DateTimeField(auto_now=True)
+
+    # Populated when the file is uploaded
+    file = models.FileField(upload_to=get_upload_path, null=True, blank=True, max_length=255)
+    uploaded = models.DateTimeField(null=True, blank=True)
+
+    # Bit mask of the secondary roots with a copy of the file, see xmpp_http_upload.mirrors
+    mirrors = models.PositiveIntegerField(default=0, editable=False)
+
+    # Position of the file in the pack file named by "file", see xmpp_http_upload.packs
+    offset = models.BigIntegerField(null=True, blank=True, editable=False)
+
+    # Encoding of "file" and size of the compressed file, see xmpp_http_upload.compression
+    encoding = models.CharField(max_length=16, blank=True, default='', editable=False)
+    compressed_size = models.PositiveIntegerField(null=True, blank=True, editable=False)
+
+    # Last download (updated in batches) and if the file was moved to cold storage, see
+    # xmpp_http_upload.tiering
+    accessed = models.DateTimeField(null=True, blank=True, editable=False)
+    cold = models.BooleanField(default=False, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['jid', 'created']),  # quotas, admin search and usage per JID
+            models.Index(fields=['created']),  # expired files
+            models.Index(fields=['node']),  # files to rebalance in cluster mode
+            models.Index(fields=['file'], name='xmpp_http_upload_pack_idx',
+                         condition=models.Q(offset__isnull=False)),  # uploads in a pack file
+        ]
+
+    @classmethod
+    def from_slot(cls, slot, **kwargs):
+        """Get an upload for the given slot, ``kwargs`` override fields of the slot."""
+        fields = {f.name: getattr(slot, f.name) for f in BaseUpload._meta.local_fields}
+        fields['created'] = slot.created
+        fields.update(kwargs)
+        return cls(**fields)
+
+    @property
+    def path(self):
+        """Path of the stored file, also if it was moved to cold storage."""
+        root = get_cold_root()
+        if self.cold and root:
+            return os.path.join(root, self.file.name)
+        return self.file.path
+
+    def open_file(self):
+        """Open the uploaded file for reading, ``None`` if no copy can be read.
+
+        The file is decompressed if only a compressed file is stored.
+        """
+        if self.offset is not None:
+            return open_packed(self)
+
+        file = open_copy(self)
+        if file is not None and self.encoding == 'gzip':
+            file = DecompressedFile(file)
+        return file
+
+    def remove_file(self):
+        """Remove the uploaded file (with all copies) and its (then empty) directory.
+
+        The space of files in a pack file is reclaimed later by the compactor.
+        """
+
+        if not self.file or self.offset is not None:
+            return
+
+        remove_copies(self.file.name)
+        remove_metadata(self)
+        remove_files(*self.get_local_paths())
+        self.file = None
+
+    def get_local_paths(self):
+        """Get the paths of the files stored on this node: the file and a compressed file next to it."""
+        if not self.file or self.offset is not None:
+            return []
+
+        paths = [self.path]
+        if self.compressed_size is not None and self.encoding == '':
+            paths.append('%s.gz' % self.path)
+        return paths
+
+
+class UploadEvent(models.Model):
+    """A finished upload that still has to pass the stages of the post-upload pipeline.
+
+    Events are stored on the same database (shard) as the upload, see :py:mod:`xmpp_http_upload.pipeline`.
+    """
+
+    upload_pk = models.BigIntegerField()
+    created = models.DateTimeField(default=timezone.now, editable=False)
+
+    stage = models.PositiveSmallIntegerField(default=0)  # index of the next stage
+    attempts = models.PositiveSmallIntegerField(default=0)  # failed attempts of the next stage
+    run_after = models.DateTimeField(default=timezone.now)  # due time of the next attempt
+    failed = models.BooleanField(default=False)  # no more attempts are made
+    error = models.TextField(blank=True, default='')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['failed', 'run_after']),  # pending events
+        ]
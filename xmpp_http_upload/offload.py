@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-http-upload
+# (https://github.com/mathiasertl/django-xmpp-http-upload).
+#
+# django-xmpp-http-upload is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# django-xmpp-http-upload is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# django-xmpp-http-upload.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Let the web server receive the body of uploads.
+
+If the ``directory`` of the ``XMPP_HTTP_UPLOAD_OFFLOAD`` setting is set, a front web server (e.g. nginx
+with ``client_body_in_file_only``) may write the request body of an upload to a file in that directory
+and only pass the path of the file in the ``header`` to Django. The file is then moved to its final
+location with a rename, so the payload never passes through a Python worker. Unless ``verify`` is
+``False``, the file is still hashed from disk to verify and store its SHA-256 digest.
+
+Clients could send the header themselves to make Django move any file in the directory, e.g. the body of
+another upload. The path is thus only accepted if the web server also sends the ``secret`` in the
+``secret_header``, overwriting any value sent by the client.
+"""
+
+import hashlib
+import hmac
+import os
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+
+_OFFLOAD_DEFAULTS = {
+    'directory': None,  # directory the web server writes request bodies to, None disables offloading
+    'header': 'X-Upload-File',  # request header with the path of the request body
+    'secret': None,  # shared secret the web server sends with the path, required for offloading
+    'secret_header': 'X-Upload-Secret',  # request header with the secret
+    'verify': True,  # hash the file to verify digests, otherwise trust the digests given by the client
+}
+
+_chunk_size = 1024 * 1024
+
+
+def get_offload_config():
+    config = dict(_OFFLOAD_DEFAULTS)
+    config.update(getattr(settings, 'XMPP_HTTP_UPLOAD_OFFLOAD', {}))
+    return config
+
+
+def _get_header(request, name):
+    return request.META.get('HTTP_%s' % name.upper().replace('-', '_'), '')
+
+
+def get_body_path(request):
+    """Get the path of the file with the request body, ``None`` if the body was not offloaded.
+
+    Raises ``ValueError`` if the request does not contain the secret or the path is not within the
+    configured directory.
+    """
+    config = get_offload_config()
+    if not config['directory']:
+        return None
+    path = _get_header(request, config['header'])
+    if not path:
+        return None
+
+    expected = (config['secret'] or '').encode('utf-8')
+    secret = _get_header(request, config['secret_header']).encode('utf-8')
+    if not expected or not hmac.compare_digest(secret, expected):
+        raise ValueError('%s: Not sent by the web server.' % path)
+
+    directory = os.path.realpath(config['directory'])
+    path = os.path.realpath(path)
+    if path == directory or os.path.commonpath([directory, path]) != directory:
+        raise ValueError('%s: Not in %s.' % (path, directory))
+    return path
+
+
+class OffloadedFile(UploadedFile):
+    """A request body written to ``path`` by the web server.
+
+    Like with a :py:class:`~django.core.files.uploadedfile.TemporaryUploadedFile`, the file storage moves
+    the file to its final location, and closing the file removes it if it was not moved.
+    """
+
+    def __init__(self, path, name, content_type):
+        self.path = path
+        file = open(path, 'rb')
+        super().__init__(file, name, content_type, os.fstat(file.fileno()).st_size, None)
+
+    def temporary_file_path(self):
+        return self.path
+
+    def close(self):
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:  # the file was moved to its final location
+            pass
+
+
+def hash_file(file):
+    """Get the SHA-256 hex digest of ``file``, which is rewound afterwards."""
+    sha256 = hashlib.sha256()
+    for chunk in iter(lambda: file.read(_chunk_size), b''):
+        sha256.update(chunk)
+    file.seek(0)
+    return sha256.hexdigest()
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-http-upload
+# (https://github.com/mathiasertl/django-xmpp-http-upload).
+#
+# django-xmpp-http-upload is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# django-xmpp-http-upload is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# django-xmpp-http-upload.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Store small uploads in large, append-only pack files.
+
+Uploads of up to ``max_size`` bytes (see the ``XMPP_HTTP_UPLOAD_PACKS`` setting) are appended to a pack
+file instead of getting a directory and a file of their own. The ``file`` field of such an upload names
+the pack file and the ``offset`` field is the position of the upload within it.
+
+Every process appends to its own pack file, so no locking between processes is needed. A process starts
+a new pack file when the current one reached ``pack_size`` bytes or was not written to for half of
+``seal_after`` seconds, so pack files that were not modified for ``seal_after`` seconds are never written
+to again. Removing a packed upload only deletes its row; the :py:class:`Compactor` reclaims the space of
+such pack files later.
+"""
+
+import logging
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+from .shards import for_each_shard
+from .utils import Throttle
+from .utils import remove_later
+from .utils import ws_download
+
+log = logging.getLogger(__name__)
+
+_PACKS_DEFAULTS = {
+    'max_size': 0,  # uploads up to this many bytes are packed, 0 disables pack files
+    'pack_size': 64 * 1024 * 1024,  # bytes before a new pack file is started
+    'seal_after': 3600,  # seconds after the last write before a pack file may be compacted
+    'min_garbage': 0.5,  # fraction of unused bytes before a pack file is compacted
+    'bytes_per_second': None,  # bandwidth used by the compactor
+}
+
+_chunk_size = 64 * 1024
+_upload_base = getattr(settings, 'XMPP_HTTP_UPLOAD_ROOT', 'http_upload')
+
+
+def get_packs_config():
+    config = dict(_PACKS_DEFAULTS)
+    config.update(getattr(settings, 'XMPP_HTTP_UPLOAD_PACKS', {}))
+    return config
+
+
+def should_pack(size):
+    """Return ``True`` if an upload of ``size`` bytes should be stored in a pack file.
+
+    Pack files are not used if the webserver serves uploaded files, as it cannot serve part of a file.
+    """
+    max_size = get_packs_config()['max_size']
+    return bool(max_size) and size <= max_size and ws_download() is False
+
+
+def get_storage():
+    from .models import Upload
+
+    return Upload._meta.get_field('file').storage
+
+
+def get_directory():
+    """Name of the directory containing all pack files, relative to the storage."""
+    return os.path.join(_upload_base, 'packs')
+
+
+class PackedFile:
+    """A read-only file object for an upload stored in a pack file.
+
+    The file descriptor is positioned at the start of the upload, so WSGI servers that use ``sendfile()``
+    for ``wsgi.file_wrapper`` (e.g. gunicorn) send the upload directly from the pack file, limited by the
+    ``Content-Length`` header. Otherwise the upload is read with ``os.pread()``.
+    """
+
+    def __init__(self, path, offset, size):
+        self.fd = os.open(path, os.O_RDONLY)
+        os.lseek(self.fd, offset, os.SEEK_SET)
+        self.offset = offset
+        self.size = size
+        self.position = 0
+
+    def fileno(self):
+        return self.fd
+
+    def read(self, size=-1):
+        remaining = self.size - self.position
+        if size < 0 or size > remaining:
+            size = remaining
+        data = os.pread(self.fd, size, self.offset + self.position)
+        self.position += len(data)
+        return data
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_packed(upload):
+    """Open a packed upload, ``None`` if the pack file cannot be read."""
+    try:
+        return PackedFile(upload.file.path, upload.offset, upload.size)
+    except OSError:
+        log.exception('Cannot read %s.', upload.file.name)
+        return None
+
+
+class PackWriter:
+    """Append files to the pack file of this process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stream = None
+
+    def get_stream(self, config):
+        stream = self.stream
+        if stream is not None and self.pid == os.getpid() and stream.tell() < config['pack_size'] and \
+                time.monotonic() - self.last_write < config['seal_after'] / 2:
+            return stream
+
+        if stream is not None and self.pid == os.getpid():  # do not close the file of the parent process
+            stream.close()
+
+        self.name = os.path.join(get_directory(), '%s.pack' % uuid.uuid4().hex)
+        path = get_storage().path(self.name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.stream = open(path, 'ab')
+        self.pid = os.getpid()
+        return self.stream
+
+    def append(self, file):
+        """Append the contents of ``file``, returns the name of the pack file and the offset."""
+        config = get_packs_config()
+        with self.lock:
+            stream = self.get_stream(config)
+            offset = stream.tell()
+            for chunk in iter(lambda: file.read(_chunk_size), b''):
+                stream.write(chunk)
+            stream.flush()
+            self.last_write = time.monotonic()
+            return self.name, offset
+
+
+_writer = PackWriter()
+
+
+def append(file):
+    """Append ``file`` to the pack file of this process, returns the name of the pack file and the offset."""
+    return _writer.append(file)
+
+
+class Compactor:
+    """Reclaim the space of removed uploads in pack files.
+
+    Pack files without any uploads are removed. If at least ``min_garbage`` of a pack file is unused, the
+    remaining uploads are appended to a new pack file and the old file is removed after
+    ``XMPP_HTTP_UPLOAD_REMOVE_DELAY`` seconds (or by the next compaction). All parameters default to the
+    respective value in the ``XMPP_HTTP_UPLOAD_PACKS`` setting.
+    """
+
+    def __init__(self, min_garbage=None, bytes_per_second=None):
+        config = get_packs_config()
+        self.seal_after = config['seal_after']
+        self.min_garbage = config['min_garbage'] if min_garbage is None else min_garbage
+        self.throttle = Throttle(config['bytes_per_second'] if bytes_per_second is None else bytes_per_second)
+
+    def get_packs(self):
+        """Get the name and size of all pack files that are not written to anymore."""
+        directory = get_directory()
+        path = get_storage().path(directory)
+        if not os.path.exists(path):
+            return []
+
+        sealed = time.time() - self.seal_after
+        with os.scandir(path) as entries:
+            return sorted((os.path.join(directory, entry.name), entry.stat().st_size) for entry in entries
+                          if entry.name.endswith('.pack') and entry.stat().st_mtime < sealed)
+
+    def get_uploads(self, alias, name):
+        from .models import Upload
+
+        return [(alias, upload) for upload in Upload.objects.using(alias).filter(
+            file=name, offset__isnull=False).only('pk', 'file', 'offset', 'size').order_by('offset')]
+
+    def move(self, alias, upload):
+        """Append a packed upload to the pack file of this process, returns ``False`` if it was removed."""
+        from .models import Upload
+
+        with PackedFile(upload.file.path, upload.offset, upload.size) as stream:
+            name, offset = append(stream)
+        self.throttle(upload.size)
+        return bool(Upload.objects.using(alias).filter(
+            pk=upload.pk, file=upload.file.name, offset=upload.offset).update(file=name, offset=offset))
+
+    def compact(self):
+        """Compact all pack files, returns the number of removed pack files and moved uploads."""
+        stats = {'removed': 0, 'moved': 0}
+        for name, size in self.get_packs():
+            uploads = [u for rows in for_each_shard(self.get_uploads, name) for u in rows]
+            used = sum(upload.size for alias, upload in uploads)
+            if uploads and size - used < self.min_garbage * size:
+                continue
+
+            if uploads:
+                for alias, upload in uploads:
+                    stats['moved'] += self.move(alias, upload)
+                remove_later(get_storage().path(name))  # downloads may still be about to read moved uploads
+            else:  # uploads were removed (or moved by a previous compaction) a while ago
+                get_storage().delete(name)
+            stats['removed'] += 1
+        return stats
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-http-upload
+# (https://github.com/mathiasertl/django-xmpp-http-upload).
+#
+# django-xmpp-http-upload is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# django-xmpp-http-upload is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# django-xmpp-http-upload.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Run custom stages after an upload finished, outside of the request.
+
+The ``stages`` of the ``XMPP_HTTP_UPLOAD_PIPELINE`` setting are import paths of callables that are called
+with the :py:class:`~xmpp_http_upload.models.Upload` one after another, e.g. to send notifications or to
+scan files. A PUT request stores an :py:class:`~xmpp_http_upload.models.UploadEvent` in the same
+transaction as the upload, and the stages run in the background (in a thread pool of ``max_workers``
+threads or as Celery tasks, see ``backend``) once the transaction is committed.
+
+Stages of an upload always run in order. If a stage raises an exception, it is retried after
+``retry_delay`` seconds (doubled for every further attempt) and the event is marked as failed after
+``max_attempts`` attempts. Events whose background job was lost (e.g. because the process was restarted)
+are run by :py:func:`run_pending`, see the ``process_http_upload_events`` management command. Since the
+event stores the index of the next stage, only ever append new stages.
+"""
+
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .utils import BackgroundExecutor
+
+log = logging.getLogger(__name__)
+
+_PIPELINE_DEFAULTS = {
+    'stages': [],  # import paths of callables called with the upload, in order
+    'backend': 'thread',  # or "celery"
+    'max_workers': 2,  # uploads processed at the same time by the "thread" backend
+    'max_attempts': 5,
+    'retry_delay': 60,  # seconds before the first retry, doubled for every further attempt
+    'timeout': 3600,  # seconds before an event that is being processed may be processed again
+}
+
+
+def get_pipeline_config():
+    config = dict(_PIPELINE_DEFAULTS)
+    config.update(getattr(settings, 'XMPP_HTTP_UPLOAD_PIPELINE', {}))
+    return config
+
+
+_executor = BackgroundExecutor(max_workers=get_pipeline_config()['max_workers'])
+
+
+def create_event(upload, using=None):
+    """Store an event for ``upload``, ``None`` if there are no stages."""
+    from .models import UploadEvent
+
+    if not get_pipeline_config()['stages']:
+        return None
+    return UploadEvent.objects.using(using).create(upload_pk=upload.pk)
+
+
+def claim(pk, using=None, timeout=3600):
+    """Get the event if it is due and not processed by another worker, ``None`` otherwise.
+
+    The event is not due again for ``timeout`` seconds, so a crashed worker only delays the event.
+    """
+    from .models import UploadEvent
+
+    now = timezone.now()
+    qs = UploadEvent.objects.using(using).filter(pk=pk, failed=False, run_after__lte=now)
+    if not qs.update(run_after=now + timedelta(seconds=timeout)):
+        return None
+    return UploadEvent.objects.using(using).get(pk=pk)
+
+
+def process(pk, using=None):
+    """Run the remaining stages of an event, returns ``True`` if the upload passed all stages.
+
+    If a stage fails, the retry is scheduled and ``False`` is returned. Returns ``None`` if the event is
+    not due, processed by another worker or its upload was removed.
+    """
+    from .models import Upload
+
+    config = get_pipeline_config()
+    event = claim(pk, using, config['timeout'])
+    if event is None:
+        return None
+
+    upload = Upload.objects.using(using).filter(pk=event.upload_pk).first()
+    if upload is None:  # removed in the meantime
+        event.delete()
+        return None
+
+    for index, path in enumerate(config['stages'][event.stage:], event.stage):
+        try:
+            import_string(path)(upload)
+        except Exception as e:
+            log.exception('%s: Stage %s failed.', upload.file.name, path)
+            event.attempts += 1
+            event.error = '%s: %s' % (path, e)
+            delay = config['retry_delay'] * 2 ** (event.attempts - 1)
+            event.run_after = timezone.now() + timedelta(seconds=delay)
+            event.failed = event.attempts >= config['max_attempts']
+            event.save(update_fields=['attempts', 'error', 'run_after', 'failed'])
+            if not event.failed:
+                schedule(event.pk, using, countdown=delay)
+            return False
+
+        # a retry starts with the next stage
+        event.stage = index + 1
+        event.attempts = 0
+        event.save(update_fields=['stage', 'attempts'])
+
+    event.delete()
+    return True
+
+
+def run_pending(using=None, batch_size=100):
+    """Process all due events of the shard ``using``, returns the number of processed and failed events."""
+    from .models import UploadEvent
+
+    stats = {'processed': 0, 'failed': 0}
+    qs = UploadEvent.objects.using(using).filter(failed=False, run_after__lte=timezone.now()).order_by('pk')
+    last_pk = 0
+    for batch in iter(lambda: list(qs.filter(pk__gt=last_pk).values_list('pk', flat=True)[:batch_size]), []):
+        last_pk = batch[-1]
+        for pk in batch:
+            result = process(pk, using)
+            if result is True:
+                stats['processed'] += 1
+            elif result is False:
+                stats['failed'] += 1
+    return stats
+
+
+def schedule(pk, using=None, countdown=0):
+    """Process the event with the primary key ``pk`` in the background after ``countdown`` seconds."""
+    if get_pipeline_config()['backend'] == 'celery':
+        from .tasks import process_http_upload_event
+
+        process_http_upload_event.apply_async((pk, ), {'using': using}, countdown=countdown)
+    elif countdown:
+        timer = threading.Timer(countdown, _executor.submit, (process, pk, using))
+        timer.daemon = True  # the event is processed by run_pending() after a restart
+        timer.start()
+    else:
+        _executor.submit(process, pk, using)
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-http-upload
+# (https://github.com/mathiasertl/django-xmpp-http-upload).
+#
+# django-xmpp-http-upload is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# django-xmpp-http-upload is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# django-xmpp-http-upload.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Per-request profiling, see :py:class:`~xmpp_http_upload.middleware.ProfilingMiddleware`.
+
+Views mark the phases of a request with :py:func:`phase`, which does nothing unless the request is
+profiled.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+_local = threading.local()
+
+_PROFILING_DEFAULTS = {
+    'sample_rate': 0,
+    'cprofile': False,
+    'cprofile_dir': None,
+    'slowest': 10,
+    'query_budgets': {},
+}
+
+
+def get_profiling_config():
+    config = dict(_PROFILING_DEFAULTS)
+    config.update(getattr(settings, 'XMPP_HTTP_UPLOAD_PROFILING', {}))
+    return config
+
+
+class Profile:
+    """Timings and database queries of a single request."""
+
+    def __init__(self, view, sampled):
+        self.view = view
+        self.sampled = sampled
+        self.start = time.perf_counter()
+        self.duration = None
+        self.current = None
+        self.phases = {}
+        self.queries = []  # tuples of phase and duration
+        self.profiler = None
+
+    def execute(self, execute, sql, params, many, context):
+        """Database execute wrapper recording the duration of every query."""
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((self.current, time.perf_counter() - start))
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.start
+
+    @property
+    def query_duration(self):
+        return sum(d for p, d in self.queries)
+
+    def server_timing(self):
+        """Value for the ``Server-Timing`` HTTP header."""
+        metrics = ['%s;dur=%.3f' % (name, duration * 1000) for name, duration in self.phases.items()]
+        metrics.append('db;dur=%.3f;desc="%s queries"' % (self.query_duration * 1000, len(self.queries)))
+        metrics.append('total;dur=%.3f' % (self.duration * 1000))
+        return ', '.join(metrics)
+
+
+def get_profile():
+    return getattr(_local, 'profile', None)
+
+
+def set_profile(profile):
+    _local.profile = profile
+
+
+@contextmanager
+def phase(name):
+    """Record the time spent in the ``with`` block as phase ``name`` of the current request."""
+
+    profile = get_profile()
+    if profile is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    previous, profile.current = profile.current, name
+    try:
+        yield
+    finally:
+        profile.current = previous
+        profile.phases[name] = profile.phases.get(name, 0) + time.perf_counter() - start
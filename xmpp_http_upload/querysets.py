@@ -16,48 +16,77 @@
 
 from __future__ import unicode_literals
 
-import os
 from datetime import timedelta
 
 from django.conf import settings
 from django.db import models
 from django.utils import timezone
 
+from . import metrics
+from .cluster import get_node
+
 _put_timeout = timedelta(seconds=int(getattr(settings, 'XMPP_HTTP_UPLOAD_PUT_TIMEOUT', 360)))
 _share_timeout = timedelta(seconds=int(
     getattr(settings, 'XMPP_HTTP_UPLOAD_SHARE_TIMEOUT', 86400 * 30)))
 
 
-class UploadQuerySet(models.QuerySet):
+class NodeQuerySet(models.QuerySet):
+    def local(self):
+        """Rows of this node (all rows, unless cluster mode is enabled)."""
+        node = get_node()
+        if node is None:
+            return self
+        return self.filter(node=node)
+
+
+class SlotQuerySet(NodeQuerySet):
     def for_upload(self):
         expired = timezone.now() - _put_timeout
-        return self.filter(file='', created__gt=expired)
+        return self.filter(created__gt=expired)
 
     def expired(self):
         expired = timezone.now() - _put_timeout
-        return self.filter(file='', created__lt=expired)
+        return self.filter(created__lt=expired)
+
+    def expire(self):
+        """Let slots expire now, so the node storing their partial files removes them."""
+        return self.update(created=timezone.now() - _put_timeout)
+
 
+class UploadQuerySet(NodeQuerySet):
     def uploaded(self):
         return self.exclude(file='')
 
+    def expired_files(self, timeout=None):
+        """Uploads older then ``timeout`` seconds (default: XMPP_HTTP_UPLOAD_SHARE_TIMEOUT)."""
+        if timeout is None:
+            timeout = _share_timeout
+        else:
+            timeout = timedelta(seconds=timeout)
+
+        return self.filter(created__lt=timezone.now() - timeout)
+
+    def expire(self):
+        """Let uploads expire now, so the node storing their files removes them."""
+        return self.update(created=timezone.now() - _share_timeout)
+
     def cleanup(self, slots=True, files=True, timeout=None):
-        # Just remove expired keys
+        from .models import Slot
+
+        # Remove expired slots and the partial files of aborted uploads. In cluster mode, every node
+        # removes its own slots, as partial files are stored by the node receiving the upload.
         if slots is True:
-            self.expired().delete()
+            with metrics.CLEANUP_DURATION.labels(kind='slots').time():
+                queryset = Slot.objects.using(self.db).local().expired()
+                for slot in queryset.only('hash', 'name'):
+                    slot.remove_partial_file()
+                deleted = queryset.delete()[0]
+            metrics.CLEANUP_REMOVED.labels(kind='slots').inc(deleted)
 
         if files is True:
-            if timeout is None:
-                timeout = _share_timeout
-            else:
-                timeout = timedelta(seconds=timeout)
-
-            expired = timezone.now() - timeout
-            queryset = self.filter(created__lt=expired)
-            for instance in queryset:
-                path = os.path.dirname(instance.file.path)
-                instance.file.delete(save=False)  # files are deleted anyway ;-)
-
-                # remove any remaining empty directories
-                if os.path.exists(path) and not os.listdir(path):
-                    os.rmdir(path)
-            queryset.delete()
+            with metrics.CLEANUP_DURATION.labels(kind='files').time():
+                queryset = self.local().expired_files(timeout=timeout)
+                for instance in queryset:
+                    instance.remove_file()
+                deleted = queryset.delete()[0]
+            metrics.CLEANUP_REMOVED.labels(kind='files').inc(deleted)
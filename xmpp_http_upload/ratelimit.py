@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-http-upload
+# (https://github.com/mathiasertl/django-xmpp-http-upload).
+#
+# django-xmpp-http-upload is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# django-xmpp-http-upload is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# django-xmpp-http-upload.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Rate limits for the ``bytes_per_timedelta`` and ``uploads_per_timedelta`` quotas.
+
+By default, usage is counted in the cache configured by ``XMPP_HTTP_UPLOAD_CACHE``, so a slot request does
+not have to aggregate all recent uploads of a user. The window is approximated by two fixed windows: the
+count of the previous window is weighted by the fraction of it that still overlaps the sliding window.
+Counters missing from the cache (e.g. after a restart) are initialized from the database, and if the cache
+fails, the database is used instead.
+"""
+
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Min
+
+from .utils import cache_key
+from .utils import get_cache
+from .utils import try_cache
+
+log = logging.getLogger(__name__)
+_failed = object()  # result of a failed cache access
+
+
+def use_cache():
+    return getattr(settings, 'XMPP_HTTP_UPLOAD_RATE_LIMITER', 'cache') == 'cache'
+
+
+class RateLimit:
+    """Limit the ``aggregate`` of ``querysets`` (e.g. ``Sum('size')``) to ``limit`` per ``delta``.
+
+    ``querysets`` are the slots and uploads of ``jid``, ``name`` identifies the limit in the cache.
+    """
+
+    def __init__(self, name, jid, querysets, delta, limit, aggregate):
+        self.name = name
+        self.prefix = cache_key(name, jid)
+        self.querysets = querysets
+        self.delta = delta
+        self.seconds = delta.total_seconds()
+        self.limit = limit
+        self.aggregate = aggregate
+        self.reserved = None  # cache key and amount of a successful hit
+
+    def get_key(self, window):
+        return '%s:%s' % (self.prefix, window)
+
+    def get_usage(self, start, end=None):
+        total = 0
+        for qs in self.querysets:
+            qs = qs.filter(created__gte=start)
+            if end is not None:
+                qs = qs.filter(created__lt=end)
+            total += qs.aggregate(total=self.aggregate)['total'] or 0
+        return total
+
+    def hit(self, amount, now):
+        """Add ``amount`` to the usage, returns the seconds until retrying makes sense if over the limit."""
+        if use_cache():
+            retry_after = try_cache(lambda: self.hit_cache(amount, now), _failed, log,
+                                    'Cannot use cache for rate limits, falling back to the database.')
+            if retry_after is not _failed:
+                return retry_after
+        return self.hit_database(amount, now)
+
+    def hit_database(self, amount, now):
+        total = 0
+        oldest = []
+        for qs in self.querysets:
+            usage = qs.filter(created__gt=now - self.delta).aggregate(
+                total=self.aggregate, oldest=Min('created'))
+            total += usage['total'] or 0
+            if usage['oldest'] is not None:
+                oldest.append(usage['oldest'])
+
+        if total + amount <= self.limit:
+            return None
+        if not oldest:  # amount alone is over the limit
+            return self.seconds
+        return (min(oldest) + self.delta - now).total_seconds()
+
+    def hit_cache(self, amount, now):
+        cache = get_cache()
+        timestamp = now.timestamp()
+        window = int(timestamp // self.seconds)
+        elapsed = timestamp - window * self.seconds
+        start = now - timedelta(seconds=elapsed)  # start of the current window
+
+        previous_key = self.get_key(window - 1)
+        key = self.get_key(window)
+        values = cache.get_many([previous_key, key])
+
+        if previous_key not in values:
+            values[previous_key] = self.get_usage(start - self.delta, start)
+            cache.add(previous_key, values[previous_key], self.seconds * 2)
+        if key not in values:
+            cache.add(key, self.get_usage(start), self.seconds * 2)
+
+        previous = values[previous_key]
+        current = cache.incr(key, amount)
+        weight = 1 - elapsed / self.seconds
+        if previous * weight + current <= self.limit:
+            self.reserved = (key, amount)
+            return None
+
+        cache.decr(key, amount)
+        return self.get_retry_after(previous, current - amount, amount, elapsed)
+
+    def get_retry_after(self, previous, current, amount, elapsed):
+        """Get the seconds until ``amount`` would be within the limit."""
+
+        available = self.limit - current - amount
+        if available >= 0:  # we have to wait until enough of the previous window has slid out
+            return self.seconds - elapsed - available * self.seconds / previous
+
+        # we have to wait for the next window, the current window is then the previous one
+        remaining = self.seconds - elapsed
+        available = self.limit - amount
+        if available < 0:  # amount alone is over the limit
+            return self.seconds
+        return remaining + self.seconds - available * self.seconds / current
+
+    def undo(self):
+        """Undo a successful :py:meth:`hit`."""
+        if self.reserved is not None:
+            key, amount = self.reserved
+            try_cache(lambda: get_cache().decr(key, amount), None, log,
+                      'Cannot undo a rate limit hit in the cache.')
+            self.reserved = None
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-http-upload
+# (https://github.com/mathiasertl/django-xmpp-http-upload).
+#
+# django-xmpp-http-upload is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# django-xmpp-http-upload is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# django-xmpp-http-upload.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Incremental removal of expired slots and files.
+
+Unlike :py:meth:`~xmpp_http_upload.querysets.UploadQuerySet.cleanup`, the reaper removes rows and files
+in small batches and limits the rate of database rows and file system operations. Rows are split into
+partitions of ``partition_size`` primary keys (partition ``N`` contains the primary keys from
+``N * partition_size`` up to, but not including, ``(N + 1) * partition_size``), and every partition is
+protected by a lease in the cache configured by ``XMPP_HTTP_UPLOAD_CACHE``, so multiple nodes can run the
+reaper at the same time. If rows are sharded across multiple databases, all shards are reaped in parallel
+under the same budget.
+"""
+
+import os
+import socket
+import time
+
+from django.conf import settings
+from django.db.models import Max
+from django.db.models import Min
+
+from . import metrics
+from .cluster import get_node
+from .models import Slot
+from .models import Upload
+from .shards import for_each_shard
+from .utils import Throttle
+from .utils import get_cache
+
+_REAPER_DEFAULTS = {
+    'batch_size': 100,
+    'rows_per_second': 500,
+    'iops': 100,
+    'partition_size': 10000,  # primary keys per partition
+    'interval': 60,
+    'lease_timeout': 300,
+}
+
+
+def get_reaper_config():
+    config = dict(_REAPER_DEFAULTS)
+    config.update(getattr(settings, 'XMPP_HTTP_UPLOAD_REAPER', {}))
+    return config
+
+
+class Lease:
+    """A lease on a partition, held in the cache configured by ``XMPP_HTTP_UPLOAD_CACHE``.
+
+    The lease is acquired atomically with ``cache.add()``. As the cache has no atomic compare-and-set, it
+    is never extended: the holder stops working on the partition when the lease expires.
+    """
+
+    def __init__(self, partition, owner, timeout):
+        self.key = 'xmpp-http-upload:reaper:%s' % partition
+        self.owner = owner
+        self.timeout = timeout
+        self.expires = None
+
+    def acquire(self):
+        """Acquire the lease, returns ``False`` if another node holds it."""
+        if not get_cache().add(self.key, self.owner, self.timeout):
+            return False
+        self.expires = time.monotonic() + self.timeout
+        return True
+
+    def held(self):
+        """Return ``True`` if the lease was acquired and did not expire yet."""
+        return self.expires is not None and time.monotonic() < self.expires
+
+    def release(self):
+        if self.held():  # otherwise another node may hold it by now
+            get_cache().delete(self.key)
+        self.expires = None
+
+
+class Reaper:
+    """Remove expired slots and files in batches under a rows-per-second and IOPS budget.
+
+    All parameters default to the respective value in the ``XMPP_HTTP_UPLOAD_REAPER`` setting.
+    """
+
+    def __init__(self, batch_size=None, rows_per_second=None, iops=None, partition_size=None,
+                 interval=None, lease_timeout=None, timeout=None):
+        config = get_reaper_config()
+        self.batch_size = batch_size or config['batch_size']
+        self.partition_size = partition_size or config['partition_size']
+        self.interval = config['interval'] if interval is None else interval
+        self.lease_timeout = lease_timeout or config['lease_timeout']
+        self.timeout = timeout  # passed to UploadQuerySet.expired_files()
+
+        if rows_per_second is None:
+            rows_per_second = config['rows_per_second']
+        if iops is None:
+            iops = config['iops']
+        self.rows = Throttle(rows_per_second)  # shared by the threads reaping the shards
+        self.io = Throttle(iops)
+
+        self.owner = '%s:%s' % (socket.gethostname(), os.getpid())
+
+    def get_partitions(self, using=None):
+        """Get the partitions containing slots or uploads.
+
+        Partitions do not depend on the rows, so all nodes reap the same rows in a partition.
+        """
+        bounds = [model.objects.using(using).aggregate(first=Min('pk'), last=Max('pk'))
+                  for model in (Slot, Upload)]
+        bounds = [b for b in bounds if b['first'] is not None]
+        if not bounds:
+            return range(0)
+
+        first = min(b['first'] for b in bounds)
+        last = max(b['last'] for b in bounds)
+        return range(first // self.partition_size, last // self.partition_size + 1)
+
+    def get_queryset(self, model, partition, using=None):
+        """Get the rows of ``partition``, a range of primary keys that is selected using the index."""
+        start = partition * self.partition_size
+        return model.objects.using(using).filter(pk__gte=start, pk__lt=start + self.partition_size)
+
+    def reap_partition(self, partition, lease, using=None):
+        """Reap a single partition, returns the number of removed slots and files."""
+        slots = files = 0
+
+        qs = self.get_queryset(Slot, partition, using)
+        while lease.held():
+            batch = list(qs.local().expired().only('hash', 'name')[:self.batch_size])
+            if not batch:
+                break
+
+            with metrics.CLEANUP_DURATION.labels(kind='slots').time():
+                for slot in batch:
+                    if slot.remove_partial_file():  # left behind by an aborted upload
+                        self.io(2)
+
+                self.rows(len(batch))
+                Slot.objects.using(using).filter(pk__in=[s.pk for s in batch]).delete()
+            metrics.CLEANUP_REMOVED.labels(kind='slots').inc(len(batch))
+            slots += len(batch)
+
+        qs = self.get_queryset(Upload, partition, using)
+        while lease.held():
+            batch = list(qs.local().expired_files(timeout=self.timeout)[:self.batch_size])
+            if not batch:
+                break
+
+            with metrics.CLEANUP_DURATION.labels(kind='files').time():
+                for upload in batch:
+                    self.io(2)  # unlink the file and remove its directory
+                    upload.remove_file()
+
+                self.rows(len(batch))
+                Upload.objects.using(using).filter(pk__in=[u.pk for u in batch]).delete()
+            metrics.CLEANUP_REMOVED.labels(kind='files').inc(len(batch))
+            files += len(batch)
+
+        return slots, files
+
+    def reap_shard(self, using):
+        """Do one pass over all partitions of a shard not leased by another node."""
+        stats = {'slots': 0, 'files': 0, 'skipped': []}
+
+        for partition in self.get_partitions(using):
+            # in cluster mode, every node removes the files it stores
+            prefix = [p for p in (get_node(), using) if p is not None]
+            name = ':'.join(prefix + [str(partition)]) if prefix else partition
+            lease = Lease(name, self.owner, self.lease_timeout)
+            if not lease.acquire():
+                stats['skipped'].append(name)
+                continue
+
+            try:
+                slots, files = self.reap_partition(partition, lease, using)
+            finally:
+                lease.release()
+
+            stats['slots'] += slots
+            stats['files'] += files
+        return stats
+
+    def reap(self):
+        """Do one pass over all partitions (of all shards) not leased by another node."""
+        stats = {'slots': 0, 'files': 0, 'skipped': []}
+        for shard_stats in for_each_shard(self.reap_shard):
+            stats['slots'] += shard_stats['slots']
+            stats['files'] += shard_stats['files']
+            stats['skipped'] += shard_stats['skipped']
+        return stats
+
+    def run(self, passes=None, callback=None):
+        """Reap continuously, sleeping ``interval`` seconds between passes."""
+        done = 0
+        while True:
+            stats = self.reap()
+            if callback is not None:
+                callback(stats)
+
+            done += 1
+            if passes is not None and done >= passes:
+                return
+            time.sleep(self.interval)
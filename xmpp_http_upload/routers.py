@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-http-upload
+# (https://github.com/mathiasertl/django-xmpp-http-upload).
+#
+# django-xmpp-http-upload is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# django-xmpp-http-upload is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# django-xmpp-http-upload.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Send read-only queries of the slot and download views to read replicas.
+
+Add :py:class:`ReplicaRouter` to the ``DATABASE_ROUTERS`` setting and list the replica aliases in the
+``XMPP_HTTP_UPLOAD_REPLICAS`` setting. Reads only go to a replica inside :py:func:`replica_reads`, all other
+queries (and all writes) go to the primary database.
+
+After a JID requested a slot or uploaded a file, its quota checks are pinned to the primary for
+``max_lag`` seconds, so a lagging replica does not under-count its usage. Lookups that miss on a replica
+(e.g. a download right after the upload) are repeated on the primary by the views.
+"""
+
+import logging
+import random
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from .utils import cache_key
+from .utils import get_cache
+from .utils import try_cache
+
+log = logging.getLogger(__name__)
+
+_REPLICA_DEFAULTS = {
+    'primary': 'default',
+    'aliases': [],
+    'max_lag': 10,  # seconds
+}
+
+_state = threading.local()  # if reads go to a replica, per thread
+
+
+def get_replica_config():
+    config = dict(_REPLICA_DEFAULTS)
+    config.update(getattr(settings, 'XMPP_HTTP_UPLOAD_REPLICAS', {}))
+    return config
+
+
+@contextmanager
+def replica_reads(enabled=True):
+    """Send reads of this app to a replica while the context is active (and ``enabled`` is ``True``)."""
+    previous = getattr(_state, 'replica_reads', False)
+    _state.replica_reads = enabled
+    try:
+        yield
+    finally:
+        _state.replica_reads = previous
+
+
+def pin(jid):
+    """Pin reads for ``jid`` to the primary for ``max_lag`` seconds after a write."""
+    config = get_replica_config()
+    if not config['aliases']:
+        return
+
+    try_cache(lambda: get_cache().set(cache_key('primary', jid), True, config['max_lag']), None, log,
+              'Cannot pin %s to the primary database.' % jid)
+
+
+def is_pinned(jid):
+    """Return ``True`` if reads for ``jid`` should go to the primary."""
+    if not get_replica_config()['aliases']:
+        return False
+
+    # use the primary if in doubt
+    return try_cache(lambda: bool(get_cache().get(cache_key('primary', jid))), True, log,
+                     'Cannot check if %s is pinned to the primary database.' % jid)
+
+
+class ReplicaRouter:
+    """Database router for the models of this app, see the module documentation."""
+
+    app_label = 'xmpp_http_upload'
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != self.app_label:
+            return None
+
+        config = get_replica_config()
+        if getattr(_state, 'replica_reads', False) and config['aliases']:
+            return random.choice(config['aliases'])
+        return config['primary']
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label != self.app_label:
+            return None
+
+        # Return the primary even for instances read from a replica
+        return get_replica_config()['primary']
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in get_replica_config()['aliases']:
+            return False  # replicas receive the schema from the primary
+        return None
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-http-upload
+# (https://github.com/mathiasertl/django-xmpp-http-upload).
+#
+# django-xmpp-http-upload is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# django-xmpp-http-upload is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# django-xmpp-http-upload.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Verify the digests of stored files, used by the ``scrub_http_uploads`` management command."""
+
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from .compression import DecompressedFile
+from .models import Upload
+from .packs import PackedFile
+from .utils import Throttle
+
+_chunk_size = 1024 * 1024
+
+
+def hash_file(path, bytes_per_second=None, offset=None, size=None, encoding=''):
+    """Hash a file (or ``size`` bytes at ``offset`` of a pack file), returns a tuple of a status (``"ok"``,
+    ``"missing"`` or ``"error"``) and the hex digest (or error message).
+
+    Compressed files (``encoding="gzip"``) are hashed after decompressing them.
+    """
+
+    throttle = Throttle(bytes_per_second)
+    sha256 = hashlib.sha256()
+    try:
+        stream = open(path, 'rb') if offset is None else PackedFile(path, offset, size)
+        if encoding == 'gzip':
+            stream = DecompressedFile(stream)
+        with stream:
+            for chunk in iter(lambda: stream.read(_chunk_size), b''):
+                sha256.update(chunk)
+                throttle(len(chunk))
+    except FileNotFoundError:
+        return 'missing', None
+    except (OSError, EOFError) as e:  # EOFError if a compressed file is truncated
+        return 'error', str(e)
+    return 'ok', sha256.hexdigest()
+
+
+class Checkpoint:
+    """Progress of a scrub, stored as JSON in ``path``, so a scrub can be continued later."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.data = {'last_pk': 0}
+        if path is not None and os.path.exists(path):
+            with open(path) as stream:
+                self.data = json.load(stream)
+
+    @property
+    def last_pk(self):
+        return self.data['last_pk']
+
+    def save(self, last_pk):
+        self.data['last_pk'] = last_pk
+        if self.path is not None:
+            tmp = '%s.tmp' % self.path
+            with open(tmp, 'w') as stream:
+                json.dump(self.data, stream)
+            os.replace(tmp, self.path)  # never leave a half-written checkpoint
+
+
+class Scrubber:
+    """Re-hash uploaded files in batches of ``batch_size`` using ``processes`` processes.
+
+    Files are compared to the digest stored in the database, rows without a digest get the computed
+    digest. The total IO of all processes is limited to ``bytes_per_second``. If ``max_duration`` is
+    given, no new batch is started after that many seconds. ``using`` is the database alias of the shard
+    to scrub.
+    """
+
+    def __init__(self, processes=1, bytes_per_second=None, batch_size=100, checkpoint=None,
+                 max_duration=None, using=None):
+        self.processes = processes
+        self.bytes_per_second = bytes_per_second
+        self.batch_size = batch_size
+        self.checkpoint = checkpoint or Checkpoint()
+        self.max_duration = max_duration
+        self.using = using
+
+    def get_batch(self):
+        qs = Upload.objects.using(self.using).uploaded().local()
+        qs = qs.filter(pk__gt=self.checkpoint.last_pk).order_by('pk')
+        return list(qs.only('pk', 'file', 'cold', 'sha256', 'offset', 'size', 'encoding')[:self.batch_size])
+
+    def hash_files(self, executor, uploads):
+        rate = None
+        if self.bytes_per_second:
+            rate = self.bytes_per_second / self.processes
+        paths = [upload.path for upload in uploads]
+        offsets = [upload.offset for upload in uploads]
+        sizes = [upload.size for upload in uploads]
+        encodings = [upload.encoding for upload in uploads]
+
+        if executor is None:
+            return list(map(hash_file, paths, [rate] * len(paths), offsets, sizes, encodings))
+        return list(executor.map(hash_file, paths, [rate] * len(paths), offsets, sizes, encodings))
+
+    def scrub_batch(self, executor, uploads, callback):
+        stats = {'ok': 0, 'updated': 0, 'missing': 0, 'corrupt': 0, 'error': 0}
+        for upload, (status, value) in zip(uploads, self.hash_files(executor, uploads)):
+            report = {'id': upload.pk, 'file': upload.file.name, 'status': status}
+            if status == 'ok' and upload.sha256 is None:
+                Upload.objects.using(self.using).filter(pk=upload.pk).update(sha256=value)
+                status = 'updated'
+            elif status == 'ok' and upload.sha256 != value:
+                status = report['status'] = 'corrupt'
+                report.update({'expected': upload.sha256, 'actual': value})
+            elif status == 'error':
+                report['error'] = value
+
+            stats[status] += 1
+            if status not in ('ok', 'updated') and callback is not None:
+                callback(report)
+        return stats
+
+    def scrub(self, callback=None):
+        """Scrub files, starting at the checkpoint.
+
+        ``callback`` is called with a dictionary describing every missing, corrupt or unreadable file. The
+        return value are the number of files per status and if the scrub is complete.
+        """
+        start = time.monotonic()
+        stats = {'ok': 0, 'updated': 0, 'missing': 0, 'corrupt': 0, 'error': 0, 'complete': False}
+
+        executor = None
+        if self.processes > 1:
+            executor = ProcessPoolExecutor(max_workers=self.processes)
+
+        try:
+            while self.max_duration is None or time.monotonic() - start < self.max_duration:
+                uploads = self.get_batch()
+                if not uploads:
+                    stats['complete'] = True
+                    self.checkpoint.save(0)  # the next scrub starts from the beginning
+                    break
+
+                for key, value in self.scrub_batch(executor, uploads, callback).items():
+                    stats[key] += value
+                self.checkpoint.save(uploads[-1].pk)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        return stats
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-http-upload
+# (https://github.com/mathiasertl/django-xmpp-http-upload).
+#
+# django-xmpp-http-upload is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# django-xmpp-http-upload is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# django-xmpp-http-upload.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Optional sharding of slots and uploads across multiple databases.
+
+Shards are the database aliases listed in the ``XMPP_HTTP_UPLOAD_SHARDS`` setting. New slots are placed on a
+shard by the domain of the JID or by the hash in the URL (spreading the rows of every JID evenly). Either
+way, the first character of the hash encodes the index of the shard, so downloads and uploads are routed
+without a lookup. Never remove or reorder shards, only append new ones (at most 62, the number of
+characters a hash may start with).
+
+Appending a shard (or placing a domain on a shard with the ``domains`` value) moves some domains to
+another shard, but existing rows stay where they are. Quotas of a JID are therefore checked on every shard
+the domain was ever placed on, i.e. its shard for every prefix of the list of shards.
+
+If sharding is disabled, the only "shard" is ``None``, so ``Model.objects.using(alias)`` uses the database
+routers as before.
+"""
+
+import string
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.crypto import get_random_string
+
+from .utils import BackgroundExecutor
+from .utils import ring_lookup
+
+_SHARDS_DEFAULTS = {
+    'aliases': [],
+    'by': 'domain',  # or "hash"
+    'domains': {},  # domains placed on a specific shard
+    'max_workers': None,  # threads used to query all shards, default is one per shard
+}
+
+# The first character of a hash is the index of its shard
+_ALPHABET = string.digits + string.ascii_letters
+_HASH_LENGTH = 32
+
+
+def get_shards_config():
+    config = dict(_SHARDS_DEFAULTS)
+    config.update(getattr(settings, 'XMPP_HTTP_UPLOAD_SHARDS', {}))
+    return config
+
+
+def get_aliases():
+    """Get the database aliases of all shards, ``[None]`` if sharding is disabled."""
+    aliases = list(get_shards_config()['aliases']) or [None]
+    if len(aliases) > len(_ALPHABET):
+        raise ImproperlyConfigured('XMPP_HTTP_UPLOAD_SHARDS: At most %s shards are supported.'
+                                   % len(_ALPHABET))
+    return aliases
+
+
+def new_hash(jid):
+    """Get the shard and the hash for a new slot of ``jid``."""
+    config = get_shards_config()
+    aliases = get_aliases()
+    if aliases == [None]:
+        return None, get_random_string(_HASH_LENGTH)
+
+    hash = get_random_string(_HASH_LENGTH - 1)
+    if config['by'] == 'hash':
+        alias = ring_lookup(aliases, hash)
+    else:
+        domain = jid.rpartition('@')[2]
+        alias = config['domains'].get(domain) or ring_lookup(aliases, domain)
+    return alias, _ALPHABET[aliases.index(alias)] + hash
+
+
+def shards_for_hash(hash):
+    """Get the shards that may contain the rows for ``hash``, the shard encoded in the hash first.
+
+    The first shard is also included for hashes created before sharding was enabled.
+    """
+    aliases = get_aliases()
+    index = _ALPHABET.find(hash[:1])
+    if aliases == [None] or index <= 0 or index >= len(aliases):
+        return aliases[:1]
+    return [aliases[index], aliases[0]]
+
+
+def shards_for_jid(jid):
+    """Get the shards that may contain rows of ``jid``, the shard of new slots first.
+
+    Rows created before shards were appended are on the shard of the domain at that time.
+    """
+    config = get_shards_config()
+    aliases = get_aliases()
+    if aliases == [None] or config['by'] == 'hash':
+        return aliases
+
+    domain = jid.rpartition('@')[2]
+    shards = [config['domains'].get(domain) or ring_lookup(aliases, domain)]
+    for i in range(1, len(aliases) + 1):
+        alias = ring_lookup(aliases[:i], domain)
+        if alias not in shards:
+            shards.append(alias)
+    return shards
+
+
+def for_each_shard(func, *args, **kwargs):
+    """Call ``func(alias, *args, **kwargs)`` for every shard in parallel.
+
+    Returns the results in the order of the shards.
+    """
+    aliases = get_aliases()
+    max_workers = get_shards_config()['max_workers'] or len(aliases)
+    if len(aliases) == 1 or max_workers == 1:
+        return [func(alias, *args, **kwargs) for alias in aliases]
+
+    executor = BackgroundExecutor(max_workers=max_workers)
+    with executor.executor:  # shuts down the threads when done
+        futures = [executor.submit(func, alias, *args, **kwargs) for alias in aliases]
+        return [future.result() for future in futures]
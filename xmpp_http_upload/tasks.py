@@ -16,9 +16,89 @@
 
 from celery import shared_task
 
+from .cluster import Rebalancer
+from .compression import compress_upload
+from .jobs import delete_uploads
+from .mirrors import mirror_upload
 from .models import Upload
+from .packs import Compactor
+from .pipeline import process
+from .pipeline import run_pending
+from .reaper import Reaper
+from .shards import for_each_shard
+from .tiering import Tierer
 
 
 @shared_task
 def cleanup_http_uploads(slots=True, files=True, timeout=None):
-    Upload.objects.cleanup(slots=slots, files=files, timeout=timeout)
+    for_each_shard(lambda alias: Upload.objects.using(alias).cleanup(
+        slots=slots, files=files, timeout=timeout))
+
+
+@shared_task(bind=True)
+def reap_http_uploads(self, reschedule=True):
+    """Do a single pass of the :py:class:`~xmpp_http_upload.reaper.Reaper`.
+
+    If ``reschedule`` is ``True``, the task schedules itself again after the configured interval.
+    """
+    reaper = Reaper()
+    reaper.reap()
+
+    if reschedule is True:
+        self.apply_async(kwargs={'reschedule': True}, countdown=reaper.interval)
+
+
+@shared_task(bind=True)
+def rebalance_http_uploads(self, reschedule=True):
+    """Do a single pass of the :py:class:`~xmpp_http_upload.cluster.Rebalancer` of this node.
+
+    If ``reschedule`` is ``True``, the task schedules itself again after the configured interval. Note that
+    the task must run on every node, e.g. using a queue per node.
+    """
+    rebalancer = Rebalancer()
+    rebalancer.rebalance()
+
+    if reschedule is True:
+        self.apply_async(kwargs={'reschedule': True}, countdown=rebalancer.interval)
+
+
+@shared_task
+def delete_http_uploads(job_id, pks=None, jids=None, using=None):
+    """Delete uploads in the background, see :py:func:`~xmpp_http_upload.jobs.delete_uploads`."""
+    delete_uploads(job_id, pks=pks, jids=jids, using=using)
+
+
+@shared_task
+def mirror_http_upload(pk, using=None):
+    """Copy an upload to the secondary roots, see :py:func:`~xmpp_http_upload.mirrors.mirror_upload`."""
+    mirror_upload(pk, using=using)
+
+
+@shared_task
+def compact_http_uploads():
+    """Compact pack files, see :py:class:`~xmpp_http_upload.packs.Compactor`."""
+    Compactor().compact()
+
+
+@shared_task
+def compress_http_upload(pk, using=None):
+    """Compress an upload, see :py:func:`~xmpp_http_upload.compression.compress_upload`."""
+    compress_upload(pk, using=using)
+
+
+@shared_task
+def tier_http_uploads():
+    """Move uploads to cold storage, see :py:class:`~xmpp_http_upload.tiering.Tierer`."""
+    for_each_shard(lambda alias: Tierer(using=alias).run())
+
+
+@shared_task
+def process_http_upload_event(pk, using=None):
+    """Run the post-upload pipeline for an upload, see :py:func:`~xmpp_http_upload.pipeline.process`."""
+    process(pk, using=using)
+
+
+@shared_task
+def process_http_upload_events():
+    """Process all due events, see :py:func:`~xmpp_http_upload.pipeline.run_pending`."""
+    for_each_shard(run_pending)
@@ -13,28 +13,122 @@
 # You should have received a copy of the GNU General Public License along with django-xmpp-http-upload. If
 # not, see <http://www.gnu.org/licenses/>.
 
+import base64
+import errno
+import gzip
+import hashlib
+import importlib
+import json
 import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from datetime import datetime
 from datetime import timedelta
 from http import HTTPStatus
+from io import BytesIO
+from io import StringIO
+from unittest import mock
+from unittest import skipUnless
+from urllib.error import URLError
 from urllib.parse import urlsplit
+from wsgiref.util import FileWrapper
 
 from freezegun import freeze_time
 
+from django.apps import apps
 from django.conf import settings
+from django.contrib import admin
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
 from django.core.files.base import ContentFile
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management import CommandError
 from django.core.management import call_command
+from django.core.servers.basehttp import WSGIServer
+from django.db import connections
+from django.db.models import Sum
+from django.http import Http404
+from django.http import HttpResponse
 from django.test import Client
+from django.test import LiveServerTestCase
 from django.test import RequestFactory
 from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test import modify_settings
 from django.test import override_settings
+from django.test.testcases import LiveServerThread
+from django.test.testcases import QuietWSGIRequestHandler
+from django.urls import resolve
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.crypto import get_random_string
 
+from . import compression
+from . import jobs
+from . import metadata
+from . import metrics
+from . import mirrors
+from . import packs
+from . import pipeline
+from . import tiering
+from .admin import EstimatedCountPaginator
+from .admin import UploadAdmin
+from .admin import estimate_count
+from .admission import Admission
+from .cluster import Rebalancer
+from .cluster import enabled as cluster_enabled
+from .cluster import get_node
+from .cluster import get_owner
+from .cluster import get_token
+from .cluster import load_token
+from .fastpath import FastPathHandler
+from .fastpath import get_fast_path_application
+from .metrics import StorageCollector
+from .middleware import ProfilingMiddleware
+from .mirrors import copy_file
+from .models import Slot
 from .models import Upload
+from .models import UploadEvent
+from .packs import Compactor
+from .packs import PackedFile
+from .packs import PackWriter
+from .profiling import phase
+from .ratelimit import RateLimit
+from .reaper import Lease
+from .reaper import Reaper
+from .routers import ReplicaRouter
+from .routers import is_pinned
+from .routers import pin
+from .routers import replica_reads
+from .shards import for_each_shard
+from .shards import get_aliases
+from .shards import new_hash
+from .shards import shards_for_hash
+from .shards import shards_for_jid
 from .tasks import cleanup_http_uploads
+from .tasks import compact_http_uploads
+from .tasks import compress_http_upload
+from .tasks import delete_http_uploads
+from .tasks import mirror_http_upload
+from .tasks import process_http_upload_event
+from .tasks import process_http_upload_events
+from .tasks import reap_http_uploads
+from .tasks import rebalance_http_uploads
+from .tasks import tier_http_uploads
+from .tiering import AccessBuffer
+from .tiering import Tierer
+from .utils import SharedThrottle
+from .utils import Throttle
+from .utils import lock_file
+from .utils import parse_size
+from .utils import remove_files
+from .utils import ring_lookup
 from .utils import ws_download
+from .views import UploadView
 
 user_jid = 'example@example.net'
 
@@ -111,10 +205,41 @@ class UploadModelTestCase(TestCase):
             self.assertEqual(get_url, self.upload.file.url.replace('http://', 'https://'))
 
 
+class SlotTestCase(TestCase):
+    def test_from_slot(self):
+        with freeze_time('2020-01-01 00:00:00'):
+            slot = Slot.objects.create(jid=user_jid, name='example.txt', size=10, type='text/plain',
+                                       hash=get_random_string(32), sha256='0' * 64)
+
+        upload = Upload.from_slot(slot, sha256='1' * 64)
+        self.assertEqual((upload.jid, upload.name, upload.size, upload.type, upload.hash),
+                         (slot.jid, slot.name, slot.size, slot.type, slot.hash))
+        self.assertEqual(upload.created, slot.created)  # quotas count from the time the slot was requested
+        self.assertEqual(upload.sha256, '1' * 64)
+        self.assertEqual(upload.get_absolute_url(), slot.get_absolute_url())
+
+    def test_migration(self):
+        migration = importlib.import_module('xmpp_http_upload.migrations.0006_slot')
+        created = timezone.now() - timedelta(hours=1)
+        upload = Upload.objects.create(jid=user_jid, name='example.txt', size=10, hash='a', created=created)
+        Upload.objects.create(jid=user_jid, name='example.jpg', size=10, hash='b', file='example.jpg')
+
+        migration.move_slots(apps, None)
+        self.assertEqual(list(Upload.objects.values_list('hash', flat=True)), ['b'])
+        slot = Slot.objects.get()
+        self.assertEqual((slot.name, slot.hash, slot.created), (upload.name, upload.hash, created))
+
+        migration.move_uploads(apps, None)
+        self.assertFalse(Slot.objects.exists())
+        upload = Upload.objects.get(hash='a')
+        self.assertEqual((upload.name, upload.created), ('example.txt', created))
+        self.assertFalse(upload.file)
+
+
 class AdminChangelistViewTestCase(TestCase):
     def setUp(self):
         self.user = User.objects.create_superuser(username='u', password='p', email='user@example.com')
-        self.changelist_url = reverse('admin:xmpp_http_upload_upload_changelist')
+        self.changelist_url = reverse('admin:xmpp_http_upload_slot_changelist')
         self.client = Client()
         self.client.force_login(self.user)
 
@@ -126,10 +251,10 @@ class AdminChangelistViewTestCase(TestCase):
         self.type = 'text/plain'
         self.hash = get_random_string(32)
 
-        self.u1 = Upload.objects.create(
+        self.u1 = Slot.objects.create(
             jid=self.jid, name=self.name1, size=self.size, type=self.type, hash=self.hash
         )
-        self.u2 = Upload.objects.create(
+        self.u2 = Slot.objects.create(
             jid=self.jid, name=self.name2, size=self.size, type=self.type, hash=self.hash
         )
 
@@ -141,44 +266,270 @@ class AdminChangelistViewTestCase(TestCase):
         response = self.client.get(self.changelist_url)
         self.assertResponse(response, self.u1, self.u2)
 
-    def test_not_uploaded(self):
-        response = self.client.get(self.changelist_url, {'uploaded': '0'})
-        self.assertResponse(response, self.u1, self.u2)
-
-        # upload u1 and test we only get u2
-        self.u1.file.save(self.name1, ContentFile(self.content))
-        response = self.client.get(self.changelist_url, {'uploaded': '0'})
-        self.assertResponse(response, self.u2)
+    def test_uploads(self):
+        upload = Upload.from_slot(self.u1)
+        upload.file.save(self.name1, ContentFile(self.content))
 
-    def test_uploaded(self):
-        response = self.client.get(self.changelist_url, {'uploaded': '1'})
-        self.assertResponse(response)
-
-        # upload u1 and test we get u1
-        self.u1.file.save(self.name1, ContentFile(self.content))
-        response = self.client.get(self.changelist_url, {'uploaded': '1'})
-        self.assertResponse(response, self.u1)
+        response = self.client.get(reverse('admin:xmpp_http_upload_upload_changelist'))
+        self.assertResponse(response, upload)
 
     def test_expired(self):
         with freeze_time(timezone.now()) as frozen:
-            response = self.client.get(self.changelist_url, {'uploaded': '2'})
+            response = self.client.get(self.changelist_url, {'expired': '1'})
             self.assertResponse(response)
+            response = self.client.get(self.changelist_url, {'expired': '0'})
+            self.assertResponse(response, self.u1, self.u2)
 
             frozen.tick(delta=timedelta(seconds=361))  # XMPP_HTTP_UPLOAD_PUT_TIMEOUT + 1
-            response = self.client.get(self.changelist_url, {'uploaded': '2'})
+            response = self.client.get(self.changelist_url, {'expired': '1'})
             self.assertResponse(response, self.u1, self.u2)  # they're all expired
+            response = self.client.get(self.changelist_url, {'expired': '0'})
+            self.assertResponse(response)
+
+
+class ScalableAdminTestCase(TestCase):
+    def setUp(self):
+        cache.clear()  # the usage summary is cached
+        self.user = User.objects.create_superuser(username='u', password='p', email='user@example.com')
+        self.changelist_url = reverse('admin:xmpp_http_upload_upload_changelist')
+        self.usage_url = reverse('admin:xmpp_http_upload_upload_usage')
+        self.client = Client()
+        self.client.force_login(self.user)
+
+        self.uploads = [
+            Upload.objects.create(jid=jid, name='example.txt', size=size, hash=get_random_string(32))
+            for jid, size in [('user@example.com', 10), ('user@example.net', 20), ('other@example.com', 30),
+                              ('user@example.com', 40)]
+        ]
+
+    def assertResults(self, response, *uploads):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context['cl'].result_list), list(uploads))
+
+    def mock_estimate(self, vendor, row):
+        connection = connections['default']
+        cursor = mock.MagicMock()
+        cursor.__enter__.return_value.fetchone.return_value = row
+        return mock.patch.multiple(connection, vendor=vendor, cursor=mock.Mock(return_value=cursor))
+
+    def test_changelist(self):
+        response = self.client.get(self.changelist_url)
+        self.assertResults(response, *reversed(self.uploads))
+        self.assertEqual(response.context['cl'].result_count, 4)
+        self.assertContains(response, self.usage_url)
+        self.assertContains(response, '40\xa0bytes')
+
+    def test_search(self):
+        response = self.client.get(self.changelist_url, {'q': 'user@example.com'})
+        self.assertResults(response, self.uploads[3], self.uploads[0])
+
+        response = self.client.get(self.changelist_url, {'q': ' user@example.'})  # only exact JIDs
+        self.assertResults(response)
+
+        response = self.client.get(self.changelist_url, {'q': 'user'})  # prefix
+        self.assertResults(response, self.uploads[3], self.uploads[1], self.uploads[0])
+
+        response = self.client.get(self.changelist_url, {'q': ' '})
+        self.assertResults(response, *reversed(self.uploads))
+
+    @mock.patch('xmpp_http_upload.admin.UploadAdmin.list_per_page', 3)
+    def test_keyset_pagination(self):
+        response = self.client.get(self.changelist_url, {'q': 'user'})
+        self.assertResults(response, self.uploads[3], self.uploads[1], self.uploads[0])
+        self.assertNotContains(response, 'before=')
+
+        response = self.client.get(self.changelist_url)
+        self.assertResults(response, self.uploads[3], self.uploads[2], self.uploads[1])
+        next_url = '?before=%s' % self.uploads[1].pk
+        self.assertContains(response, 'href="%s"' % next_url)
+
+        response = self.client.get(self.changelist_url + next_url)
+        self.assertResults(response, self.uploads[0])
+        self.assertContains(response, 'href="?"')  # link to the newest uploads
+        self.assertNotContains(response, 'class="next"')
+
+        response = self.client.get(self.changelist_url, {'before': 'foo'})
+        self.assertRedirects(response, '%s?e=1' % self.changelist_url)
+
+    def test_estimated_count(self):
+        qs = Upload.objects.all()
+        with self.mock_estimate('postgresql', (12345.0, )):
+            self.assertEqual(estimate_count(qs), 12345)
+            self.assertIsNone(estimate_count(qs.filter(jid='user@example.com')))
+            self.assertEqual(EstimatedCountPaginator(qs, 10).count, 12345)
+
+        with self.mock_estimate('postgresql', (-1.0, )):  # table was never analyzed
+            self.assertIsNone(estimate_count(qs))
+        with self.mock_estimate('mysql', (10, )):
+            self.assertEqual(estimate_count(qs), 10)
+        with mock.patch('xmpp_http_upload.admin.estimate_count', return_value=10):
+            self.assertEqual(EstimatedCountPaginator(qs, 10).count, 4)  # small tables are counted
+        with self.mock_estimate('mysql', None):
+            self.assertIsNone(estimate_count(qs))
+        with self.mock_estimate('mysql', (None, )):
+            self.assertIsNone(estimate_count(qs))
+
+        self.assertIsNone(estimate_count(qs))  # SQLite has no estimate
+        self.assertEqual(EstimatedCountPaginator(qs.filter(jid='user@example.com'), 10).count, 2)
+
+    def test_usage(self):
+        response = self.client.get(self.usage_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(u['jid'], u['uploads'], u['bytes']) for u in response.context['usage']], [
+            ('user@example.com', 2, 50),
+            ('other@example.com', 1, 30),
+            ('user@example.net', 1, 20),
+        ])
+        self.assertEqual(response.context['usage'][0]['last'], self.uploads[3].created)
+
+        response = self.client.get(self.usage_url, {'jid': 'user@example.net'})
+        self.assertEqual([(u['jid'], u['uploads'], u['bytes']) for u in response.context['usage']], [
+            ('user@example.net', 1, 20),
+        ])
+
+        # the summary of all JIDs is cached, searches are not
+        Upload.objects.create(jid='user@example.net', name='example.txt', size=50, hash=get_random_string(32))
+        response = self.client.get(self.usage_url)
+        self.assertContains(response, 'Updated every 300 seconds.')
+        self.assertEqual(response.context['usage'][0]['jid'], 'user@example.com')
+        response = self.client.get(self.usage_url, {'jid': 'user@example.net'})
+        self.assertEqual([(u['jid'], u['uploads'], u['bytes']) for u in response.context['usage']], [
+            ('user@example.net', 2, 70),
+        ])
+        self.assertNotContains(response, 'Updated every')
+
+        with mock.patch('xmpp_http_upload.admin.get_cache', side_effect=Exception('down')), \
+                self.assertLogs('xmpp_http_upload.admin', 'ERROR') as logs:
+            response = self.client.get(self.usage_url)
+        self.assertEqual(len(logs.output), 2)
+        self.assertEqual(response.context['usage'][0]['jid'], 'user@example.net')
+
+    def test_usage_permission_denied(self):
+        user = User.objects.create_user(username='staff', password='p', is_staff=True)
+        self.client.force_login(user)
+        self.assertEqual(self.client.get(self.usage_url).status_code, 403)
+
+
+def run_now(func, *args, **kwargs):
+    """Replaces ``submit()`` of the executor used for background jobs."""
+    func(*args, **kwargs)
+
+
+@mock.patch('xmpp_http_upload.utils.connections')
+@mock.patch('xmpp_http_upload.jobs._executor.executor.submit', side_effect=run_now)
+class AdminJobsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_superuser(username='u', password='p', email='user@example.com')
+        self.changelist_url = reverse('admin:xmpp_http_upload_upload_changelist')
+        self.client = Client()
+        self.client.force_login(self.user)
+
+        self.uploads = []
+        for i, jid in enumerate(['user@example.com', 'user@example.com', 'other@example.com']):
+            upload = Upload.objects.create(jid=jid, name='example%s.txt' % i, size=4,
+                                           hash=get_random_string(32))
+            upload.file.save(upload.name, ContentFile(b'test'))
+            self.uploads.append(upload)
+        self.slot = Slot.objects.create(jid='user@example.com', name='example.txt', size=4, hash='a')
+
+    def tearDown(self):
+        for upload in Upload.objects.all():
+            upload.remove_file()
+
+    def action(self, action, *uploads):
+        return self.client.post(self.changelist_url, {
+            'action': action,
+            '_selected_action': [u.pk for u in uploads],
+        }, follow=True)
+
+    def get_job(self, response):
+        message = list(response.context['messages'])[0].message
+        job_id = message.split('/jobs/')[1].split('/')[0]
+        return jobs.Job(job_id).get()
+
+    def test_delete_with_files(self, submit, connections):
+        response = self.action('delete_with_files', self.uploads[0], self.uploads[2])
+        self.assertContains(response, 'Deleting 2 uploads in the background')
+        self.assertEqual(list(Upload.objects.all()), [self.uploads[1]])
+        self.assertTrue(Slot.objects.exists())
+        for upload in (self.uploads[0], self.uploads[2]):
+            self.assertFalse(os.path.exists(os.path.dirname(upload.file.path)))
+
+        job = self.get_job(response)
+        self.assertEqual((job['status'], job['done'], job['total']), ('done', 2, 2))
+        connections.close_all.assert_called_once_with()
+
+        # view the progress
+        response = self.client.get(reverse('admin:xmpp_http_upload_upload_job', kwargs={'job_id': job['id']}))
+        self.assertContains(response, 'Status: done, 2 of 2 uploads deleted.')
+        self.assertNotContains(response, 'http-equiv="refresh"')
+
+    @override_settings(XMPP_HTTP_UPLOAD_JOBS={'batch_size': 1})
+    def test_delete_jids(self, submit, connections):
+        response = self.action('delete_jids', self.uploads[0])
+        self.assertContains(response, 'Deleting all uploads of user@example.com in the background')
+        self.assertEqual(list(Upload.objects.all()), [self.uploads[2]])
+        self.assertFalse(Slot.objects.exists())
+        job = self.get_job(response)
+        self.assertEqual((job['status'], job['done'], job['total']), ('done', 2, 2))
+
+    def test_failure(self, submit, connections):
+        with mock.patch.object(Upload, 'remove_file', side_effect=OSError('Permission denied')), \
+                self.assertLogs('xmpp_http_upload.jobs', level='ERROR'), self.assertRaises(OSError):
+            self.action('delete_with_files', self.uploads[0])
+        connections.close_all.assert_called_once_with()
+        self.assertEqual(Upload.objects.count(), 3)
+
+    def test_progress(self, submit, connections):
+        job = jobs.Job.create('Deleting 3 uploads', 3)
+        url = reverse('admin:xmpp_http_upload_upload_job', kwargs={'job_id': job.id})
+        response = self.client.get(url)
+        self.assertContains(response, 'Status: queued, 0 of 3 uploads deleted.')
+        self.assertContains(response, 'http-equiv="refresh"')
+
+        job.update(status='failed', error='Permission denied')
+        self.assertContains(self.client.get(url), 'Permission denied')
+
+        url = reverse('admin:xmpp_http_upload_upload_job', kwargs={'job_id': 'unknown'})
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+        user = User.objects.create_user(username='staff', password='p', is_staff=True)
+        self.client.force_login(user)
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+    def test_no_default_delete(self, submit, connections):
+        response = self.client.get(self.changelist_url)
+        self.assertNotContains(response, 'delete_selected')
+        self.assertContains(response, 'delete_with_files')
+
+    @override_settings(XMPP_HTTP_UPLOAD_JOBS={'backend': 'celery'})
+    @mock.patch('xmpp_http_upload.tasks.delete_http_uploads.delay')
+    def test_celery(self, delay, submit, connections):
+        response = self.action('delete_jids', self.uploads[2])
+        job = self.get_job(response)
+        delay.assert_called_once_with(job['id'], pks=None, jids=['other@example.com'], using=None)
+        submit.assert_not_called()
+        self.assertEqual(job['status'], 'queued')
+
+        delete_http_uploads(job['id'], jids=['other@example.com'])
+        self.assertEqual(jobs.Job(job['id']).get()['status'], 'done')
+        self.assertEqual(Upload.objects.count(), 2)
 
 
 class RequestSlotTestCase(TestCase):
+    def setUp(self):
+        cache.clear()  # rate limits are counted in the cache
+
     def assertSlot(self, jid='admin@example.com', filename='example.jpg', size=10,
                    expected_filename=None,
                    **kwargs):
         expected_filename = expected_filename or filename
         response = slot(jid=jid, name=filename, size=size, **kwargs)
         self.assertEquals(response.status_code, 200)
-        self.assertEquals(Upload.objects.count(), 1)
+        self.assertEquals(Slot.objects.count(), 1)
 
-        upload = Upload.objects.first()
+        upload = Slot.objects.first()
         self.assertEqual(upload.jid, jid)
         self.assertEqual(upload.name, expected_filename)
         self.assertEqual(upload.size, size)
@@ -190,7 +541,7 @@ class RequestSlotTestCase(TestCase):
         response = slot(jid=jid, name='example.jpg', size=10)
         self.assertEquals(response.status_code, status_code)
         self.assertEquals(response.content, message)
-        self.assertEquals(Upload.objects.count(), 0)
+        self.assertEquals(Slot.objects.count(), 0)
 
     def test_slot(self):
         self.assertSlot()
@@ -204,14 +555,14 @@ class RequestSlotTestCase(TestCase):
     def test_max_file_size(self):
         response = slot(jid=user_jid, name='example.jpg', size=1024 * 1024)
         self.assertEquals(response.status_code, 413)
-        self.assertEquals(Upload.objects.count(), 0)
+        self.assertEquals(Slot.objects.count(), 0)
 
         size = 300 * 1024
         response = slot(jid=user_jid, name='example.jpg', size=size)
         self.assertEquals(response.status_code, 200)
-        self.assertEquals(Upload.objects.count(), 1)
+        self.assertEquals(Slot.objects.count(), 1)
 
-        upload = Upload.objects.first()
+        upload = Slot.objects.first()
         self.assertEqual(upload.jid, user_jid)
         self.assertEqual(upload.name, 'example.jpg')
         self.assertEqual(upload.size, size)
@@ -220,48 +571,54 @@ class RequestSlotTestCase(TestCase):
 
     def test_max_total_size(self):
         # first, create some uploads manually so we're almost at the limit
-        for i in range(1, 11):
-            Upload.objects.create(jid=user_jid, name='example%s.jpg' % i, size=300 * 1024)
-
-        # created is auto_now, and we cannot override it, but we can update it
-        Upload.objects.update(created=timezone.now() - timedelta(hours=2))
+        for i in range(1, 10):
+            Upload.objects.create(jid=user_jid, name='example%s.jpg' % i, size=300 * 1024,
+                                  created=timezone.now() - timedelta(hours=2))
+
+        # pending slots count as well, expired slots do not
+        expired = Slot.objects.create(jid=user_jid, name='example.jpg', size=300 * 1024)
+        Slot.objects.update(created=timezone.now() - timedelta(hours=2))
+        response = slot(jid=user_jid, name='example10.jpg', size=300 * 1024)
+        self.assertEquals(response.status_code, 200)
+        expired.delete()
 
         # now we would be over quota
-        response = slot(jid=user_jid, name='example%s.jpg' % i, size=300 * 1024)
+        response = slot(jid=user_jid, name='example11.jpg', size=300 * 1024)
         self.assertEquals(response.status_code, 403)
-        self.assertEquals(Upload.objects.count(), 10)
+        self.assertEquals(Upload.objects.count(), 9)
+        self.assertEquals(Slot.objects.count(), 1)
 
     def test_bytes_per_timedelta(self):
         # First, upload two files totalling 800 KB
         for i in range(1, 3):
             response = slot(jid=user_jid, name='example%s.jpg' % i, size=400 * 1024)
             self.assertEquals(response.status_code, 200)
-            self.assertEquals(Upload.objects.count(), i)
-        self.assertEquals(Upload.objects.count(), i)
+            self.assertEquals(Slot.objects.count(), i)
+        self.assertEquals(Slot.objects.count(), i)
 
         # next slot would exceed bytes_per_timedelta, but not uploads_per_timedelta
         response = slot(jid=user_jid, name='example%s.jpg' % (i + 1), size=400 * 1024)
         self.assertEquals(response.status_code, 402)
-        self.assertEquals(Upload.objects.count(), i)
+        self.assertEquals(Slot.objects.count(), i)
 
     def test_uploads_per_timedelta(self):
         # first, create some uploads manually so we're almost at the limit
         for i in range(1, 4):
             response = slot(jid=user_jid, name='example%s.jpg' % i, size=10 * 1024)
             self.assertEquals(response.status_code, 200)
-            self.assertEquals(Upload.objects.count(), i)
-        self.assertEquals(Upload.objects.count(), i)
+            self.assertEquals(Slot.objects.count(), i)
+        self.assertEquals(Slot.objects.count(), i)
 
         response = slot(jid=user_jid, name='example%s.jpg' % (i + 1), size=10 * 1024)
         self.assertEquals(response.status_code, 402)
-        self.assertEquals(Upload.objects.count(), i)
+        self.assertEquals(Slot.objects.count(), i)
 
     def test_mime_type(self):
         response = slot(jid='admin@example.com', name='example.jpg', size=10, type='foo/bar')
         self.assertEquals(response.status_code, 200)
-        self.assertEquals(Upload.objects.count(), 1)
+        self.assertEquals(Slot.objects.count(), 1)
 
-        upload = Upload.objects.first()
+        upload = Slot.objects.first()
         self.assertEqual(upload.jid, 'admin@example.com')
         self.assertEqual(upload.name, 'example.jpg')
         self.assertEqual(upload.size, 10)
@@ -270,7 +627,7 @@ class RequestSlotTestCase(TestCase):
 
     def test_json(self):
         response = slot(jid='admin@example.com', name='example.jpg', size=10, output='application/json')
-        upload = Upload.objects.first()
+        upload = Slot.objects.first()
         put_url, get_url = upload.get_urls(response.wsgi_request)
 
         self.assertEquals(response.json(), {
@@ -278,7 +635,7 @@ class RequestSlotTestCase(TestCase):
             'put': put_url,
         })
         self.assertEquals(response.status_code, 200)
-        self.assertEquals(Upload.objects.count(), 1)
+        self.assertEquals(Slot.objects.count(), 1)
 
         self.assertEqual(upload.jid, 'admin@example.com')
         self.assertEqual(upload.name, 'example.jpg')
@@ -302,38 +659,38 @@ class RequestSlotTestCase(TestCase):
         # jid missing
         response = slot(name='example.jpg', size=10)
         self.assertEquals(response.status_code, 400)
-        self.assertEquals(Upload.objects.count(), 0)
+        self.assertEquals(Slot.objects.count(), 0)
 
         # name missing
         response = slot(jid='admin@example.com', size=10)
         self.assertEquals(response.status_code, 400)
-        self.assertEquals(Upload.objects.count(), 0)
+        self.assertEquals(Slot.objects.count(), 0)
 
         # size missing
         response = slot(jid='admin@example.com', name='example.jpg')
         self.assertEquals(response.status_code, 400)
-        self.assertEquals(Upload.objects.count(), 0)
+        self.assertEquals(Slot.objects.count(), 0)
 
         # malformed size
         response = slot(jid='admin@example.com', name='example.jpg', size='foo')
         self.assertEquals(response.status_code, 400)
-        self.assertEquals(Upload.objects.count(), 0)
+        self.assertEquals(Slot.objects.count(), 0)
 
         # negative size
         response = slot(jid='admin@example.com', name='example.jpg', size=-3)
         self.assertEquals(response.status_code, 400)
-        self.assertEquals(Upload.objects.count(), 0)
+        self.assertEquals(Slot.objects.count(), 0)
 
         # filename to long
         response = slot(jid='admin@example.com', name='a' * 255, size=10)
         self.assertEquals(response.status_code, 413)
-        self.assertEquals(Upload.objects.count(), 0)
+        self.assertEquals(Slot.objects.count(), 0)
 
         # invalid content type
         response = slot(jid='admin@example.com', name='example.jpg', size=10, output='foo/bar')
         self.assertEquals(response.content, b"Unsupported content type in output.")
         self.assertEquals(response.status_code, 400)
-        self.assertEquals(Upload.objects.count(), 0)
+        self.assertEquals(Slot.objects.count(), 0)
 
     @override_settings(XMPP_HTTP_UPLOAD_ACCESS=[
         (r'^admin@example\.com$', {}),
@@ -342,12 +699,1859 @@ class RequestSlotTestCase(TestCase):
         # This works:
         response = slot(jid='admin@example.com', name='example.jpg', size=10)
         self.assertEquals(response.status_code, 200)
-        self.assertEquals(Upload.objects.count(), 1)
+        self.assertEquals(Slot.objects.count(), 1)
 
         # But this doesn't match any ACL, so we get forbidden
         response = slot(jid='admin@example.net', name='example.jpg', size=10)
         self.assertEquals(response.status_code, 403)
-        self.assertEquals(Upload.objects.count(), 1)
+        self.assertEquals(Slot.objects.count(), 1)
+
+
+@override_settings(DATABASE_ROUTERS=['xmpp_http_upload.routers.ReplicaRouter'],
+                   XMPP_HTTP_UPLOAD_REPLICAS={'aliases': ['replica']},
+                   XMPP_HTTP_UPLOAD_WEBSERVER_DOWNLOAD=False)
+class ReplicaTestCase(TestCase):
+    databases = {'default', 'replica'}  # "replica" is a separate database that never receives any rows
+
+    def setUp(self):
+        cache.clear()
+
+    def test_router(self):
+        router = ReplicaRouter()
+        self.assertEqual(router.db_for_read(Upload), 'default')
+        with replica_reads():
+            self.assertEqual(router.db_for_read(Upload), 'replica')
+            self.assertEqual(router.db_for_write(Upload), 'default')
+            self.assertIsNone(router.db_for_read(User))
+            self.assertIsNone(router.db_for_write(User))
+            with replica_reads(False):
+                self.assertEqual(router.db_for_read(Slot), 'default')
+            self.assertEqual(router.db_for_read(Slot), 'replica')
+
+            # other threads (i.e. other requests) still read from the primary
+            result = []
+            thread = threading.Thread(target=lambda: result.append(router.db_for_read(Upload)))
+            thread.start()
+            thread.join()
+            self.assertEqual(result, ['default'])
+
+            with self.settings(XMPP_HTTP_UPLOAD_REPLICAS={}):
+                self.assertEqual(router.db_for_read(Upload), 'default')
+
+        self.assertIsNone(router.allow_relation(Upload(), Slot()))
+        self.assertFalse(router.allow_migrate('replica', 'xmpp_http_upload'))
+        self.assertIsNone(router.allow_migrate('default', 'xmpp_http_upload'))
+
+    def test_quota(self):
+        for i in range(1, 11):  # almost at max_total_size
+            Upload.objects.create(jid=user_jid, name='example%s.jpg' % i, size=300 * 1024,
+                                  created=timezone.now() - timedelta(hours=2))
+
+        # the (empty) replica does not know about these uploads yet
+        self.assertEqual(slot(jid=user_jid, name='example.jpg', size=300 * 1024).status_code, 200)
+
+        # but the JID is now pinned to the primary
+        self.assertTrue(is_pinned(user_jid))
+        self.assertFalse(is_pinned('admin@example.com'))
+        self.assertEqual(slot(jid=user_jid, name='example.jpg', size=300 * 1024).status_code, 403)
+
+    def test_download(self):
+        # the upload is not on the replica yet, so the primary is used
+        upload = Upload.objects.create(jid=user_jid, name='example.txt', size=4, hash=get_random_string(32))
+        upload.file.save(upload.name, ContentFile(b'test'))
+        try:
+            response = get(upload.get_absolute_url())
+            self.assertEqual(b''.join(response.streaming_content), b'test')
+        finally:
+            upload.remove_file()
+
+        url = reverse('xmpp-http-upload:share', kwargs={'hash': '0' * 32, 'filename': 'example.txt'})
+        self.assertEqual(get(url).status_code, 404)
+
+    @mock.patch('xmpp_http_upload.routers.get_cache', side_effect=Exception('Connection refused'))
+    def test_cache_failure(self, get_cache):
+        with self.assertLogs('xmpp_http_upload.routers', level='ERROR') as logs:
+            pin(user_jid)
+            self.assertTrue(is_pinned(user_jid))  # use the primary if in doubt
+        self.assertEqual(len(logs.output), 2)
+
+
+class ShardFunctionsTestCase(TestCase):
+    def test_unsharded(self):
+        self.assertEqual(get_aliases(), [None])
+        alias, hash = new_hash(user_jid)
+        self.assertIsNone(alias)
+        self.assertEqual(len(hash), 32)
+        self.assertEqual(shards_for_hash(hash), [None])
+        self.assertEqual(shards_for_jid(user_jid), [None])
+        self.assertEqual(for_each_shard(lambda alias, value: (alias, value), 1), [(None, 1)])
+
+    @override_settings(XMPP_HTTP_UPLOAD_SHARDS={'aliases': ['a', 'b', 'c'], 'domains': {'example.com': 'c'}})
+    def test_domain(self):
+        alias, hash = new_hash('user@example.com')
+        self.assertEqual(alias, 'c')
+        self.assertEqual(len(hash), 32)
+        self.assertEqual(hash[0], '2')
+        self.assertEqual(shards_for_hash(hash), ['c', 'a'])
+        self.assertEqual(shards_for_hash('0' + hash[1:]), ['a'])
+        self.assertEqual(shards_for_hash('z' + hash[1:]), ['a'])  # created before sharding was enabled
+        self.assertEqual(shards_for_jid('other@example.com')[0], 'c')
+
+        alias, hash = new_hash('user@example.net')
+        self.assertEqual(shards_for_jid('other@example.net')[0], alias)
+        self.assertEqual(shards_for_hash(hash)[0], alias)
+
+    def test_appended_shard(self):
+        domains = ['example%s.com' % i for i in range(100)]
+        with self.settings(XMPP_HTTP_UPLOAD_SHARDS={'aliases': ['a', 'b']}):
+            before = {domain: new_hash('user@%s' % domain)[0] for domain in domains}
+
+        # domains moved to the new shard are also looked up on their previous shard
+        with self.settings(XMPP_HTTP_UPLOAD_SHARDS={'aliases': ['a', 'b', 'c']}):
+            moved = [domain for domain in domains if new_hash('user@%s' % domain)[0] == 'c']
+            self.assertTrue(moved)
+            for domain in moved:
+                expected = ['c', 'a'] if before[domain] == 'a' else ['c', 'a', 'b']
+                self.assertEqual(shards_for_jid('user@%s' % domain), expected)
+
+    def test_too_many_shards(self):
+        with self.settings(XMPP_HTTP_UPLOAD_SHARDS={'aliases': ['shard%s' % i for i in range(63)]}):
+            with self.assertRaisesRegex(ImproperlyConfigured, 'At most 62 shards are supported.'):
+                new_hash(user_jid)
+
+    @override_settings(XMPP_HTTP_UPLOAD_SHARDS={'aliases': ['a', 'b', 'c'], 'by': 'hash'})
+    def test_hash(self):
+        self.assertEqual(shards_for_jid(user_jid), ['a', 'b', 'c'])
+
+        used = set()
+        for i in range(100):
+            alias, hash = new_hash(user_jid)
+            self.assertEqual(shards_for_hash(hash)[0], alias)
+            used.add(alias)
+        self.assertEqual(used, {'a', 'b', 'c'})
+
+    def test_ring_lookup(self):
+        keys = ['example%s.com' % i for i in range(1000)]
+        before = {key: ring_lookup(['a', 'b', 'c'], key) for key in keys}
+        after = {key: ring_lookup(['a', 'b', 'c', 'd'], key) for key in keys}
+
+        # appending a shard moves about a quarter of the keys, all to the new shard
+        moved = [key for key in keys if before[key] != after[key]]
+        self.assertEqual({after[key] for key in moved}, {'d'})
+        self.assertGreater(len(moved), 150)
+        self.assertLess(len(moved), 350)
+
+    @override_settings(XMPP_HTTP_UPLOAD_SHARDS={'aliases': ['a', 'b']})
+    def test_for_each_shard(self):
+        main = threading.get_ident()
+        with mock.patch('xmpp_http_upload.utils.connections') as connections:
+            results = for_each_shard(lambda alias, value: (alias, value, threading.get_ident() != main), 1)
+        self.assertEqual(results, [('a', 1, True), ('b', 1, True)])
+        self.assertEqual(connections.close_all.call_count, 2)  # every thread closes its connections
+
+        with self.settings(XMPP_HTTP_UPLOAD_SHARDS={'aliases': ['a', 'b'], 'max_workers': 1}):
+            results = for_each_shard(lambda alias, value: (alias, value, threading.get_ident() != main), 1)
+        self.assertEqual(results, [('a', 1, False), ('b', 1, False)])
+
+
+@override_settings(XMPP_HTTP_UPLOAD_SHARDS={
+    'aliases': ['default', 'shard'],
+    'domains': {'example.net': 'shard'},
+    'max_workers': 1,  # TestCase transactions are not visible to other threads
+}, XMPP_HTTP_UPLOAD_WEBSERVER_DOWNLOAD=False)
+class ShardTestCase(TestCase):
+    databases = {'default', 'shard'}
+
+    def setUp(self):
+        cache.clear()
+        self.uploads = []
+
+    def tearDown(self):
+        for upload in self.uploads:
+            upload.remove_file()
+
+    def create(self, using, jid, content=b'test', **kwargs):
+        kwargs.setdefault('hash', get_random_string(32))
+        upload = Upload.objects.using(using).create(jid=jid, name='example.txt', size=len(content), **kwargs)
+        upload.file.save(upload.name, ContentFile(content))
+        self.uploads.append(upload)
+        return upload
+
+    def test_upload(self):
+        put_url, get_url = slot(jid=user_jid, name='example.txt', size=4).content.decode('utf-8').split()
+        path = urlsplit(put_url).path
+        self.assertEqual(path.split('/')[-2][0], '1')
+        self.assertEqual(Slot.objects.using('shard').count(), 1)
+        self.assertEqual(Slot.objects.using('default').count(), 0)
+
+        self.assertEqual(put(path, b'test').status_code, 201)
+        upload = Upload.objects.using('shard').get()
+        self.uploads.append(upload)
+        self.assertEqual(Upload.objects.using('default').count(), 0)
+        self.assertEqual(Slot.objects.using('shard').count(), 0)
+
+        response = get(path)
+        self.assertEqual(b''.join(response.streaming_content), b'test')
+        self.assertEqual(get(path.replace('/example.txt', '/other.txt')).status_code, 404)
+
+    def test_created_before_sharding(self):
+        upload = self.create('default', user_jid, hash='1' + get_random_string(31))
+        response = get(upload.get_absolute_url())
+        self.assertEqual(b''.join(response.streaming_content), b'test')
+
+    def test_quota(self):
+        for i in range(10):  # almost at max_total_size, on the shard of the domain
+            Upload.objects.using('shard').create(jid=user_jid, name='example.jpg', size=300 * 1024,
+                                                 hash=get_random_string(32),
+                                                 created=timezone.now() - timedelta(hours=2))
+        self.assertEqual(slot(jid=user_jid, name='example.jpg', size=300 * 1024).status_code, 403)
+
+    def test_quota_moved_domain(self):
+        for i in range(10):  # on the first shard, before the domain was placed on another shard
+            Upload.objects.using('default').create(jid=user_jid, name='example.jpg', size=300 * 1024,
+                                                   hash=get_random_string(32),
+                                                   created=timezone.now() - timedelta(hours=2))
+        self.assertEqual(shards_for_jid(user_jid), ['shard', 'default'])
+        self.assertEqual(slot(jid=user_jid, name='example.jpg', size=300 * 1024).status_code, 403)
+
+    def test_quota_by_hash(self):
+        for i in range(5):  # on both shards
+            for using in ('default', 'shard'):
+                Upload.objects.using(using).create(jid=user_jid, name='example.jpg', size=300 * 1024,
+                                                   hash=get_random_string(32),
+                                                   created=timezone.now() - timedelta(hours=2))
+
+        with self.settings(XMPP_HTTP_UPLOAD_SHARDS={'aliases': ['default', 'shard'], 'by': 'hash'}):
+            self.assertEqual(slot(jid=user_jid, name='example.jpg', size=300 * 1024).status_code, 403)
+
+    def test_reaper(self):
+        for using in ('default', 'shard'):
+            Slot.objects.using(using).create(jid=user_jid, name='example.txt', size=4, hash='a')
+            self.create(using, user_jid)
+
+        with freeze_time(timezone.now() + timedelta(days=32)):
+            Lease('shard:0', 'other', 60).acquire()
+            stats = Reaper(partition_size=10 ** 9).reap()
+        self.assertEqual(stats['skipped'], ['shard:0'])
+        self.assertEqual(stats['slots'] + stats['files'], 2)
+        self.assertEqual(Slot.objects.using('default').count() + Upload.objects.using('default').count(), 0)
+        self.assertEqual(Slot.objects.using('shard').count() + Upload.objects.using('shard').count(), 2)
+
+    def test_cleanup(self):
+        for using in ('default', 'shard'):
+            Slot.objects.using(using).create(jid=user_jid, name='example.txt', size=4, hash='a')
+            self.create(using, user_jid)
+
+        with freeze_time(timezone.now() + timedelta(seconds=361)):
+            call_command('cleanup_http_uploads')
+        self.assertEqual(Slot.objects.using('default').count() + Slot.objects.using('shard').count(), 0)
+        self.assertEqual(Upload.objects.using('default').count() + Upload.objects.using('shard').count(), 2)
+
+        with freeze_time(timezone.now() + timedelta(days=32)):
+            cleanup_http_uploads()
+        self.assertEqual(Upload.objects.using('default').count() + Upload.objects.using('shard').count(), 0)
+
+    def test_scrub(self):
+        ok = self.create('default', user_jid, sha256=hashlib.sha256(b'test').hexdigest())
+        corrupt = self.create('shard', user_jid, sha256='0' * 64)
+
+        stdout, stderr = StringIO(), StringIO()
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'checkpoint')
+            call_command('scrub_http_uploads', '--checkpoint', path, '--bytes-per-second', '1M', verbosity=2,
+                         stdout=stdout, stderr=stderr)
+            self.assertEqual(sorted(os.listdir(tempdir)), ['checkpoint.default', 'checkpoint.shard'])
+
+        self.assertEqual([json.loads(line)['id'] for line in stdout.getvalue().splitlines()], [corrupt.pk])
+        self.assertEqual(stderr.getvalue(),
+                         'Scrub complete: 1 ok, 0 new digests, 0 missing, 1 corrupt, 0 unreadable.\n')
+        self.assertEqual(ok.pk, corrupt.pk)  # primary keys are only unique per shard
+
+    @skipUnless(metrics.prometheus_client, 'prometheus_client is not installed.')
+    def test_metrics(self):
+        cache.clear()  # totals are cached
+        self.create('default', 'a@example.com', file='a.txt')
+        self.create('shard', 'b@example.com', content=b'more')
+        self.create('shard', user_jid)
+
+        metric = list(StorageCollector().collect())[0]
+        self.assertEqual([(s.labels['domain'], s.value) for s in metric.samples],
+                         [('example.com', 8), ('example.net', 4)])
+
+    def test_usage(self):
+        self.create('default', 'big@example.com', content=b'0123456789')
+        self.create('default', user_jid, content=b'012345')
+        self.create('shard', user_jid, content=b'012345')
+
+        # JIDs are ranked by their usage in all shards
+        model_admin = UploadAdmin(Upload, admin.site)
+        model_admin.usage_limit = 1
+        self.assertEqual([(row['jid'], row['uploads'], row['bytes']) for row in model_admin.get_usage()],
+                         [(user_jid, 2, 12)])
+
+    @mock.patch('xmpp_http_upload.utils.connections')
+    @mock.patch('xmpp_http_upload.jobs._executor.executor.submit', side_effect=run_now)
+    def test_admin(self, submit, connections):
+        user = User.objects.create_superuser(username='u', password='p', email='user@example.com')
+        changelist_url = reverse('admin:xmpp_http_upload_upload_changelist')
+        client = Client()
+        client.force_login(user)
+
+        default = self.create('default', 'user@example.com')
+        shard = self.create('shard', 'user@example.com', content=b'more data')
+        other = self.create('shard', user_jid)
+
+        response = client.get(changelist_url)
+        self.assertEqual(list(response.context['cl'].result_list), [default])
+        self.assertContains(response, '<strong>default</strong>')
+        response = client.get(changelist_url, {'shard': 'shard'})
+        self.assertEqual(list(response.context['cl'].result_list), [other, shard])
+        self.assertContains(response, '<a href="?shard=default">default</a>')
+
+        change_url = reverse('admin:xmpp_http_upload_upload_change', args=(other.pk, ))
+        response = client.get(change_url, {'_changelist_filters': 'shard=shard'})
+        self.assertEqual(response.context['original'], other)
+
+        usage = UploadAdmin(Upload, admin.site).get_usage()
+        self.assertEqual([(row['jid'], row['uploads'], row['bytes']) for row in usage],
+                         [('user@example.com', 2, 13), (user_jid, 1, 4)])
+
+        response = client.post('%s?shard=shard' % changelist_url, {
+            'action': 'delete_with_files', '_selected_action': [other.pk]}, follow=True)
+        self.assertContains(response, 'Deleting 1 uploads in the background')
+        self.assertEqual(list(Upload.objects.using('shard')), [shard])
+        self.assertEqual(list(Upload.objects.using('default')), [default])
+
+        response = client.post(changelist_url, {'action': 'delete_jids', '_selected_action': [default.pk]},
+                               follow=True)
+        self.assertContains(response, 'Deleting all uploads of user@example.com in the background')
+        self.assertEqual(Upload.objects.using('default').count() + Upload.objects.using('shard').count(), 0)
+
+
+def hash_for(node):
+    """Get a random hash owned by ``node``."""
+    while True:
+        hash = get_random_string(32)
+        if get_owner(hash) == node:
+            return hash
+
+
+@override_settings(XMPP_HTTP_UPLOAD_CLUSTER={
+    'nodes': {'a': 'http://a.example.com', 'b': 'http://b.example.com/'},
+    'retired': {'c': 'http://c.example.com'},
+    'node': 'a',
+}, XMPP_HTTP_UPLOAD_WEBSERVER_DOWNLOAD=False)
+class ClusterTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.uploads = []
+
+    def tearDown(self):
+        for upload in self.uploads:
+            upload.remove_file()
+
+    def create(self, node, content=b'test', owner=None, **kwargs):
+        upload = Upload.objects.create(jid=user_jid, name='example.txt', size=len(content),
+                                       hash=hash_for(owner or node), node=node, **kwargs)
+        upload.file.save(upload.name, ContentFile(content))
+        self.uploads.append(upload)
+        return upload
+
+    def push(self, upload, node='b', content=b'test', token=None):
+        url = reverse('xmpp-http-upload:cluster', kwargs={'hash': upload.hash, 'filename': upload.name})
+        if token is None:
+            token = get_token(upload, node)
+        return Client().put(url, content, content_type='text/plain', HTTP_X_CLUSTER_TOKEN=token)
+
+    def test_disabled(self):
+        with self.settings(XMPP_HTTP_UPLOAD_CLUSTER={}):
+            self.assertFalse(cluster_enabled())
+            self.assertIsNone(get_node())
+            put_url, get_url = slot(jid=user_jid, name='example.txt', size=4).content.decode('utf-8').split()
+        self.assertEqual(Slot.objects.get().node, '')
+        self.assertTrue(put_url.startswith('http://testserver/'))
+
+    def test_slot(self):
+        for node in ('a', 'b'):
+            hash = hash_for(node)
+            with mock.patch('xmpp_http_upload.views.new_hash', return_value=(None, hash)):
+                put_url, get_url = slot(jid=user_jid, name='example.txt', size=4).content.decode(
+                    'utf-8').split()
+            self.assertEqual(Slot.objects.get(hash=hash).node, node)
+            self.assertEqual(put_url, 'http://%s.example.com/http_upload/share/%s/example.txt' % (node, hash))
+            self.assertEqual(get_url, put_url)
+
+    def test_get(self):
+        local = self.create('a')
+        response = get(local.get_absolute_url())
+        self.assertEqual(b''.join(response.streaming_content), b'test')
+
+        remote = Upload.objects.create(jid=user_jid, name='example.txt', size=4, hash=hash_for('b'), node='b',
+                                       file='example.txt')
+        response = get(remote.get_absolute_url() + '?foo=bar')
+        self.assertEqual(response.status_code, 307)
+        self.assertEqual(response['Location'], 'http://b.example.com%s?foo=bar' % remote.get_absolute_url())
+
+        with self.settings(XMPP_HTTP_UPLOAD_CLUSTER={'nodes': {'a': 'http://a', 'b': 'http://b'}, 'node': 'a',
+                                                     'proxy_prefix': '/nodes/'}):
+            response = get(remote.get_absolute_url())
+        self.assertEqual(response.status_code, 307)
+        self.assertEqual(response['X-Accel-Redirect'], '/nodes/b%s' % remote.get_absolute_url())
+        self.assertFalse(response.has_header('Location'))
+
+        Upload.objects.filter(pk=remote.pk).update(node='c')  # still stored on a retired node
+        self.assertEqual(get(remote.get_absolute_url())['Location'],
+                         'http://c.example.com%s' % remote.get_absolute_url())
+        Upload.objects.filter(pk=remote.pk).update(node='d')  # left without rebalancing
+        self.assertEqual(get(remote.get_absolute_url()).status_code, 404)
+
+    def test_slot_on_other_node(self):
+        remote = Slot.objects.create(jid=user_jid, name='example.txt', size=4, hash=hash_for('b'), node='b')
+        response = put(remote.get_absolute_url(), b'test')
+        self.assertEqual(response.status_code, 307)
+        self.assertEqual(response['Location'], 'http://b.example.com%s' % remote.get_absolute_url())
+
+        with self.settings(XMPP_HTTP_UPLOAD_PROGRESSIVE_DOWNLOAD=True):
+            response = get(remote.get_absolute_url())
+        self.assertEqual(response.status_code, 307)
+
+    def test_local(self):
+        local = self.create('a')
+        self.create('b')
+        self.assertEqual(list(Upload.objects.local()), [local])
+        with self.settings(XMPP_HTTP_UPLOAD_CLUSTER={}):
+            self.assertEqual(Upload.objects.local().count(), 2)
+
+        with freeze_time(timezone.now() + timedelta(days=32)):
+            Lease('a:%s' % local.pk, 'other', 60).acquire()
+            stats = Reaper(partition_size=1).reap()
+        self.assertEqual(stats['skipped'], ['a:%s' % local.pk])
+
+    def test_receive(self):
+        upload = self.create('a', sha256=hashlib.sha256(b'test').hexdigest(), mirrors=1)
+        previous = upload.file.path
+
+        response = self.push(upload)
+        self.assertEqual(response.status_code, 201)
+        received = Upload.objects.get(pk=upload.pk)
+        self.uploads.append(received)
+        self.assertEqual(received.node, 'b')
+        self.assertEqual(received.mirrors, 0)  # copied by the receiving node
+        self.assertNotEqual(received.file.path, previous)  # the test nodes share a disk
+        with received.file.open('rb') as stream:
+            self.assertEqual(stream.read(), b'test')
+        self.assertTrue(os.path.exists(previous))  # removed by the node pushing the file
+
+    def test_receive_errors(self):
+        upload = self.create('a', sha256='0' * 64)
+        other = self.create('a')
+
+        self.assertEqual(self.push(upload, token='wrong').status_code, 403)
+        self.assertEqual(self.push(upload, token=get_token(other, 'b')).status_code, 403)
+        self.assertEqual(self.push(upload, content=b'too long').status_code, 400)
+        self.assertEqual(self.push(upload).status_code, 400)  # digest mismatch
+
+        with self.settings(XMPP_HTTP_UPLOAD_CLUSTER={'nodes': {'a': '', 'b': ''}, 'timeout': -1}):
+            self.assertEqual(self.push(other).status_code, 403)  # expired
+
+        Upload.objects.filter(pk=other.pk).update(file='')
+        self.assertEqual(self.push(other).status_code, 404)
+        self.assertEqual(Upload.objects.get(pk=upload.pk).node, 'a')
+
+    def test_receive_conflict(self):
+        upload = self.create('a')
+        stale = Upload.objects.get(pk=upload.pk)
+        Upload.objects.filter(pk=upload.pk).update(node='c')
+
+        with mock.patch('xmpp_http_upload.views._lookup', return_value=stale):
+            self.assertEqual(self.push(upload).status_code, 409)
+        self.assertEqual(Upload.objects.get(pk=upload.pk).node, 'c')
+        self.assertEqual(len(os.listdir(os.path.dirname(upload.file.path))), 1)
+
+    def test_delete(self):
+        local = self.create('a')
+        remote = self.create('b')
+        job = jobs.Job.create('Deleting 2 uploads', 2)
+        jobs.delete_uploads(job.id, pks=[local.pk, remote.pk])
+        self.assertEqual(jobs.Job(job.id).get()['done'], 2)
+        self.assertFalse(os.path.exists(local.file.path))
+
+        # the file of the other node is removed by its cleanup
+        self.assertEqual(list(Upload.objects.expired_files()), [remote])
+        self.assertTrue(os.path.exists(remote.file.path))
+        with self.settings(XMPP_HTTP_UPLOAD_CLUSTER={'nodes': {'a': '', 'b': ''}, 'node': 'b'}):
+            Upload.objects.cleanup()
+        self.assertFalse(Upload.objects.exists())
+        self.assertFalse(os.path.exists(remote.file.path))
+
+    @override_settings(XMPP_HTTP_UPLOAD_PROGRESSIVE_DOWNLOAD=True)
+    def test_delete_jids(self):
+        remote = self.create('b')
+        local = Slot.objects.create(jid=user_jid, name='example.txt', size=4, hash=hash_for('a'), node='a')
+        other = Slot.objects.create(jid=user_jid, name='example.txt', size=4, hash=hash_for('b'), node='b')
+        partial = local.get_partial_path()
+        os.makedirs(os.path.dirname(partial))
+        with open(partial, 'wb'):
+            pass
+
+        jobs.delete_uploads(jobs.Job.create('Deleting all uploads', 1).id, jids=[user_jid])
+        self.assertFalse(os.path.exists(partial))
+        self.assertEqual(list(Slot.objects.expired()), [other])
+        self.assertEqual(list(Upload.objects.expired_files()), [remote])
+
+        # ... also if deleted in the admin interface
+        remote = self.create('b')
+        UploadAdmin(Upload, admin.site).delete_model(None, remote)
+        self.assertEqual(Upload.objects.expired_files().count(), 2)
+        self.assertTrue(os.path.exists(remote.file.path))
+
+    @mock.patch('xmpp_http_upload.cluster.urllib.request.urlopen')
+    def test_rebalance(self, urlopen):
+        bodies = []
+        urlopen.side_effect = lambda req, timeout: bodies.append(b''.join(req.data)) or mock.MagicMock()
+        remote = self.create('a', content=b'remote', owner='b')
+        local = self.create('b', owner='a')  # on the wrong node, but not stored by this node
+        self.create('a')
+        rebalancer = Rebalancer(batch_size=1)
+
+        with self.settings(XMPP_HTTP_UPLOAD_METADATA={'enabled': True, 'xattrs': False}):
+            metadata.write(remote)
+        sidecar = '%s.meta' % remote.file.path
+        self.assertTrue(os.path.exists(sidecar))
+
+        # copies of the file may be named like the copy of the new owner
+        with mock.patch('xmpp_http_upload.models.remove_copies') as remove_copies, \
+                mock.patch('xmpp_http_upload.utils.threading.Timer') as timer:
+            self.assertEqual(rebalancer.rebalance(), {'moved': 1, 'failed': 0})
+        remove_copies.assert_not_called()
+        self.assertFalse(os.path.exists(sidecar))
+
+        # downloads that looked up the upload before it was pushed can still read the file
+        timer.assert_called_once_with(60, remove_files, (remote.file.path, ))
+        self.assertTrue(os.path.exists(remote.file.path))
+        remove_files(remote.file.path)
+        self.assertFalse(os.path.exists(os.path.dirname(remote.file.path)))
+        request = urlopen.call_args[0][0]
+        self.assertEqual(request.full_url, 'http://b.example.com/http_upload/cluster/%s/example.txt' % (
+            remote.hash))
+        self.assertEqual(request.get_method(), 'PUT')
+        self.assertEqual(request.headers['Content-length'], '6')
+        self.assertEqual(request.headers['Content-type'], 'application/octet-stream')
+        self.assertEqual(load_token(request.headers['X-cluster-token'], remote.hash, 'example.txt'), 'b')
+        self.assertEqual(bodies, [b'remote'])
+        self.assertTrue(os.path.exists(local.file.path))
+
+        # nothing to do until the ring changes
+        self.assertEqual(rebalancer.rebalance(), {'moved': 0, 'failed': 0})
+        self.assertEqual(urlopen.call_count, 1)
+        Upload.objects.filter(pk=remote.pk).update(node='b')  # done by the receiving node
+        self.assertEqual(rebalancer.rebalance(force=True), {'moved': 0, 'failed': 0})
+        self.assertEqual(urlopen.call_count, 1)
+
+    @mock.patch('xmpp_http_upload.cluster.urllib.request.urlopen', side_effect=URLError('refused'))
+    def test_rebalance_error(self, urlopen):
+        upload = self.create('a', owner='b')
+        self.create('a', content=b'local')
+        rebalancer = Rebalancer()
+
+        with self.assertLogs('xmpp_http_upload.cluster', level='ERROR'):
+            self.assertEqual(rebalancer.rebalance(), {'moved': 0, 'failed': 1})
+        self.assertTrue(os.path.exists(upload.file.path))
+        with self.assertLogs('xmpp_http_upload.cluster', level='ERROR'):
+            self.assertEqual(rebalancer.rebalance(), {'moved': 0, 'failed': 1})  # tried again
+
+        os.remove(upload.file.path)
+        with self.assertLogs('xmpp_http_upload.cluster', level='ERROR') as logs:
+            self.assertEqual(rebalancer.rebalance(), {'moved': 0, 'failed': 1})
+        self.assertIn('the file cannot be read', logs.output[0])
+
+    @mock.patch('xmpp_http_upload.cluster.urllib.request.urlopen')
+    def test_command(self, urlopen):
+        self.create('a', owner='b')
+        self.create('a', owner='b')
+        stdout = StringIO()
+        call_command('rebalance_http_uploads', once=True, verbosity=2, stdout=stdout)
+        call_command('rebalance_http_uploads', once=True, verbosity=2, stdout=stdout)
+        Upload.objects.update(node='b')  # done by the receiving node
+        call_command('rebalance_http_uploads', once=True, force=True, verbosity=2, stdout=stdout)
+        call_command('rebalance_http_uploads', once=True, stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'Moved 2 files, 0 failed.\n' + 'Moved 0 files, 0 failed.\n' * 2)
+
+        with self.settings(XMPP_HTTP_UPLOAD_CLUSTER={}), self.assertRaises(CommandError):
+            call_command('rebalance_http_uploads', once=True)
+
+    @mock.patch('xmpp_http_upload.cluster.time.sleep')
+    @mock.patch('xmpp_http_upload.tasks.rebalance_http_uploads.apply_async')
+    def test_task(self, apply_async, sleep):
+        rebalance_http_uploads(reschedule=False)
+        apply_async.assert_not_called()
+        rebalance_http_uploads()
+        apply_async.assert_called_once_with(kwargs={'reschedule': True}, countdown=60)
+
+        callback = mock.Mock()
+        Rebalancer(interval=5).run(passes=2, callback=callback)
+        self.assertEqual(callback.call_count, 2)
+        sleep.assert_called_once_with(5)
+        Rebalancer().run(passes=1)
+
+
+@override_settings(XMPP_HTTP_UPLOAD_WEBSERVER_DOWNLOAD=False)
+@mock.patch('xmpp_http_upload.utils.connections')
+@mock.patch('xmpp_http_upload.mirrors._executor.executor.submit', side_effect=run_now)
+class MirrorTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        mirrors._unhealthy.clear()
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.roots = [os.path.join(tempdir.name, 'a'), os.path.join(tempdir.name, 'b')]
+        override = self.settings(XMPP_HTTP_UPLOAD_MIRRORS={'roots': self.roots})
+        override.enable()
+        self.addCleanup(override.disable)
+        self.uploads = []
+
+    def tearDown(self):
+        for upload in self.uploads:
+            upload.remove_file()
+
+    def create(self, content=b'test', **kwargs):
+        upload = Upload.objects.create(jid=user_jid, name='example.txt', size=len(content),
+                                       hash=get_random_string(32), uploaded=timezone.now(), **kwargs)
+        upload.file.save(upload.name, ContentFile(content))
+        self.uploads.append(upload)
+        return upload
+
+    def copies(self, upload):
+        upload.refresh_from_db()
+        paths = [upload.file.path] + [os.path.join(root, upload.file.name) for root in self.roots]
+        return upload.mirrors, [os.path.exists(path) for path in paths]
+
+    def test_put(self, submit, connections):
+        url = Slot.objects.create(jid=user_jid, name='example.txt', size=4,
+                                  hash=get_random_string(32)).get_absolute_url()
+        with mock.patch('django.db.transaction.on_commit', side_effect=lambda func, using: func()):
+            self.assertEqual(put(url, b'test').status_code, 201)
+
+        upload = Upload.objects.get()
+        self.uploads.append(upload)
+        self.assertEqual(self.copies(upload), (3, [True, True, True]))
+        with open(os.path.join(self.roots[1], upload.file.name), 'rb') as stream:
+            self.assertEqual(stream.read(), b'test')
+        connections.close_all.assert_called_once_with()
+
+        # copies are removed with their directories
+        directory = os.path.dirname(upload.file.name)
+        with open(os.path.join(self.roots[1], directory, 'other.txt'), 'w'):
+            pass
+        upload.remove_file()
+        self.assertFalse(os.path.exists(os.path.join(self.roots[0], directory)))
+        self.assertEqual(os.listdir(os.path.join(self.roots[1], directory)), ['other.txt'])
+
+    def test_disabled(self, submit, connections):
+        with self.settings(XMPP_HTTP_UPLOAD_MIRRORS={}):
+            mirrors.schedule(self.create())
+        submit.assert_not_called()
+
+    def test_celery(self, submit, connections):
+        upload = self.create()
+        with self.settings(XMPP_HTTP_UPLOAD_MIRRORS={'roots': self.roots, 'backend': 'celery'}), \
+                mock.patch('xmpp_http_upload.tasks.mirror_http_upload.delay') as delay:
+            mirrors.schedule(upload)
+        delay.assert_called_once_with(upload.pk, using='default')
+        submit.assert_not_called()
+
+        mirror_http_upload(upload.pk, using='default')
+        self.assertEqual(self.copies(upload), (3, [True, True, True]))
+
+    def test_get(self, submit, connections):
+        upload = self.create()
+        mirrors.mirror_upload(upload.pk)
+        upload.refresh_from_db()
+        with open(os.path.join(self.roots[1], upload.file.name), 'wb') as stream:
+            stream.write(b'copy')  # shows which copy is read
+
+        with mock.patch('xmpp_http_upload.mirrors.random.shuffle', side_effect=list.reverse):
+            response = get(upload.get_absolute_url())
+            self.assertEqual(b''.join(response.streaming_content), b'copy')
+            self.assertEqual(response['Content-Length'], '4')
+
+            # unhealthy roots are tried last
+            mirrors.mark_unhealthy(self.roots[1])
+            self.assertTrue(mirrors.is_healthy(self.roots[0]))
+            self.assertFalse(mirrors.is_healthy(self.roots[1]))
+            response = get(upload.get_absolute_url())
+            self.assertEqual(b''.join(response.streaming_content), b'test')
+
+            # fail over to the primary if a copy is missing, the copy is made again
+            os.remove(os.path.join(self.roots[0], upload.file.name))
+            response = get(upload.get_absolute_url())
+            self.assertEqual(b''.join(response.streaming_content), b'test')
+            self.assertEqual(self.copies(upload), (3, [True, True, True]))
+
+            # fail over if the primary copy is missing, the primary copy is restored
+            os.remove(upload.file.path)
+            os.remove(os.path.join(self.roots[0], upload.file.name))
+            os.makedirs(os.path.join(self.roots[0], upload.file.name))  # cannot be read
+            with self.assertLogs('xmpp_http_upload.mirrors', 'ERROR'):
+                response = get(upload.get_absolute_url())
+            self.assertEqual(b''.join(response.streaming_content), b'copy')
+            self.assertEqual(self.copies(upload), (3, [True, True, True]))
+            with open(upload.file.path, 'rb') as stream:
+                self.assertEqual(stream.read(), b'copy')
+
+            os.remove(upload.file.path)
+            os.makedirs(upload.file.path)
+            os.remove(os.path.join(self.roots[1], upload.file.name))
+            with self.assertLogs('xmpp_http_upload.mirrors', 'ERROR'):
+                self.assertEqual(get(upload.get_absolute_url()).status_code, 404)
+        os.rmdir(upload.file.path)
+        os.rmdir(os.path.join(self.roots[0], upload.file.name))
+
+    @override_settings(XMPP_HTTP_UPLOAD_PROGRESSIVE_DOWNLOAD=True)
+    def test_get_partial(self, submit, connections):
+        upload = self.create(mirrors=2)
+        os.makedirs(os.path.dirname(os.path.join(self.roots[1], upload.file.name)))
+        with open(os.path.join(self.roots[1], upload.file.name), 'wb') as stream:
+            stream.write(b'test')
+        os.remove(upload.file.path)
+
+        slot = Slot(jid=user_jid, name=upload.name, size=upload.size, hash=upload.hash)
+        with mock.patch('xmpp_http_upload.mirrors.random.shuffle'):  # the primary copy is tried first
+            response = UploadView().get_partial(slot, {})
+        self.assertEqual(b''.join(response.streaming_content), b'test')
+
+        os.remove(upload.file.path)  # restored from the copy
+        mirrors.remove_copies(upload.file.name)
+        with self.assertRaises(Http404):
+            UploadView().get_partial(slot, {})
+
+    def test_mirror_errors(self, submit, connections):
+        self.assertEqual(mirrors.mirror_upload(0), 0)
+
+        upload = self.create()
+        os.remove(upload.file.path)
+        with self.assertLogs('xmpp_http_upload.mirrors', 'ERROR'):
+            self.assertEqual(mirrors.mirror_upload(upload.pk), 0)
+
+        upload = self.create()
+        with open(self.roots[0], 'w'):  # a file instead of a directory
+            pass
+        with self.assertLogs('xmpp_http_upload.mirrors', 'ERROR'):
+            self.assertEqual(mirrors.mirror_upload(upload.pk), 1)
+        self.assertEqual(self.copies(upload), (2, [True, False, True]))
+        self.assertFalse(mirrors.is_healthy(self.roots[0]))
+        self.assertEqual(mirrors.mirror_upload(upload.pk), 0)  # skipped until retry_after passed
+
+        with self.assertLogs('xmpp_http_upload.mirrors', 'ERROR'):
+            mirrors.remove_copies(upload.file.name)
+        os.remove(self.roots[0])
+
+    def test_command(self, submit, connections):
+        complete = self.create()
+        mirrors.mirror_upload(complete.pk)
+        missing = self.create(mirrors=1)
+        os.makedirs(os.path.dirname(os.path.join(self.roots[0], missing.file.name)))
+        with open(os.path.join(self.roots[0], missing.file.name), 'w'):
+            pass
+        os.remove(os.path.join(self.roots[1], complete.file.name))  # not noticed without --verify
+
+        stdout = StringIO()
+        call_command('mirror_http_uploads', verbosity=2, stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'Made 1 copies.\n')
+        self.assertEqual(self.copies(missing), (3, [True, True, True]))
+        self.assertEqual(self.copies(complete), (3, [True, True, False]))
+
+        stdout = StringIO()
+        call_command('mirror_http_uploads', '--verify', '--batch-size=1', stdout=stdout)
+        self.assertEqual(stdout.getvalue(), '')
+        self.assertEqual(self.copies(complete), (3, [True, True, True]))
+
+        with self.settings(XMPP_HTTP_UPLOAD_MIRRORS={}), self.assertRaises(CommandError):
+            call_command('mirror_http_uploads')
+
+
+@override_settings(XMPP_HTTP_UPLOAD_WEBSERVER_DOWNLOAD=False, XMPP_HTTP_UPLOAD_PACKS={'max_size': 10})
+class PackTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch('xmpp_http_upload.packs._writer', PackWriter())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, packs.get_storage().path(packs.get_directory()), ignore_errors=True)
+
+    def tearDown(self):
+        for upload in Upload.objects.all():
+            upload.remove_file()
+
+    def upload(self, content):
+        url = Slot.objects.create(jid=user_jid, name='example.txt', size=len(content),
+                                  hash=get_random_string(32)).get_absolute_url()
+        self.assertEqual(put(url, content).status_code, 201)
+        return Upload.objects.get(hash=urlsplit(url).path.split('/')[-2])
+
+    def create(self, content):
+        """Create a packed upload without a request."""
+        name, offset = packs.append(BytesIO(content))
+        return Upload.objects.create(jid=user_jid, name='example.txt', size=len(content), file=name,
+                                     offset=offset, hash=get_random_string(32), uploaded=timezone.now(),
+                                     sha256=hashlib.sha256(content).hexdigest())
+
+    def seal(self, *uploads):
+        """Make pack files look as if they were not written to for a long time."""
+        for upload in uploads:
+            os.utime(upload.file.path, (0, 0))
+
+    def test_should_pack(self):
+        self.assertTrue(packs.should_pack(10))
+        self.assertFalse(packs.should_pack(11))
+        with self.settings(XMPP_HTTP_UPLOAD_WEBSERVER_DOWNLOAD=True):
+            self.assertFalse(packs.should_pack(10))
+        with self.settings(XMPP_HTTP_UPLOAD_PACKS={}):
+            self.assertFalse(packs.should_pack(10))
+
+    def test_upload(self):
+        first = self.upload(b'first')
+        second = self.upload(b'second')
+        large = self.upload(b'large upload')
+
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertEqual(os.path.dirname(first.file.name), packs.get_directory())
+        self.assertEqual((first.offset, second.offset), (0, 5))
+        self.assertIsNone(large.offset)
+        with open(first.file.path, 'rb') as stream:
+            self.assertEqual(stream.read(), b'firstsecond')
+
+        for upload, content in ((first, b'first'), (second, b'second'), (large, b'large upload')):
+            response = get(upload.get_absolute_url())
+            self.assertEqual(b''.join(response.streaming_content), content)
+            self.assertEqual(response['Content-Length'], str(len(content)))
+
+        # removing a packed upload keeps the pack file
+        first.remove_file()
+        self.assertTrue(os.path.exists(second.file.path))
+
+        os.remove(second.file.path)
+        with self.assertLogs('xmpp_http_upload.packs', 'ERROR'):
+            self.assertEqual(get(second.get_absolute_url()).status_code, 404)
+
+    def test_packed_file(self):
+        upload = self.create(b'0123456789')
+        with PackedFile(upload.file.path, 2, 5) as stream:
+            self.assertEqual(os.lseek(stream.fileno(), 0, os.SEEK_CUR), 2)  # for sendfile()
+            self.assertEqual(stream.read(2), b'23')
+            self.assertEqual(stream.read(), b'456')
+            self.assertEqual(stream.read(), b'')
+        stream.close()  # closing twice does nothing
+
+    def test_writer(self):
+        first = self.create(b'first')
+        self.assertEqual(self.create(b'second').file.name, first.file.name)
+        with self.settings(XMPP_HTTP_UPLOAD_PACKS={'pack_size': 10}):
+            full = self.create(b'full')
+        self.assertNotEqual(full.file.name, first.file.name)
+
+        with mock.patch('xmpp_http_upload.packs.time.monotonic', return_value=time.monotonic() + 1800):
+            idle = self.create(b'idle')
+        self.assertNotEqual(idle.file.name, full.file.name)
+
+        stream = packs._writer.stream
+        with mock.patch('xmpp_http_upload.packs.os.getpid', return_value=0):  # in a forked process
+            forked = self.create(b'forked')
+        self.assertNotEqual(forked.file.name, idle.file.name)
+        self.assertFalse(stream.closed)  # still used by the parent process
+        stream.close()
+
+    def test_compact(self):
+        empty = self.create(b'empty')
+        empty.delete()
+        packs._writer.stream = None  # start a new pack file
+        garbage = self.create(b'garbage')
+        kept = self.create(b'kept')
+        garbage.delete()
+        packs._writer.stream = None
+        used = self.create(b'mostly used')
+        self.create(b'x').delete()
+        packs._writer.stream = None
+        unsealed = self.create(b'unsealed')
+        unsealed.delete()
+        self.seal(empty, kept, used)
+        packs._writer.stream = None
+
+        with mock.patch('xmpp_http_upload.utils.threading.Timer') as timer:
+            self.assertEqual(Compactor().compact(), {'removed': 2, 'moved': 1})
+        timer.assert_called_once_with(60, remove_files, (kept.file.path, ))
+        self.assertFalse(os.path.exists(empty.file.path))
+        self.assertTrue(os.path.exists(used.file.path))
+        self.assertTrue(os.path.exists(unsealed.file.path))
+
+        moved = Upload.objects.get(pk=kept.pk)
+        self.assertNotEqual(moved.file.name, kept.file.name)
+        self.assertEqual(b''.join(get(moved.get_absolute_url()).streaming_content), b'kept')
+
+        # a download that looked up the upload before it was moved can still read it
+        with kept.open_file() as stream:
+            self.assertEqual(stream.read(), b'kept')
+        remove_files(kept.file.path)
+
+        # uploads removed while they are moved are not counted
+        removed = Upload(pk=0, file=used.file.name, offset=used.offset, size=used.size)
+        self.assertFalse(Compactor().move(None, removed))
+        self.assertEqual(Compactor(min_garbage=0).compact(), {'removed': 1, 'moved': 1})
+
+    def test_no_packs(self):
+        self.assertEqual(Compactor().compact(), {'removed': 0, 'moved': 0})
+
+    def test_command(self):
+        self.create(b'test').delete()
+        self.seal(Upload(file=packs._writer.name))
+        packs._writer.stream = None
+
+        stdout = StringIO()
+        call_command('compact_http_uploads', '--min-garbage=0.1', '--bytes-per-second=1M', verbosity=2,
+                     stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'Removed 1 pack files, moved 0 uploads.\n')
+        call_command('compact_http_uploads', stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'Removed 1 pack files, moved 0 uploads.\n')
+        compact_http_uploads()
+
+    def test_scrub(self):
+        ok = self.create(b'ok')
+        corrupt = self.create(b'corrupt')
+        Upload.objects.filter(pk=corrupt.pk).update(sha256='0' * 64)
+        stdout = StringIO()
+        call_command('scrub_http_uploads', stdout=stdout)
+        self.assertEqual([json.loads(line)['id'] for line in stdout.getvalue().splitlines()], [corrupt.pk])
+        self.assertEqual(Upload.objects.get(pk=ok.pk).sha256, hashlib.sha256(b'ok').hexdigest())
+
+    def test_mirrors(self):
+        upload = self.create(b'test')
+        with tempfile.TemporaryDirectory() as tempdir, \
+                self.settings(XMPP_HTTP_UPLOAD_MIRRORS={'roots': [tempdir]}):
+            self.assertEqual(mirrors.mirror_upload(upload.pk), 0)
+            self.assertEqual(mirrors.mirror_missing(), 0)
+            self.assertEqual(os.listdir(tempdir), [])
+
+    @mock.patch('xmpp_http_upload.cluster.urllib.request.urlopen')
+    def test_cluster(self, urlopen):
+        bodies = []
+        urlopen.side_effect = lambda req, timeout: bodies.append(b''.join(req.data)) or mock.MagicMock()
+        nodes = {'a': 'http://a', 'b': 'http://b'}
+        with self.settings(XMPP_HTTP_UPLOAD_CLUSTER={'nodes': nodes, 'node': 'a'}):
+            local = self.create(b'local')
+            upload = self.create(b'remote')
+            Upload.objects.update(node='a')
+            Upload.objects.filter(pk=local.pk).update(hash=hash_for('a'))
+            Upload.objects.filter(pk=upload.pk).update(hash=hash_for('b'))
+            upload.refresh_from_db()
+            self.assertEqual(Rebalancer().rebalance(), {'moved': 1, 'failed': 0})
+            self.assertEqual(bodies, [b'remote'])
+            self.assertTrue(os.path.exists(upload.file.path))  # reclaimed by the compactor
+
+            url = reverse('xmpp-http-upload:cluster', kwargs={'hash': upload.hash, 'filename': upload.name})
+            response = Client().put(url, b'remote', content_type='text/plain',
+                                    HTTP_X_CLUSTER_TOKEN=get_token(upload, 'b'))
+            self.assertEqual(response.status_code, 201)
+            received = Upload.objects.get(pk=upload.pk)
+            self.assertIsNone(received.offset)
+            self.assertEqual(received.node, 'b')
+            received.remove_file()
+
+
+@override_settings(XMPP_HTTP_UPLOAD_WEBSERVER_DOWNLOAD=False, XMPP_HTTP_UPLOAD_REMOVE_DELAY=0,
+                   XMPP_HTTP_UPLOAD_COMPRESSION={'types': ['text/*', 'application/json'], 'min_size': 100})
+@mock.patch('xmpp_http_upload.utils.connections')
+@mock.patch('xmpp_http_upload.compression._executor.executor.submit', side_effect=run_now)
+class CompressionTestCase(TestCase):
+    content = b'compressible ' * 100
+
+    def setUp(self):
+        cache.clear()
+
+    def tearDown(self):
+        for upload in Upload.objects.all():
+            upload.remove_file()
+
+    def upload(self, content=None, content_type='text/plain; charset=utf-8'):
+        content = self.content if content is None else content
+        url = Slot.objects.create(jid=user_jid, name='example.txt', size=len(content),
+                                  hash=get_random_string(32)).get_absolute_url()
+        with mock.patch('django.db.transaction.on_commit', side_effect=lambda func, using: func()):
+            self.assertEqual(put(url, content, content_type=content_type).status_code, 201)
+        return Upload.objects.get(hash=urlsplit(url).path.split('/')[-2])
+
+    def create(self, content=None, **kwargs):
+        content = self.content if content is None else content
+        upload = Upload.objects.create(jid=user_jid, name='example.txt', size=len(content), type='text/plain',
+                                       hash=get_random_string(32), uploaded=timezone.now(),
+                                       sha256=hashlib.sha256(content).hexdigest(), **kwargs)
+        upload.file.save(upload.name, ContentFile(content))
+        return upload
+
+    def test_should_compress(self, submit, connections):
+        self.assertTrue(compression.should_compress(Upload(size=100, type='Text/Plain; charset=utf-8')))
+        self.assertTrue(compression.should_compress(Upload(size=100, type='application/json')))
+        self.assertFalse(compression.should_compress(Upload(size=100, type='image/png')))
+        self.assertFalse(compression.should_compress(Upload(size=100, type=None)))
+        self.assertFalse(compression.should_compress(Upload(size=99, type='text/plain')))
+        self.assertFalse(compression.should_compress(Upload(size=100, type='text/plain', offset=0)))
+        with self.settings(XMPP_HTTP_UPLOAD_COMPRESSION={}):
+            self.assertFalse(compression.should_compress(Upload(size=100, type='text/plain')))
+
+    def test_replace(self, submit, connections):
+        upload = self.upload()
+        original = os.path.join(os.path.dirname(upload.file.path), 'example.txt')
+        self.assertEqual(upload.encoding, 'gzip')
+        self.assertEqual(upload.file.name, '%s.gz' % os.path.relpath(original, settings.MEDIA_ROOT))
+        self.assertEqual(upload.compressed_size, os.path.getsize(upload.file.path))
+        self.assertLess(upload.compressed_size, 100)
+        self.assertFalse(os.path.exists(original))
+        sha256 = hashlib.sha256(self.content).hexdigest()
+
+        response = get(upload.get_absolute_url(), HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Content-Length'], str(upload.compressed_size))
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(response['ETag'], '"%s-gzip"' % sha256)
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), self.content)
+
+        response = get(upload.get_absolute_url())
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response['Content-Length'], str(len(self.content)))
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(response['ETag'], '"%s"' % sha256)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+        response = get(upload.get_absolute_url(), HTTP_ACCEPT_ENCODING='gzip',
+                       HTTP_IF_NONE_MATCH='"%s-gzip"' % sha256)
+        self.assertEqual(response.status_code, 304)
+
+        # there is no original to send instead of a missing compressed file
+        with mock.patch('xmpp_http_upload.models.open_copy', return_value=None) as open_copy, \
+                mock.patch('xmpp_http_upload.compression.mirrors.open_copy', return_value=None):
+            self.assertEqual(get(upload.get_absolute_url(), HTTP_ACCEPT_ENCODING='gzip').status_code, 404)
+        open_copy.assert_not_called()
+
+        # the compressed file is verified after decompressing it
+        stdout = StringIO()
+        call_command('scrub_http_uploads', stdout=stdout)
+        self.assertEqual(stdout.getvalue(), '')
+        with open(upload.file.path, 'r+b') as stream:
+            stream.truncate(upload.compressed_size - 10)
+        call_command('scrub_http_uploads', stdout=stdout)
+        self.assertEqual(json.loads(stdout.getvalue())['status'], 'error')
+
+        upload.remove_file()
+        self.assertFalse(os.path.exists(os.path.dirname(original)))
+
+    @override_settings(XMPP_HTTP_UPLOAD_REMOVE_DELAY=60)
+    def test_remove_later(self, submit, connections):
+        upload = self.create()
+        original = upload.file.path
+        with mock.patch('xmpp_http_upload.utils.threading.Timer') as timer:
+            compression.compress_upload(upload.pk)
+        timer.assert_called_once_with(60, remove_files, (original, ))
+
+        # a download that looked up the upload before it was compressed can still read the original
+        with upload.open_file() as stream:
+            self.assertEqual(stream.read(), self.content)
+
+        remove_files(original)
+        self.assertFalse(os.path.exists(original))
+
+    def test_keep_original(self, submit, connections):
+        with self.settings(XMPP_HTTP_UPLOAD_COMPRESSION={'types': ['text/*'], 'keep_original': True}):
+            upload = self.upload()
+        compressed = '%s.gz' % upload.file.path
+        self.assertEqual((upload.encoding, upload.compressed_size), ('', os.path.getsize(compressed)))
+        with open(upload.file.path, 'rb') as stream:
+            self.assertEqual(stream.read(), self.content)
+
+        response = get(upload.get_absolute_url(), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), self.content)
+        response = get(upload.get_absolute_url())
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+        # the original is sent if the compressed file is missing
+        os.remove(compressed)
+        with self.assertLogs('xmpp_http_upload.compression', 'ERROR'):
+            response = get(upload.get_absolute_url(), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response['Content-Length'], str(len(self.content)))
+        self.assertEqual(response['ETag'], '"%s"' % hashlib.sha256(self.content).hexdigest())
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+        Upload.objects.filter(pk=upload.pk).update(sha256=None)  # uploaded before digests were introduced
+        with self.assertLogs('xmpp_http_upload.compression', 'ERROR'):
+            response = get(upload.get_absolute_url(), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(response.has_header('ETag'))
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+        # ... also from a mirror if the original is missing as well
+        with tempfile.TemporaryDirectory() as tempdir, \
+                self.settings(XMPP_HTTP_UPLOAD_MIRRORS={'roots': [tempdir]}):
+            Upload.objects.filter(pk=upload.pk).update(mirrors=1)
+            mirrors.copy_file(upload.file.path, os.path.join(tempdir, upload.file.name))
+            os.remove(upload.file.path)
+            with self.assertLogs('xmpp_http_upload.compression', 'ERROR'):
+                response = get(upload.get_absolute_url(), HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(b''.join(response.streaming_content), self.content)
+            upload.mirrors = 1
+            upload.remove_file()
+
+        # the compressed file is removed with the upload
+        upload = self.create(compressed_size=10)
+        compressed = '%s.gz' % upload.file.path
+        with open(compressed, 'wb'):
+            pass
+        upload.remove_file()
+        self.assertFalse(os.path.exists(compressed))
+
+    def test_webserver_download(self, submit, connections):
+        upload = self.create()
+        with self.settings(XMPP_HTTP_UPLOAD_WEBSERVER_DOWNLOAD=True):
+            size = compression.compress_upload(upload.pk)
+        upload.refresh_from_db()
+        self.assertEqual((upload.encoding, upload.compressed_size), ('', size))  # for nginx's gzip_static
+        self.assertTrue(os.path.exists('%s.gz' % upload.file.path))
+
+    def test_not_compressed(self, submit, connections):
+        upload = self.upload(os.urandom(200))  # cannot be compressed
+        self.assertEqual((upload.encoding, upload.compressed_size), ('', None))
+        self.assertEqual(os.listdir(os.path.dirname(upload.file.path)), ['example.txt'])
+        self.assertIsNone(compression.compress_upload(upload.pk))
+
+        with mock.patch('xmpp_http_upload.compression.mirrors.schedule') as schedule:
+            upload = self.upload(content_type='image/png')
+        schedule.assert_called_once_with(upload)
+        self.assertIsNone(upload.compressed_size)
+
+        self.assertIsNone(compression.compress_upload(0))
+
+    def test_moved(self, submit, connections):
+        upload = self.create()
+        compress = compression.compress
+
+        def move(*args):  # e.g. pushed to another node
+            Upload.objects.filter(pk=upload.pk).update(file='moved.txt')
+            return compress(*args)
+
+        with mock.patch('xmpp_http_upload.compression.compress', side_effect=move):
+            self.assertIsNone(compression.compress_upload(upload.pk))
+        self.assertEqual(os.listdir(os.path.dirname(upload.file.path)), ['example.txt'])
+        Upload.objects.filter(pk=upload.pk).update(file=upload.file.name)
+
+    def test_mirrors(self, submit, connections):
+        upload = self.create(mirrors=1)
+        with tempfile.TemporaryDirectory() as tempdir, \
+                self.settings(XMPP_HTTP_UPLOAD_MIRRORS={'roots': [tempdir]}):
+            copy = os.path.join(tempdir, upload.file.name)
+            os.makedirs(os.path.dirname(copy))
+            with open(copy, 'wb'):
+                pass
+
+            compression.compress_upload(upload.pk)
+            upload.refresh_from_db()
+            self.assertEqual(upload.mirrors, 1)
+            self.assertEqual(os.listdir(os.path.dirname(copy)), ['example.txt.gz'])
+            with upload.open_file() as stream:
+                self.assertEqual(stream.read(), self.content)
+            upload.remove_file()
+
+    def test_celery(self, submit, connections):
+        upload = self.create()
+        with self.settings(XMPP_HTTP_UPLOAD_COMPRESSION={'types': ['text/*'], 'backend': 'celery'}), \
+                mock.patch('xmpp_http_upload.tasks.compress_http_upload.delay') as delay:
+            compression.schedule(upload)
+        delay.assert_called_once_with(upload.pk, using='default')
+        submit.assert_not_called()
+
+        compress_http_upload(upload.pk, using='default')
+        upload.refresh_from_db()
+        self.assertEqual(upload.encoding, 'gzip')
+
+
+@override_settings(XMPP_HTTP_UPLOAD_WEBSERVER_DOWNLOAD=False)
+class TieringTestCase(TestCase):
+    content = b'compressible ' * 100
+
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch('xmpp_http_upload.tiering._buffer', AccessBuffer())
+        self.buffer = patcher.start()
+        self.addCleanup(patcher.stop)
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.root = os.path.join(tempdir.name, 'cold')
+        override = self.settings(XMPP_HTTP_UPLOAD_TIERING={'days': 30, 'root': self.root},
+                                 XMPP_HTTP_UPLOAD_REMOVE_DELAY=0)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def tearDown(self):
+        for upload in Upload.objects.all():
+            upload.remove_file()
+
+    def create(self, days=40, accessed=None, **kwargs):
+        upload = Upload.objects.create(jid=user_jid, name='example.txt', size=len(self.content),
+                                       hash=get_random_string(32), accessed=accessed,
+                                       uploaded=timezone.now() - timedelta(days=days), **kwargs)
+        upload.file.save(upload.name, ContentFile(self.content))
+        return upload
+
+    def test_touch(self):
+        upload = self.create()
+        self.assertEqual(b''.join(get(upload.get_absolute_url()).streaming_content), self.content)
+        get(upload.get_absolute_url())
+        self.assertEqual(self.buffer.pks, {None: {upload.pk}})
+        upload.refresh_from_db()
+        self.assertIsNone(upload.accessed)
+
+        with freeze_time('2020-01-01 12:00:00'):
+            self.assertEqual(self.buffer.flush(), 1)
+        upload.refresh_from_db()
+        self.assertEqual(upload.accessed, datetime(2020, 1, 1, 12, tzinfo=timezone.utc))
+        self.assertEqual(self.buffer.pks, {})
+
+        # recent downloads are not recorded again
+        with freeze_time('2020-01-01 12:59:00'):
+            tiering.touch(upload)
+        self.assertEqual(self.buffer.pks, {})
+
+        with self.settings(XMPP_HTTP_UPLOAD_TIERING={'days': 30}):
+            tiering.touch(upload)
+        self.assertEqual(self.buffer.pks, {None: {upload.pk}})
+        with self.settings(XMPP_HTTP_UPLOAD_TIERING={'days': 30, 'max_buffered': 1}):
+            tiering.touch(upload)
+        self.assertEqual(self.buffer.pks, {})
+        with self.settings(XMPP_HTTP_UPLOAD_TIERING={'days': 30, 'flush_interval': 0}):
+            upload._state.db = 'replica'  # read from a replica, written to the primary
+            upload.accessed = None
+            tiering.touch(upload)
+        self.assertEqual(self.buffer.pks, {})
+
+        with self.settings(XMPP_HTTP_UPLOAD_TIERING={}):
+            tiering.touch(upload)
+        self.assertEqual(self.buffer.pks, {})
+
+    def test_flush_error(self):
+        self.buffer.pks = {'unknown': {1}}
+        with self.assertLogs('xmpp_http_upload.tiering', 'ERROR'):
+            self.assertEqual(self.buffer.flush(), 0)
+
+    def test_tier(self):
+        cold = self.create()
+        accessed = self.create(accessed=timezone.now() - timedelta(days=1))
+        self.create(days=1)
+        old = self.create(accessed=timezone.now() - timedelta(days=40))
+        hot = cold.file.path
+
+        self.assertEqual(Tierer(batch_size=1).run(), {'moved': 2, 'failed': 0})
+        self.assertEqual(list(Upload.objects.filter(cold=True).order_by('pk')), [cold, old])
+        cold.refresh_from_db()
+        self.assertEqual(cold.path, os.path.join(self.root, cold.file.name))
+        self.assertFalse(os.path.exists(os.path.dirname(hot)))
+        self.assertEqual(b''.join(get(cold.get_absolute_url()).streaming_content), self.content)
+        self.assertFalse(accessed.cold)
+
+        directory = os.path.dirname(cold.path)
+        cold.remove_file()
+        self.assertFalse(os.path.exists(directory))
+        self.assertEqual(Tierer().run(), {'moved': 0, 'failed': 0})
+
+    @override_settings(XMPP_HTTP_UPLOAD_REMOVE_DELAY=60)
+    @mock.patch('xmpp_http_upload.utils.threading.Timer')
+    def test_remove_later(self, timer):
+        upload = self.create()
+        hot = upload.file.path
+
+        self.assertEqual(Tierer().run(), {'moved': 1, 'failed': 0})
+        timer.assert_called_once_with(60, remove_files, (hot, ))
+        timer.return_value.start.assert_called_once_with()
+        self.assertTrue(os.path.exists(hot))  # downloads that still use the hot file do not fail
+
+        remove_files(*timer.call_args[0][2])
+        self.assertFalse(os.path.exists(os.path.dirname(hot)))
+        remove_files(hot)  # files may be removed in the meantime
+
+    def test_compress(self):
+        upload = self.create(type='text/plain')
+        sidecar = self.create(type='text/plain')
+        compression.compress_stored(sidecar, keep_original=True)
+
+        with self.settings(XMPP_HTTP_UPLOAD_TIERING={'days': 30, 'root': self.root, 'compress': True}):
+            self.assertEqual(Tierer().run(), {'moved': 2, 'failed': 0})
+        upload.refresh_from_db()
+        self.assertEqual((upload.encoding, upload.cold), ('gzip', True))
+        self.assertEqual(upload.path, os.path.join(self.root, upload.file.name))
+        sidecar.refresh_from_db()
+        self.assertEqual(sorted(os.listdir(os.path.dirname(sidecar.path))), ['example.txt', 'example.txt.gz'])
+        for obj in (upload, sidecar):
+            response = get(obj.get_absolute_url(), HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), self.content)
+
+        # only compress uploads
+        upload = self.create()
+        with self.settings(XMPP_HTTP_UPLOAD_TIERING={'days': 30, 'compress': True}):
+            self.assertEqual(Tierer().run(), {'moved': 1, 'failed': 0})
+            upload.refresh_from_db()
+            self.assertEqual((upload.encoding, upload.cold), ('gzip', True))
+            self.assertEqual(upload.path, upload.file.path)
+
+    def test_removed(self):
+        upload = self.create()
+
+        def remove(source, target):  # removed while it was copied
+            Upload.objects.filter(pk=upload.pk).delete()
+            copy_file(source, target)
+
+        with mock.patch('xmpp_http_upload.mirrors.copy_file', side_effect=remove):
+            self.assertFalse(Tierer().tier(upload))
+        self.assertEqual(os.listdir(self.root), [os.path.dirname(os.path.dirname(upload.file.name))])
+        self.assertTrue(os.path.exists(upload.file.path))
+        upload.remove_file()
+
+    def test_error(self):
+        upload = self.create()
+        with open(self.root, 'w'):  # a file instead of a directory
+            pass
+        with self.assertLogs('xmpp_http_upload.tiering', 'ERROR'):
+            self.assertEqual(Tierer().run(), {'moved': 0, 'failed': 1})
+        self.assertTrue(os.path.exists(upload.file.path))
+        os.remove(self.root)
+
+    def test_mirrors(self):
+        upload = self.create()
+        with tempfile.TemporaryDirectory() as tempdir, \
+                self.settings(XMPP_HTTP_UPLOAD_MIRRORS={'roots': [tempdir]}):
+            self.assertEqual(Tierer().run(), {'moved': 1, 'failed': 0})
+            upload.refresh_from_db()
+            self.assertEqual(upload.mirrors, 1)
+            upload.remove_file()
+
+    def test_command(self):
+        self.create(days=10)
+        stdout = StringIO()
+        call_command('tier_http_uploads', verbosity=2, stdout=stdout)
+        call_command('tier_http_uploads', '--days=5', '--batch-size=10', '--bytes-per-second=1M',
+                     stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'Moved 0 uploads to cold storage, 0 failed.\n')
+        self.assertTrue(Upload.objects.get().cold)
+
+        tier_http_uploads()
+        with self.settings(XMPP_HTTP_UPLOAD_TIERING={}):
+            self.assertEqual(Tierer().run(), {'moved': 0, 'failed': 0})
+            with self.assertRaises(CommandError):
+                call_command('tier_http_uploads')
+
+
+@override_settings(XMPP_HTTP_UPLOAD_WEBSERVER_DOWNLOAD=False)
+class OffloadTestCase(TestCase):
+    content = b'example content'
+    sha256 = hashlib.sha256(content).hexdigest()
+
+    def setUp(self):
+        cache.clear()
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.directory = os.path.join(tempdir.name, 'body')
+        os.makedirs(os.path.join(self.directory, '1'))
+        self.path = os.path.join(self.directory, '1', '0000000001')
+        with open(self.path, 'wb') as stream:
+            stream.write(self.content)
+        override = self.settings(XMPP_HTTP_UPLOAD_OFFLOAD={'directory': self.directory, 'secret': 'secret'})
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def tearDown(self):
+        for upload in Upload.objects.all():
+            upload.remove_file()
+
+    def put(self, path=None, size=None, secret='secret', **kwargs):
+        slot = Slot.objects.create(jid=user_jid, name='example.txt', size=size or len(self.content),
+                                   hash=get_random_string(32), **kwargs)
+        # nginx does not pass the body and clears the Content-Length header
+        return Client().put(slot.get_absolute_url(), b'', content_type='application/octet-stream',
+                            HTTP_X_UPLOAD_FILE=path or self.path, HTTP_X_UPLOAD_SECRET=secret)
+
+    def test_put(self):
+        response = self.put()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response['ETag'], '"%s"' % self.sha256)
+        self.assertFalse(os.path.exists(self.path))  # moved to its final location
+
+        upload = Upload.objects.get()
+        self.assertEqual(upload.sha256, self.sha256)
+        with upload.open_file() as stream:
+            self.assertEqual(stream.read(), self.content)
+
+    def test_not_offloaded(self):
+        slot = Slot.objects.create(jid=user_jid, name='example.txt', size=len(self.content),
+                                   hash=get_random_string(32))
+        response = Client().put(slot.get_absolute_url(), self.content,
+                                content_type='application/octet-stream')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Upload.objects.get().sha256, self.sha256)
+
+        # the header is ignored if offloading is disabled
+        with self.settings(XMPP_HTTP_UPLOAD_OFFLOAD={}):
+            response = self.put()
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_custom_header(self):
+        slot = Slot.objects.create(jid=user_jid, name='example.txt', size=len(self.content),
+                                   hash=get_random_string(32))
+        config = {'directory': self.directory, 'header': 'X-Body-File', 'secret': 'secret',
+                  'secret_header': 'X-Body-Secret'}
+        with self.settings(XMPP_HTTP_UPLOAD_OFFLOAD=config):
+            response = Client().put(slot.get_absolute_url(), b'', content_type='application/octet-stream',
+                                    HTTP_X_BODY_FILE=self.path, HTTP_X_BODY_SECRET='secret')
+        self.assertEqual(response.status_code, 201)
+
+    def test_secret(self):
+        # the header may be sent by the client, e.g. to take over the body of another upload
+        for secret in ('', 'wrong'):
+            response = self.put(secret=secret)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.content, b'Invalid request body file.')
+
+        # offloading requires a secret
+        with self.settings(XMPP_HTTP_UPLOAD_OFFLOAD={'directory': self.directory}):
+            self.assertEqual(self.put(secret='').status_code, 400)
+        self.assertFalse(Upload.objects.exists())
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_no_verify(self):
+        with self.settings(XMPP_HTTP_UPLOAD_OFFLOAD={'directory': self.directory, 'secret': 'secret',
+                                                     'verify': False}):
+            response = self.put()
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn('ETag', response)
+        self.assertIsNone(Upload.objects.get().sha256)
+
+    def test_no_verify_with_digest(self):
+        with self.settings(XMPP_HTTP_UPLOAD_OFFLOAD={'directory': self.directory, 'secret': 'secret',
+                                                     'verify': False}):
+            response = self.put(sha256='0' * 64)  # the client is trusted
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Upload.objects.get().sha256, '0' * 64)
+
+    def test_digest_mismatch(self):
+        response = self.put(sha256='0' * 64)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Upload.objects.exists())
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_size_mismatch(self):
+        response = self.put(size=len(self.content) + 1)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.content.decode('utf-8'),
+                         'File size (15) does not match requested size (16).')
+        self.assertFalse(Upload.objects.exists())
+
+    def test_missing_file(self):
+        response = self.put(path=os.path.join(self.directory, 'missing'))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.content, b'Request body file does not exist.')
+
+    def test_outside_directory(self):
+        for path in (self.directory, os.path.join(self.directory, '..', 'other'), '/etc/passwd'):
+            response = self.put(path=path)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.content, b'Invalid request body file.')
+        self.assertFalse(Upload.objects.exists())
+
+    @override_settings(XMPP_HTTP_UPLOAD_PACKS={'max_size': 100})
+    @mock.patch('xmpp_http_upload.packs._writer', PackWriter())
+    def test_packed(self):
+        self.addCleanup(shutil.rmtree, packs.get_storage().path(packs.get_directory()), ignore_errors=True)
+        self.assertEqual(self.put().status_code, 201)
+        self.assertFalse(os.path.exists(self.path))
+        upload = Upload.objects.get()
+        self.assertIsNotNone(upload.offset)
+        with upload.open_file() as stream:
+            self.assertEqual(stream.read(), self.content)
+
+
+@override_settings(XMPP_HTTP_UPLOAD_ACCESS=[(r'^blocked@', False), ('.*', {'max_file_size': 100})])
+class FastPathTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.application = get_fast_path_application()
+
+    def request(self, path, **params):
+        environ = RequestFactory().get(path, params).environ
+        environ['wsgi.input'] = BytesIO()
+        result = {}
+
+        def start_response(status, headers):
+            result.update(status=status, headers=dict(headers))
+
+        response = self.application(environ, start_response)
+        content = b''.join(response)
+        response.close()
+        return result['status'], result['headers'], content.decode('utf-8')
+
+    def test_slot(self):
+        status, headers, content = self.request('/http_upload/slot/', jid=user_jid, name='example.txt',
+                                                size=10)
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['Content-Type'], 'text/plain')
+        slot = Slot.objects.get()
+        self.assertEqual(content.split()[0], 'http://testserver%s' % slot.get_absolute_url())
+
+        status, headers, content = self.request('/http_upload/slot/', jid='blocked@example.com',
+                                                name='example.txt', size=10)
+        self.assertEqual(status, '403 Forbidden')
+        self.assertEqual(Slot.objects.count(), 1)
+
+    def test_max_size(self):
+        status, headers, content = self.request('/http_upload/max_size/', jid=user_jid)
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(content, '100')
+
+    def test_prefix(self):
+        self.application = FastPathHandler(prefix='/')
+        self.assertEqual(self.request('/max_size/', jid=user_jid)[0], '200 OK')
+        self.assertEqual(self.request('/http_upload/max_size/', jid=user_jid)[0], '404 Not Found')
+
+    def test_not_found(self):
+        status, headers, content = self.request('/http_upload/share/', jid=user_jid)
+        self.assertEqual(status, '404 Not Found')
+
+    def test_exception(self):
+        with self.settings(ALLOWED_HOSTS=['example.com']):  # build_absolute_uri() raises DisallowedHost
+            status, headers, content = self.request('/http_upload/slot/', jid=user_jid, name='example.txt',
+                                                    size=10)
+        self.assertEqual(status, '400 Bad Request')
+
+
+@override_settings(XMPP_HTTP_UPLOAD_WEBSERVER_DOWNLOAD=False, XMPP_HTTP_UPLOAD_METADATA={'enabled': True})
+class MetadataTestCase(TestCase):
+    content = b'example content'
+    sha256 = hashlib.sha256(content).hexdigest()
+
+    def setUp(self):
+        cache.clear()
+
+    def tearDown(self):
+        for upload in Upload.objects.all():
+            upload.remove_file()
+
+    def put(self, name='example.txt'):
+        slot = Slot.objects.create(jid=user_jid, name=name, size=len(self.content), type='text/plain',
+                                   hash=get_random_string(32))
+        response = Client().put(slot.get_absolute_url(), self.content, content_type='text/plain')
+        self.assertEqual(response.status_code, 201)
+        return Upload.objects.get(hash=slot.hash)
+
+    def assertServed(self, upload, queries=0):
+        with self.assertNumQueries(queries):
+            response = get(upload.get_absolute_url())
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b''.join(response.streaming_content), self.content)
+            response.close()
+        self.assertEqual(response['Content-Type'], 'text/plain')
+        self.assertEqual(response['ETag'], '"%s"' % self.sha256)
+
+    def test_xattrs(self):
+        upload = self.put()
+        self.assertFalse(os.path.exists('%s.meta' % upload.path))
+        self.assertEqual(metadata.read(upload.path), {
+            'id': upload.pk, 'db': 'default', 'jid': user_jid, 'type': 'text/plain',
+            'size': len(self.content), 'sha256': self.sha256,
+            'expires': int(upload.created.timestamp()) + 86400 * 30,
+        })
+        self.assertServed(upload)
+
+        with self.settings(XMPP_HTTP_UPLOAD_METADATA={'enabled': False}):
+            self.assertServed(upload, queries=1)
+
+    @override_settings(XMPP_HTTP_UPLOAD_METADATA={'enabled': True, 'xattrs': False})
+    def test_sidecar(self):
+        upload = self.put()
+        sidecar = '%s.meta' % upload.path
+        self.assertTrue(os.path.exists(sidecar))
+        self.assertEqual(metadata.read(upload.path)['id'], upload.pk)
+        self.assertServed(upload)
+
+        directory = os.path.dirname(upload.path)
+        upload.remove_file()
+        self.assertFalse(os.path.exists(directory))
+        self.assertEqual(get(upload.get_absolute_url()).status_code, 404)
+
+    @override_settings(XMPP_HTTP_UPLOAD_METADATA={'enabled': True, 'xattrs': False})
+    def test_admin_delete(self):
+        client = Client()
+        client.force_login(User.objects.create_superuser(username='u', password='p', email='u@example.com'))
+        upload = self.put()
+        url = reverse('admin:xmpp_http_upload_upload_delete', kwargs={'object_id': upload.pk})
+        self.assertEqual(client.post(url, {'post': 'yes'}).status_code, 302)
+        self.assertFalse(Upload.objects.exists())
+        self.assertFalse(os.path.exists(os.path.dirname(upload.path)))
+        self.assertEqual(get(upload.get_absolute_url()).status_code, 404)
+
+        upload = self.put()
+        UploadAdmin(Upload, admin.site).delete_queryset(None, Upload.objects.all())
+        self.assertFalse(Upload.objects.exists())
+        self.assertFalse(os.path.exists(os.path.dirname(upload.path)))
+        self.assertEqual(get(upload.get_absolute_url()).status_code, 404)
+
+    @override_settings(XMPP_HTTP_UPLOAD_METADATA={'enabled': True, 'xattrs': False})
+    def test_webserver_download(self):
+        # the web server would serve the sidecar file with the JID of the uploader
+        with self.settings(XMPP_HTTP_UPLOAD_WEBSERVER_DOWNLOAD=True):
+            upload = self.put()
+            self.assertFalse(metadata.enabled())
+        self.assertFalse(os.path.exists('%s.meta' % upload.path))
+        self.assertIsNone(metadata.read(upload.path))
+        self.assertServed(upload, queries=1)
+
+    def test_xattrs_not_supported(self):
+        with mock.patch('os.setxattr', side_effect=OSError(errno.ENOTSUP, 'not supported')):
+            upload = self.put()
+        self.assertTrue(os.path.exists('%s.meta' % upload.path))
+        self.assertServed(upload)
+
+    def test_write_error(self):
+        with mock.patch('os.setxattr', side_effect=OSError(errno.EACCES, 'denied')), \
+                self.assertLogs('xmpp_http_upload.metadata', 'ERROR'):
+            upload = self.put()
+        self.assertIsNone(metadata.read(upload.path))
+        self.assertServed(upload, queries=1)
+
+    def test_disabled(self):
+        with self.settings(XMPP_HTTP_UPLOAD_METADATA={}):
+            upload = self.put()
+        self.assertIsNone(metadata.read(upload.path))
+        self.assertServed(upload, queries=1)
+
+    def test_other_name(self):
+        upload = self.put()
+        upload.file.name = os.path.join(os.path.dirname(upload.file.name), 'other.txt')
+        metadata.write(upload)
+        self.assertIsNone(metadata.read(upload.path))
+
+    @override_settings(XMPP_HTTP_UPLOAD_METADATA={'enabled': True, 'xattrs': False})
+    def test_invalid(self):
+        upload = self.put()
+        with open('%s.meta' % upload.path, 'wb') as stream:
+            stream.write(b'{"id": ')
+        self.assertIsNone(metadata.read(upload.path))
+        self.assertServed(upload, queries=1)
+
+    def test_expired(self):
+        upload = self.put()
+        with freeze_time(timezone.now() + timedelta(days=31)):
+            self.assertIsNone(metadata.load(upload.hash, upload.name))
+
+    def test_size_mismatch(self):
+        upload = self.put()
+        with open(upload.path, 'ab') as stream:
+            stream.write(b'appended')
+        self.assertIsNone(metadata.load(upload.hash, upload.name))
+
+    def test_missing_file(self):
+        upload = self.put()
+        data = metadata.read(upload.path)
+        with mock.patch('xmpp_http_upload.metadata.read', return_value=data):
+            os.remove(upload.path)
+            self.assertIsNone(metadata.load(upload.hash, upload.name))
+
+    def test_load(self):
+        upload = self.put()
+        loaded = metadata.load(upload.hash, upload.name)
+        self.assertEqual(loaded, upload)
+        self.assertEqual(loaded.path, upload.path)
+        self.assertEqual((loaded.jid, loaded.size, loaded.sha256), (user_jid, upload.size, self.sha256))
+        self.assertFalse(loaded._state.adding)
+
+    @override_settings(XMPP_HTTP_UPLOAD_COMPRESSION={'types': ['text/*'], 'min_size': 0, 'max_ratio': 10})
+    def test_compressed(self):
+        upload = self.put()
+        compression.compress_stored(upload, keep_original=True, max_ratio=10)
+        self.assertIsNone(metadata.read(upload.path))
+        self.assertIsNone(metadata.load(upload.hash, upload.name))
+
+        metadata.write(upload)  # compressed uploads never get metadata
+        self.assertIsNone(metadata.read(upload.path))
+
+    def test_cold(self):
+        upload = self.put()
+        with tempfile.TemporaryDirectory() as root, \
+                self.settings(XMPP_HTTP_UPLOAD_TIERING={'days': 30, 'root': root}):
+            self.assertTrue(Tierer().tier(upload))
+            upload.refresh_from_db()
+            self.assertIsNone(metadata.load(upload.hash, upload.name))
+            metadata.write(upload)  # cold uploads never get metadata
+            self.assertIsNone(metadata.read(upload.path))
+            upload.remove_file()
+
+    @override_settings(XMPP_HTTP_UPLOAD_PACKS={'max_size': 100})
+    @mock.patch('xmpp_http_upload.packs._writer', PackWriter())
+    def test_packed(self):
+        self.addCleanup(shutil.rmtree, packs.get_storage().path(packs.get_directory()), ignore_errors=True)
+        upload = self.put()
+        self.assertIsNotNone(upload.offset)
+        self.assertIsNone(metadata.load(upload.hash, upload.name))
+
+
+stage_calls = []
+
+
+def first_stage(upload):
+    """Stage of the post-upload pipeline used in tests."""
+    stage_calls.append(('first', upload.pk))
+
+
+def second_stage(upload):
+    """Stage of the post-upload pipeline used in tests."""
+    stage_calls.append(('second', upload.pk))
+
+
+@override_settings(XMPP_HTTP_UPLOAD_PIPELINE={
+    'stages': ['xmpp_http_upload.tests.first_stage', 'xmpp_http_upload.tests.second_stage'],
+    'max_attempts': 2, 'retry_delay': 10})
+@mock.patch('xmpp_http_upload.utils.connections')
+@mock.patch('xmpp_http_upload.pipeline._executor.executor.submit', side_effect=run_now)
+class PipelineTestCase(TestCase):
+    content = b'example content'
+
+    def setUp(self):
+        cache.clear()
+        stage_calls.clear()
+
+    def tearDown(self):
+        for upload in Upload.objects.all():
+            upload.remove_file()
+
+    def create(self):
+        upload = Upload.objects.create(jid=user_jid, name='example.txt', size=len(self.content),
+                                       hash=get_random_string(32), uploaded=timezone.now())
+        upload.file.save(upload.name, ContentFile(self.content))
+        return upload
+
+    def test_put(self, submit, connections):
+        url = Slot.objects.create(jid=user_jid, name='example.txt', size=len(self.content),
+                                  hash=get_random_string(32)).get_absolute_url()
+        with mock.patch('django.db.transaction.on_commit', side_effect=lambda func, using: func()):
+            self.assertEqual(put(url, self.content).status_code, 201)
+        upload = Upload.objects.get()
+        self.assertEqual(stage_calls, [('first', upload.pk), ('second', upload.pk)])
+        self.assertFalse(UploadEvent.objects.exists())
+        connections.close_all.assert_called_once_with()
+
+    def test_put_without_commit(self, submit, connections):
+        url = Slot.objects.create(jid=user_jid, name='example.txt', size=len(self.content),
+                                  hash=get_random_string(32)).get_absolute_url()
+        self.assertEqual(put(url, self.content).status_code, 201)  # the test transaction is never committed
+        self.assertEqual(stage_calls, [])
+        self.assertEqual(UploadEvent.objects.get().upload_pk, Upload.objects.get().pk)
+
+    def test_no_stages(self, submit, connections):
+        with self.settings(XMPP_HTTP_UPLOAD_PIPELINE={}):
+            self.assertIsNone(pipeline.create_event(self.create()))
+        self.assertFalse(UploadEvent.objects.exists())
+
+    def test_retry(self, submit, connections):
+        upload = self.create()
+        event = pipeline.create_event(upload)
+        with mock.patch('xmpp_http_upload.tests.second_stage', side_effect=OSError('boom')), \
+                mock.patch('xmpp_http_upload.pipeline.threading.Timer') as timer, \
+                self.assertLogs('xmpp_http_upload.pipeline', 'ERROR'):
+            self.assertFalse(pipeline.process(event.pk))
+        timer.assert_called_once_with(10, pipeline._executor.submit, (pipeline.process, event.pk, None))
+        timer.return_value.start.assert_called_once_with()
+
+        event.refresh_from_db()
+        self.assertEqual((event.stage, event.attempts, event.failed), (1, 1, False))
+        self.assertEqual(event.error, 'xmpp_http_upload.tests.second_stage: boom')
+        self.assertIsNone(pipeline.process(event.pk))  # not due yet
+
+        # the retry continues with the failed stage
+        with freeze_time(timezone.now() + timedelta(seconds=11)):
+            self.assertTrue(pipeline.process(event.pk))
+        self.assertEqual(stage_calls, [('first', upload.pk), ('second', upload.pk)])
+        self.assertFalse(UploadEvent.objects.exists())
+
+    def test_max_attempts(self, submit, connections):
+        event = pipeline.create_event(self.create())
+        with mock.patch('xmpp_http_upload.tests.first_stage', side_effect=Exception('boom')), \
+                mock.patch('xmpp_http_upload.pipeline.threading.Timer') as timer, \
+                self.assertLogs('xmpp_http_upload.pipeline', 'ERROR'):
+            self.assertFalse(pipeline.process(event.pk))
+            with freeze_time(timezone.now() + timedelta(seconds=11)):
+                self.assertFalse(pipeline.process(event.pk))
+        self.assertEqual(timer.call_count, 1)  # no retry after the last attempt
+
+        event.refresh_from_db()
+        self.assertEqual((event.stage, event.attempts, event.failed), (0, 2, True))
+        with freeze_time(timezone.now() + timedelta(days=1)):
+            self.assertIsNone(pipeline.process(event.pk))
+            self.assertEqual(pipeline.run_pending(), {'processed': 0, 'failed': 0})
+
+    def test_claim(self, submit, connections):
+        event = pipeline.create_event(self.create())
+        self.assertEqual(pipeline.claim(event.pk, timeout=60), event)
+        self.assertIsNone(pipeline.claim(event.pk))  # processed by another worker
+        self.assertIsNone(pipeline.process(event.pk))
+        with freeze_time(timezone.now() + timedelta(seconds=61)):  # the worker died
+            self.assertTrue(pipeline.process(event.pk))
+
+    def test_removed_upload(self, submit, connections):
+        upload = self.create()
+        event = pipeline.create_event(upload)
+        upload.remove_file()
+        upload.delete()
+        self.assertIsNone(pipeline.process(event.pk))
+        self.assertFalse(UploadEvent.objects.exists())
+
+        UploadEvent.objects.create(upload_pk=event.upload_pk)
+        self.assertEqual(pipeline.run_pending(), {'processed': 0, 'failed': 0})
+        self.assertFalse(UploadEvent.objects.exists())
+
+    def test_run_pending(self, submit, connections):
+        uploads = [self.create() for i in range(3)]
+        for upload in uploads:
+            pipeline.create_event(upload)
+
+        with mock.patch('xmpp_http_upload.tests.second_stage', side_effect=[None, OSError('boom'), None]), \
+                mock.patch('xmpp_http_upload.pipeline.threading.Timer'), \
+                self.assertLogs('xmpp_http_upload.pipeline', 'ERROR'):
+            self.assertEqual(pipeline.run_pending(batch_size=2), {'processed': 2, 'failed': 1})
+        self.assertEqual(UploadEvent.objects.get().upload_pk, uploads[1].pk)
+
+    def test_command(self, submit, connections):
+        upload = self.create()
+        pipeline.create_event(upload)
+        stdout = StringIO()
+        call_command('process_http_upload_events', verbosity=2, stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'Processed 1 uploads, 0 failed.\n')
+        self.assertEqual(stage_calls, [('first', upload.pk), ('second', upload.pk)])
+
+        call_command('process_http_upload_events', stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'Processed 1 uploads, 0 failed.\n')
+
+    def test_celery(self, submit, connections):
+        config = dict(settings.XMPP_HTTP_UPLOAD_PIPELINE, backend='celery')
+        with self.settings(XMPP_HTTP_UPLOAD_PIPELINE=config), \
+                mock.patch('xmpp_http_upload.tasks.process_http_upload_event.apply_async') as apply_async:
+            pipeline.schedule(1, 'shard', countdown=5)
+        apply_async.assert_called_once_with((1, ), {'using': 'shard'}, countdown=5)
+        submit.assert_not_called()
+
+    def test_tasks(self, submit, connections):
+        upload = self.create()
+        event = pipeline.create_event(upload)
+        process_http_upload_event(event.pk)
+        self.assertEqual(len(stage_calls), 2)
+
+        pipeline.create_event(upload)
+        process_http_upload_events()
+        self.assertEqual(len(stage_calls), 4)
+        self.assertFalse(UploadEvent.objects.exists())
 
 
 @override_settings(XMPP_HTTP_UPLOAD_ACCESS=[
@@ -409,14 +2613,18 @@ class MaxSizeViewTest(TestCase):
 
 
 class UploadTest(TestCase):
+    def setUp(self):
+        cache.clear()  # rate limits are counted in the cache
+
     def request_slot(self, filename, size, **kwargs):
         response = slot(jid=user_jid, name=filename, size=size, **kwargs)
         self.assertEquals(response.status_code, 200)
-        self.assertEquals(Upload.objects.count(), 1)
+        self.assertEquals(Slot.objects.count(), 1)
         return response.content.decode('utf-8').split()
 
     def assertUpload(self, filename, content, delete=True, content_type=None):
         # First request a slot
+        self.assertEquals(Slot.objects.count(), 0)
         self.assertEquals(Upload.objects.count(), 0)
         slot_kwargs = {}
         if content_type:
@@ -430,9 +2638,11 @@ class UploadTest(TestCase):
             put_kwargs['content_type'] = content_type
         response = put(put_path, content, **put_kwargs)
         self.assertEquals(response.status_code, 201)
+        self.assertEquals(Slot.objects.count(), 0)  # the slot was replaced by the upload
 
         # Get the object, verify that the same URLs are generated
-        upload = Upload.objects.all()[0]  # we verified there is exactly one above
+        upload = Upload.objects.get()
+        self.assertIsNotNone(upload.uploaded)
         try:
             self.assertEqual((put_url, get_url), upload.get_urls(response.wsgi_request))
 
@@ -511,34 +2721,405 @@ class UploadTest(TestCase):
         filename = 'example.jpg'
         content = 'foobar'
         put_url, get_url = self.request_slot(filename, size=len(content), type='text/plain')
-        upload = Upload.objects.first()
-        self.assertEqual(upload.file.name, '')
+        upload = Slot.objects.first()
+        self.assertFalse(Upload.objects.exists())
         self.assertEqual(upload.type, 'text/plain')
 
         false_put_url = reverse('xmpp-http-upload:share', kwargs={'hash': 'f' * 32, 'filename': filename})
         put_path = urlsplit(false_put_url).path
         response = put(put_path, content)
         self.assertEquals(response.status_code, 403)
-        upload = Upload.objects.get(pk=upload.pk)
-        self.assertEqual(upload.file.name, '')
+        Slot.objects.get(pk=upload.pk)  # slot still exists
+        self.assertFalse(Upload.objects.exists())
         self.assertEqual(response.content, b'')
 
         put_path = urlsplit(put_url).path
         response = put(put_path, content + 'foobar')
         self.assertEquals(response.status_code, 400)
-        upload = Upload.objects.get(pk=upload.pk)
-        self.assertEqual(upload.file.name, '')
+        Slot.objects.get(pk=upload.pk)  # slot still exists
+        self.assertFalse(Upload.objects.exists())
         self.assertEqual(response.content, b'File size (12) does not match requested size (6).')
 
         put_path = urlsplit(put_url).path
         response = put(put_path, content)
         self.assertEquals(response.status_code, 400)
-        upload = Upload.objects.get(pk=upload.pk)
-        self.assertEqual(upload.file.name, '')
+        Slot.objects.get(pk=upload.pk)  # slot still exists
+        self.assertFalse(Upload.objects.exists())
         self.assertEqual(response.content,
                          b'Content type (application/octet-stream) does not match requested type.')
 
 
+@override_settings(XMPP_HTTP_UPLOAD_WEBSERVER_DOWNLOAD=False, XMPP_HTTP_UPLOAD_ACCESS=[
+    (r'^user@example\.com$', {'max_concurrent_uploads': 1, 'upload_bandwidth': 4, 'download_bandwidth': 4}),
+])
+class UserLimitsTestCase(TestCase):
+    jid = 'user@example.com'
+    content = b'0123456789'
+
+    def setUp(self):
+        cache.clear()
+        self.slot = Slot.objects.create(jid=self.jid, name='example.txt', size=len(self.content),
+                                        hash=get_random_string(32))
+        self.url = self.slot.get_absolute_url()
+
+    def tearDown(self):
+        for upload in Upload.objects.all():
+            upload.remove_file()
+
+    def test_max_concurrent_uploads(self):
+        admission = Admission(10, jid=self.jid, max_uploads=1)
+        self.assertTrue(admission.acquire())
+
+        response = put(self.url, self.content)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '30')
+
+        # other users are not affected
+        self.assertTrue(Admission(10, jid=user_jid, max_uploads=1).acquire())
+
+        admission.release()
+        self.assertEqual(put(self.url, self.content).status_code, 201)
+        self.assertTrue(admission.acquire())  # the upload was released
+
+    @mock.patch('xmpp_http_upload.utils.time')
+    def test_bandwidth(self, time):
+        time.monotonic.return_value = 100
+        time.time.return_value = 100.5
+        self.assertEqual(put(self.url, self.content).status_code, 201)
+        time.sleep.assert_called_once_with(1.5)
+
+        time.sleep.reset_mock()
+        response = get(self.url)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response.filename, 'example.txt')
+        time.sleep.assert_called_once_with(2.0)
+
+        # the bandwidth is shared by all downloads of the user
+        time.sleep.reset_mock()
+        response = get(self.url)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        time.sleep.assert_called_once_with(4.5)
+
+        # cache is not available, so the download is limited on its own
+        time.sleep.reset_mock()
+        with mock.patch('xmpp_http_upload.utils.get_cache', side_effect=Exception('down')), \
+                self.assertLogs('xmpp_http_upload.utils', level='ERROR') as logs:
+            response = get(self.url)
+            self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(len(logs.output), 1)
+        time.sleep.assert_called_once_with(1.5)
+
+    @mock.patch('xmpp_http_upload.utils.time')
+    def test_file_wrapper(self, time):
+        time.monotonic.return_value = 100
+        time.time.return_value = 100
+        self.assertEqual(put(self.url, self.content).status_code, 201)
+        time.sleep.reset_mock()
+
+        wrapped = []
+
+        def file_wrapper(filelike, block_size):
+            # WSGI servers use sendfile() if the file has a file descriptor
+            wrapped.append((hasattr(filelike, 'fileno'), block_size))
+            return FileWrapper(filelike, block_size)
+
+        environ = RequestFactory().get(self.url).environ
+        environ['wsgi.input'] = BytesIO()
+        environ['wsgi.file_wrapper'] = file_wrapper
+        response = WSGIHandler()(environ, lambda status, headers: None)
+        self.assertEqual(b''.join(response), self.content)
+        response.close()
+        self.assertEqual(wrapped, [(False, 64 * 1024)])
+        time.sleep.assert_called_once_with(2.5)
+
+    @override_settings(XMPP_HTTP_UPLOAD_PROGRESSIVE_DOWNLOAD=True)
+    @mock.patch('xmpp_http_upload.utils.time')
+    def test_progressive_bandwidth(self, time):
+        time.monotonic.return_value = 100
+        self.assertEqual(put(self.url, self.content).status_code, 201)
+        time.sleep.assert_called_once_with(1.5)
+
+        # another upload that is still in progress
+        slot = Slot.objects.create(jid=self.jid, name='example.txt', size=len(self.content),
+                                   hash=get_random_string(32))
+        os.makedirs(os.path.dirname(slot.get_partial_path()))
+        with open(slot.get_partial_path(), 'wb') as stream:
+            stream.write(self.content)
+
+        time.sleep.reset_mock()
+        time.time.return_value = 100
+        response = get(slot.get_absolute_url())
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        time.sleep.assert_called_once_with(2.5)
+
+        os.remove(slot.get_partial_path())
+        os.rmdir(os.path.dirname(slot.get_partial_path()))
+
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=5)
+    def test_temporary_file(self):
+        self.assertEqual(put(self.url, self.content).status_code, 201)
+        self.assertEqual(Upload.objects.get().file.read(), self.content)
+
+    def test_incomplete_body(self):
+        response = Client().put(self.url, b'', content_type='application/octet-stream', CONTENT_LENGTH='10',
+                                **{'wsgi.input': BytesIO(b'01234')})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.content, b'Could not read post request.')
+        self.assertTrue(Admission(10, jid=self.jid, max_uploads=1).acquire())  # the upload was released
+
+
+@override_settings(XMPP_HTTP_UPLOAD_WEBSERVER_DOWNLOAD=False)
+class DigestTestCase(TestCase):
+    content = b'example content'
+    sha256 = hashlib.sha256(content).hexdigest()
+
+    def setUp(self):
+        cache.clear()
+
+    def tearDown(self):
+        for upload in Upload.objects.all():
+            upload.remove_file()
+
+    def put(self, **kwargs):
+        response = slot(jid=user_jid, name='example.txt', size=len(self.content), **kwargs)
+        self.assertEqual(response.status_code, 200)
+        put_url = response.content.decode('utf-8').split()[0]
+        return Client().put(urlsplit(put_url).path, self.content, content_type='application/octet-stream')
+
+    def put_with_header(self, header, value):
+        slot = Slot.objects.create(jid=user_jid, name='example.txt', size=len(self.content),
+                                   hash=get_random_string(32))
+        return Client().put(slot.get_absolute_url(), self.content, content_type='application/octet-stream',
+                            **{header: value})
+
+    def test_digest(self):
+        response = self.put()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response['ETag'], '"%s"' % self.sha256)
+        upload = Upload.objects.get()
+        self.assertEqual(upload.sha256, self.sha256)
+
+        # downloads use the digest as ETag
+        response = get(upload.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], '"%s"' % self.sha256)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+        response = get(upload.get_absolute_url(), HTTP_IF_NONE_MATCH='"%s"' % self.sha256)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], '"%s"' % self.sha256)
+
+        response = get(upload.get_absolute_url(), HTTP_IF_NONE_MATCH='"%s"' % ('0' * 64))
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+        response = get(upload.get_absolute_url(), HTTP_IF_MATCH='"%s"' % ('0' * 64))
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(response['ETag'], '"%s"' % self.sha256)
+
+        response = get(upload.get_absolute_url(), HTTP_IF_MATCH='"%s"' % self.sha256)
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+    def test_no_digest(self):
+        # files uploaded before digests were computed
+        upload = Upload.objects.create(jid=user_jid, name='example.txt', size=len(self.content),
+                                       hash=get_random_string(32))
+        upload.file.save(upload.name, ContentFile(self.content))
+
+        response = get(upload.get_absolute_url(), HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response)
+        response.close()
+
+    def test_slot_digest(self):
+        self.assertEqual(self.put(sha256=self.sha256.upper()).status_code, 201)
+        self.assertEqual(Upload.objects.get().sha256, self.sha256)
+
+    def test_slot_digest_mismatch(self):
+        response = self.put(sha256='0' * 64)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.content.decode('utf-8'),
+                         'SHA-256 digest (%s) does not match expected digest (%s).' % (self.sha256, '0' * 64))
+        self.assertFalse(Upload.objects.exists())
+
+    def test_invalid_slot_digest(self):
+        response = slot(jid=user_jid, name='example.txt', size=10, sha256='foo')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Slot.objects.exists())
+
+    def test_content_digest_header(self):
+        digest = base64.b64encode(hashlib.sha256(self.content).digest()).decode('ascii')
+        response = self.put_with_header('HTTP_CONTENT_DIGEST', 'sha-512=:Zm9v:, sha-256=:%s:' % digest)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Upload.objects.get().sha256, self.sha256)
+
+    def test_digest_header(self):
+        digest = base64.b64encode(hashlib.sha256(b'other content').digest()).decode('ascii')
+        response = self.put_with_header('HTTP_DIGEST', 'SHA-256=%s' % digest)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Upload.objects.exists())
+
+    def test_csrf(self):
+        slot = Slot.objects.create(jid=user_jid, name='example.txt', size=len(self.content),
+                                   hash=get_random_string(32))
+        client = Client(enforce_csrf_checks=True)
+        response = client.put(slot.get_absolute_url(), self.content, content_type='application/octet-stream')
+        self.assertEqual(response.status_code, 201)
+
+    def test_invalid_digest_header(self):
+        response = self.put_with_header('HTTP_DIGEST', 'SHA-256=foo')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.content, b'Invalid digest header.')
+
+
+@override_settings(XMPP_HTTP_UPLOAD_WEBSERVER_DOWNLOAD=False, XMPP_HTTP_UPLOAD_PROGRESSIVE_DOWNLOAD=True,
+                   XMPP_HTTP_UPLOAD_PROGRESSIVE_TIMEOUT=5)
+class ProgressiveDownloadTestCase(TestCase):
+    content = b'0123456789'
+
+    def setUp(self):
+        cache.clear()
+        self.slot = Slot.objects.create(jid=user_jid, name='exa mple.txt', size=len(self.content),
+                                        hash=get_random_string(32))
+        self.url = self.slot.get_absolute_url()
+        self.path = self.slot.get_partial_path()
+
+    def tearDown(self):
+        for upload in Upload.objects.all():
+            upload.remove_file()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def start_upload(self, content):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'wb') as stream:
+            stream.write(content)
+
+    def test_upload(self):
+        self.assertEqual(put(self.url, self.content).status_code, 201)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(Upload.objects.get().file.read(), self.content)
+        self.assertEqual(get(self.url)['ETag'], '"%s"' % hashlib.sha256(self.content).hexdigest())
+
+    def test_aborted_upload(self):
+        response = Client().put(self.url, b'', content_type='application/octet-stream', CONTENT_LENGTH='10',
+                                **{'wsgi.input': BytesIO(b'01234')})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_concurrent_upload(self):
+        self.start_upload(self.content[:4])
+        fd = lock_file(self.path)  # another request is uploading the file
+        try:
+            response = put(self.url, self.content)
+            self.assertEqual(response.status_code, 409)
+            self.assertEqual(response.content, b'Upload is already in progress.')
+
+            # expired slots keep the partial file of an upload that is still running
+            with freeze_time(timezone.now() + timedelta(seconds=3600)):
+                Upload.objects.cleanup(files=False)
+            self.assertFalse(Slot.objects.exists())
+        finally:
+            os.close(fd)
+
+        with open(self.path, 'rb') as stream:  # the other upload is not affected
+            self.assertEqual(stream.read(), self.content[:4])
+        self.assertFalse(Upload.objects.exists())
+
+    def test_aborted_worker(self):
+        self.start_upload(self.content[:4])  # the worker was killed, so the file is no longer locked
+
+        self.assertEqual(put(self.url, self.content).status_code, 201)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(Upload.objects.get().file.read(), self.content)
+
+    def test_stopped_worker(self):
+        throttle = mock.Mock(side_effect=SystemExit)  # e.g. raised by gunicorn on a timeout
+        with mock.patch.object(UploadView, 'chunk_size', 4), \
+                mock.patch('xmpp_http_upload.views.Throttle', return_value=throttle):
+            with self.assertRaises(SystemExit):
+                put(self.url, self.content)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_cleanup(self):
+        self.start_upload(self.content[:4])
+        with freeze_time(timezone.now() + timedelta(seconds=3600)):
+            Upload.objects.cleanup(files=False)
+        self.assertFalse(Slot.objects.exists())
+        self.assertFalse(os.path.exists(os.path.dirname(self.path)))
+        self.assertFalse(self.slot.remove_partial_file())
+
+    def test_reaper(self):
+        self.start_upload(self.content[:4])
+        with freeze_time(timezone.now() + timedelta(seconds=3600)):
+            self.assertEqual(Reaper(iops=0).reap()['slots'], 1)
+        self.assertFalse(Slot.objects.exists())
+        self.assertFalse(os.path.exists(os.path.dirname(self.path)))
+
+    def test_lock_file(self):
+        self.start_upload(self.content[:4])
+
+        # the file is moved or removed by the previous holder before it releases the lock
+        with mock.patch('xmpp_http_upload.utils.os.path.samestat', side_effect=[False, True]) as samestat:
+            fd = lock_file(self.path, create=True)
+        os.close(fd)
+        self.assertEqual(samestat.call_count, 2)
+
+        with mock.patch('xmpp_http_upload.utils.os.stat', side_effect=FileNotFoundError):
+            self.assertFalse(self.slot.remove_partial_file())
+        self.assertTrue(os.path.exists(self.path))
+
+    @mock.patch('xmpp_http_upload.utils.time.sleep')
+    def test_download(self, sleep):
+        self.start_upload(self.content[:4])
+
+        def write(seconds):  # the upload continues while the download waits for more data
+            with open(self.path, 'ab') as stream:
+                stream.write(self.content[4:])
+
+        sleep.side_effect = write
+        response = get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertEqual(response['Content-Type'], 'application/octet-stream')
+        self.assertEqual(response['Content-Disposition'], 'inline; filename="exa%20mple.txt"')
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        sleep.assert_called_once_with(0.1)
+
+    @mock.patch('xmpp_http_upload.utils.time')
+    def test_timeout(self, time):
+        self.start_upload(self.content[:4])
+        time.monotonic.side_effect = [0, 1, 4, 7]
+
+        response = get(self.url)
+        with self.assertLogs('xmpp_http_upload.utils', level='WARNING'):
+            self.assertEqual(b''.join(response.streaming_content), self.content[:4])
+        self.assertEqual(time.sleep.call_count, 1)
+
+    def test_not_started(self):
+        self.assertEqual(get(self.url).status_code, 404)
+
+    def test_finished(self):
+        # the upload finishes between the database query and opening the partial file
+        def finish(slot):
+            upload = Upload.from_slot(slot)
+            upload.file.save(upload.name, ContentFile(self.content))
+            return self.path
+
+        with mock.patch.object(Slot, 'get_partial_path', autospec=True, side_effect=finish):
+            response = get(self.url)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+    @override_settings(XMPP_HTTP_UPLOAD_PROGRESSIVE_DOWNLOAD=False)
+    def test_disabled(self):
+        self.start_upload(self.content[:4])
+        self.assertEqual(get(self.url).status_code, 404)
+
+        url = reverse('xmpp-http-upload:share', kwargs={'hash': '0' * 32, 'filename': 'example.txt'})
+        self.assertEqual(get(url).status_code, 404)
+
+
 class CleanupMixin:
     def setUp(self):
         self.content = 'example content'
@@ -555,6 +3136,9 @@ class CleanupMixin:
         self.u2 = Upload.objects.create(
             jid=self.jid, name=self.name2, size=self.size, type=self.type, hash=self.hash
         )
+        self.slot = Slot.objects.create(
+            jid=self.jid, name='example.png', size=self.size, type=self.type, hash=self.hash
+        )
 
     @property
     def slots_expired(self):
@@ -567,18 +3151,15 @@ class CleanupMixin:
     def test_basic(self):
         # first, nothing happens...
         self.cleanup()
-        u1 = Upload.objects.get(pk=self.u1.pk)
-        u2 = Upload.objects.get(pk=self.u2.pk)
-        self.assertFalse(u1.file)
-        self.assertFalse(u2.file)
+        self.assertTrue(Slot.objects.filter(pk=self.slot.pk).exists())
+        self.assertEqual(Upload.objects.count(), 2)
 
         # save a file, and still nothing happens
         self.u1.file.save(self.name1, ContentFile(self.content))
         self.cleanup()
         u1 = Upload.objects.get(pk=self.u1.pk)
-        u2 = Upload.objects.get(pk=self.u2.pk)
         self.assertTrue(os.path.exists(u1.file.path))
-        self.assertFalse(u2.file)
+        self.assertTrue(Slot.objects.filter(pk=self.slot.pk).exists())
 
     def test_expired_slots(self):
         self.u1.file.save(self.name1, ContentFile(self.content))
@@ -587,12 +3168,12 @@ class CleanupMixin:
         with freeze_time(self.slots_expired):
             # cleanup with no empty slot removal - nothing should be removed
             self.cleanup(slots=False)
-            self.assertTrue(Upload.objects.filter(pk=self.u1.pk).exists())
-            self.assertTrue(Upload.objects.filter(pk=self.u2.pk).exists())
+            self.assertTrue(Slot.objects.filter(pk=self.slot.pk).exists())
 
             self.cleanup()
+            self.assertFalse(Slot.objects.filter(pk=self.slot.pk).exists())
             self.assertTrue(Upload.objects.filter(pk=self.u1.pk).exists())
-            self.assertFalse(Upload.objects.filter(pk=self.u2.pk).exists())
+            self.assertTrue(Upload.objects.filter(pk=self.u2.pk).exists())
 
     def test_files_expired(self):
         self.u1.file.save(self.name1, ContentFile(self.content))
@@ -634,3 +3215,734 @@ class ManageCleanupCommandTestCase(CleanupMixin, TestCase):
             kwargs['timeout'] = int(timeout / 86400)
 
         call_command('cleanup_http_uploads', **kwargs)
+
+
+class ScrubTestCase(TestCase):
+    def setUp(self):
+        self.uploads = []
+        for i in range(5):
+            content = b'content %d' % i
+            upload = Upload.objects.create(jid=user_jid, name='example.txt', size=len(content),
+                                           hash=get_random_string(32),
+                                           sha256=hashlib.sha256(content).hexdigest())
+            upload.file.save(upload.name, ContentFile(content))
+            self.uploads.append(upload)
+        self.ok, self.updated, self.corrupt, self.missing, self.ok2 = self.uploads
+
+        Upload.objects.filter(pk=self.updated.pk).update(sha256=None)
+        Upload.objects.filter(pk=self.corrupt.pk).update(sha256='0' * 64)
+        os.remove(self.missing.file.path)
+        Upload.objects.create(jid=user_jid, name='example.txt', size=10, hash=get_random_string(32))  # slot
+
+    def tearDown(self):
+        for upload in self.uploads:
+            upload.remove_file()
+
+    def scrub(self, *args, verbosity=2):
+        stdout, stderr = StringIO(), StringIO()
+        call_command('scrub_http_uploads', *args, verbosity=verbosity, stdout=stdout, stderr=stderr)
+        return [json.loads(line) for line in stdout.getvalue().splitlines()], stderr.getvalue()
+
+    def assertReports(self, reports):
+        self.assertEqual(reports, [
+            {'id': self.corrupt.pk, 'file': self.corrupt.file.name, 'status': 'corrupt', 'expected': '0' * 64,
+             'actual': hashlib.sha256(b'content 2').hexdigest()},
+            {'id': self.missing.pk, 'file': self.missing.file.name, 'status': 'missing'},
+        ])
+        self.updated.refresh_from_db()
+        self.assertEqual(self.updated.sha256, hashlib.sha256(b'content 1').hexdigest())
+
+    def test_scrub(self):
+        reports, stderr = self.scrub()
+        self.assertReports(reports)
+        self.assertEqual(stderr, 'Scrub complete: 2 ok, 1 new digests, 1 missing, 1 corrupt, 0 unreadable.\n')
+
+    def test_processes(self):
+        reports, stderr = self.scrub('--processes=2', '--bytes-per-second=1G')
+        self.assertReports(reports)
+
+    def test_checkpoint(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'checkpoint.json')
+            with mock.patch('xmpp_http_upload.scrub.time') as time:
+                time.monotonic.side_effect = [0, 0, 10]
+                reports, stderr = self.scrub('--checkpoint=%s' % path, '--batch-size=2', '--max-duration=5')
+            self.assertEqual(reports, [])
+            self.assertEqual(stderr,
+                             'Scrub incomplete: 1 ok, 1 new digests, 0 missing, 0 corrupt, 0 unreadable.\n')
+            with open(path) as stream:
+                self.assertEqual(json.load(stream), {'last_pk': self.updated.pk})
+
+            reports, stderr = self.scrub('--checkpoint=%s' % path, '--batch-size=2')
+            self.assertReports(reports)
+            self.assertEqual(stderr,
+                             'Scrub complete: 1 ok, 0 new digests, 1 missing, 1 corrupt, 0 unreadable.\n')
+            with open(path) as stream:
+                self.assertEqual(json.load(stream), {'last_pk': 0})
+
+    @mock.patch('xmpp_http_upload.scrub.open', side_effect=PermissionError('Permission denied'), create=True)
+    def test_unreadable(self, open):
+        reports, stderr = self.scrub(verbosity=1)
+        self.assertEqual(stderr, '')
+        self.assertEqual(len(reports), 5)
+        self.assertEqual(reports[0], {'id': self.ok.pk, 'file': self.ok.file.name, 'status': 'error',
+                                      'error': 'Permission denied'})
+
+
+class ThrottleTestCase(TestCase):
+    @mock.patch('xmpp_http_upload.utils.time')
+    def test_throttle(self, time):
+        time.monotonic.return_value = 100
+        throttle = Throttle(10)
+
+        throttle(5)  # within the initial burst
+        throttle(5)
+        time.sleep.assert_not_called()
+
+        throttle(5)
+        time.sleep.assert_called_once_with(0.5)
+
+        # after some idle time, we may again do a full burst, but not more
+        time.monotonic.return_value = 200
+        time.sleep.reset_mock()
+        throttle(10)
+        time.sleep.assert_not_called()
+
+    @mock.patch('xmpp_http_upload.utils.time')
+    def test_threads(self, time):
+        # e.g. the reaper shares its budget by the threads reaping the shards
+        time.monotonic.return_value = 100
+        throttle = Throttle(10)
+        threads = [threading.Thread(target=throttle, args=(5, )) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(throttle.tokens, -10)
+        self.assertEqual(sorted(call[0][0] for call in time.sleep.call_args_list), [0.5, 1.0])
+
+    @mock.patch('xmpp_http_upload.utils.time')
+    def test_disabled(self, time):
+        throttle = Throttle(None)
+        throttle(10 ** 6)
+        time.sleep.assert_not_called()
+
+    @mock.patch('xmpp_http_upload.utils.time')
+    def test_shared(self, time):
+        cache.clear()
+        time.time.return_value = 100.5
+        throttle, other = SharedThrottle(10, 'test'), SharedThrottle(10, 'test')
+
+        throttle(5)
+        other(5)
+        time.sleep.assert_not_called()
+
+        throttle(5)
+        time.sleep.assert_called_once_with(1.0)
+
+        # the next window has the full rate again
+        time.time.return_value = 101
+        time.sleep.reset_mock()
+        other(10)
+        SharedThrottle(None, 'test')(10)
+        time.sleep.assert_not_called()
+
+
+class RateLimitTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def assertQuota(self, retry_after, reason='uploads_per_timedelta'):
+        response = slot(jid=user_jid, name='example.jpg', size=10)
+        if retry_after is None:
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('Retry-After', response)
+        else:
+            self.assertEqual(response.status_code, 402)
+            self.assertEqual(response['Retry-After'], str(retry_after))
+
+    def test_sliding_window(self):
+        with freeze_time('2020-01-01 00:30:00') as frozen:
+            for i in range(3):
+                self.assertQuota(None)
+            self.assertQuota(3000)  # the approximation assumes uploads were spread over the window
+
+            frozen.tick(timedelta(minutes=40))  # 01:10, 5/6 of the previous window still count
+            self.assertQuota(600)
+            frozen.tick(timedelta(minutes=10))
+            self.assertQuota(None)
+            self.assertQuota(1200)
+
+            # denied slots do not count against the bytes quota
+            limit = RateLimit('bytes', user_jid, Upload.objects.all(), timedelta(hours=1), 1024, Sum('size'))
+            self.assertEqual(cache.get(limit.get_key(438289)), 10)
+
+    def test_restart(self):
+        with freeze_time('2020-01-01 00:30:00'):
+            for i in range(3):
+                Upload.objects.create(jid=user_jid, name='example.jpg', size=10, hash=get_random_string(32))
+            self.assertQuota(3000)  # counters are initialized from the database
+
+    @override_settings(XMPP_HTTP_UPLOAD_RATE_LIMITER='database')
+    def test_database(self):
+        with freeze_time('2020-01-01 00:30:00') as frozen:
+            for i in range(3):
+                self.assertQuota(None)
+            self.assertQuota(3600)
+
+            frozen.tick(timedelta(minutes=40))
+            self.assertQuota(1200)
+            frozen.tick(timedelta(minutes=20, seconds=1))
+            self.assertQuota(None)
+
+    @mock.patch('xmpp_http_upload.ratelimit.get_cache', side_effect=Exception('Connection refused'))
+    def test_cache_failure(self, get_cache):
+        with freeze_time('2020-01-01 00:30:00'), self.assertLogs('xmpp_http_upload.ratelimit') as logs:
+            for i in range(3):
+                self.assertQuota(None)
+            self.assertQuota(3600)
+        self.assertEqual(len(logs.output), 8)  # both quotas for every request
+
+    def test_undo_cache_failure(self):
+        limit = RateLimit('bytes', user_jid, Upload.objects.all(), timedelta(hours=1), 1024, Sum('size'))
+        with freeze_time('2020-01-01 00:30:00'):
+            self.assertIsNone(limit.hit(10, timezone.now()))
+            key = limit.reserved[0]
+            with mock.patch('xmpp_http_upload.ratelimit.get_cache', side_effect=Exception('down')), \
+                    self.assertLogs('xmpp_http_upload.ratelimit') as logs:
+                limit.undo()
+            self.assertEqual(cache.get(key), 10)  # the counter expires with its window
+        self.assertEqual(len(logs.output), 1)
+        self.assertIsNone(limit.reserved)
+
+    def test_over_limit(self):
+        now = timezone.now()
+        limit = RateLimit('bytes', user_jid, Upload.objects.all(), timedelta(hours=1), 10, Sum('size'))
+        self.assertEqual(limit.hit_cache(20, now), 3600)
+        self.assertEqual(limit.hit_database(20, now), 3600)
+
+
+@override_settings(XMPP_HTTP_UPLOAD_ADMISSION={'max_uploads': 2, 'max_bytes': 100, 'timeout': 60})
+class AdmissionTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.slot = Slot.objects.create(jid=user_jid, name='example.txt', size=10, hash=get_random_string(32))
+
+    def assertOverloaded(self, response):
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '30')
+
+    def put(self):
+        return put(self.slot.get_absolute_url(), b'0123456789')
+
+    def test_max_uploads(self):
+        admissions = [Admission(10), Admission(10)]
+        for admission in admissions:
+            self.assertTrue(admission.acquire())
+        self.assertFalse(Admission(10).acquire())
+
+        self.assertOverloaded(slot(jid=user_jid, name='example.jpg', size=10))
+        self.assertOverloaded(self.put())
+        self.assertFalse(Upload.objects.exists())
+
+        admissions[0].release()
+        self.assertEqual(slot(jid=user_jid, name='example.jpg', size=10).status_code, 200)
+        self.assertEqual(self.put().status_code, 201)
+        Upload.objects.get().remove_file()
+
+        # the upload was released again
+        self.assertTrue(Admission(10).acquire())
+
+    def test_max_bytes(self):
+        admission = Admission(95)
+        self.assertTrue(admission.acquire())
+        self.assertTrue(Admission(5).check())
+        self.assertFalse(Admission(6).check())
+        self.assertOverloaded(self.put())
+
+        admission.release()
+        admission.release()  # releasing twice does nothing
+        self.assertTrue(Admission(100).check())
+
+    def test_timeout(self):
+        with freeze_time('2020-01-01 00:00:30') as frozen:
+            self.assertTrue(Admission(100).acquire())  # never released, e.g. the process died
+            self.assertFalse(Admission(1).check())
+
+            frozen.tick(timedelta(seconds=60))  # the previous generation still counts
+            self.assertFalse(Admission(1).check())
+            self.assertFalse(Admission(1).acquire())
+
+            frozen.tick(timedelta(seconds=60))
+            self.assertTrue(Admission(1).check())
+            self.assertTrue(Admission(1).acquire())
+
+    def test_expired_release(self):
+        with freeze_time('2020-01-01 00:00:30') as frozen:
+            admission = Admission(10)
+            self.assertTrue(admission.acquire())
+            frozen.tick(timedelta(seconds=120))
+            with self.assertLogs('xmpp_http_upload.admission', level='ERROR'):
+                admission.release()
+
+    @mock.patch('xmpp_http_upload.admission.get_cache', side_effect=Exception('Connection refused'))
+    def test_cache_failure(self, get_cache):
+        with self.assertLogs('xmpp_http_upload.admission', level='ERROR') as logs:
+            self.assertTrue(Admission(1000).check())
+            self.assertTrue(Admission(1000).acquire())
+        self.assertEqual(len(logs.output), 2)
+
+    @override_settings(XMPP_HTTP_UPLOAD_ADMISSION={})
+    def test_disabled(self):
+        self.assertTrue(Admission(10 ** 12).check())
+        self.assertTrue(Admission(10 ** 12).acquire())
+        self.assertEqual(cache.get_many(Admission(1).get_keys(int(time.time() // 3600))), {})
+
+
+class ReaperTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.content = 'example content'
+        self.jid = 'user@example.com'
+        self.uploads = [
+            Upload.objects.create(jid=self.jid, name='example%s.txt' % i, size=len(self.content),
+                                  hash=get_random_string(32))
+            for i in range(3)
+        ]
+        for upload in self.uploads:
+            upload.file.save(upload.name, ContentFile(self.content))
+        self.slots = [
+            Slot.objects.create(jid=self.jid, name='example%s.txt' % i, size=len(self.content),
+                                hash=get_random_string(32))
+            for i in range(2)
+        ]
+
+    @property
+    def files_expired(self):
+        return timezone.now() + timedelta(seconds=86400 * 32)
+
+    def test_lease(self):
+        lease = Lease(1, 'node1', 10)
+        other = Lease(1, 'node2', 10)
+        self.assertTrue(lease.acquire())
+        self.assertTrue(lease.held())
+        self.assertFalse(other.acquire())
+        self.assertFalse(other.held())
+
+        other.release()  # does nothing, as the lease is not ours
+        self.assertFalse(other.acquire())
+
+        lease.release()
+        self.assertFalse(lease.held())
+        self.assertTrue(other.acquire())
+
+        # an expired lease is not released, as another node may hold it by now
+        with mock.patch('xmpp_http_upload.reaper.time.monotonic', return_value=time.monotonic() + 11):
+            self.assertFalse(other.held())
+            other.release()
+        self.assertFalse(lease.acquire())
+
+    def test_reap(self):
+        reaper = Reaper(batch_size=1, partition_size=2, rows_per_second=0, iops=0)
+        self.assertEqual(reaper.reap(), {'slots': 0, 'files': 0, 'skipped': []})
+        self.assertEqual(Slot.objects.count(), 2)
+        self.assertEqual(Upload.objects.count(), 3)
+
+        with freeze_time(timezone.now() + timedelta(seconds=361)):
+            self.assertEqual(reaper.reap(), {'slots': 2, 'files': 0, 'skipped': []})
+        self.assertFalse(Slot.objects.exists())
+        self.assertEqual(set(Upload.objects.all()), set(self.uploads))
+
+        with freeze_time(self.files_expired):
+            self.assertEqual(reaper.reap(), {'slots': 0, 'files': 3, 'skipped': []})
+        self.assertFalse(Upload.objects.exists())
+        for upload in self.uploads:
+            self.assertFalse(os.path.exists(os.path.dirname(upload.file.path)))
+
+    def test_leased_partition(self):
+        reaper = Reaper(partition_size=2)
+        partition = self.uploads[0].pk // 2
+
+        with freeze_time(self.files_expired):
+            Lease(partition, 'other-node', 10).acquire()
+            stats = reaper.reap()
+        self.assertEqual(stats['skipped'], [partition])
+        self.assertEqual(list(Upload.objects.all()), [u for u in self.uploads if u.pk // 2 == partition])
+        self.assertEqual(list(Slot.objects.all()), [s for s in self.slots if s.pk // 2 == partition])
+
+    def test_partitions(self):
+        reaper = Reaper(partition_size=1000)
+        pks = [upload.pk for upload in self.uploads] + [slot.pk for slot in self.slots]
+        self.assertEqual(reaper.get_partitions(), range(min(pks) // 1000, max(pks) // 1000 + 1))
+
+        # a partition is always the same range of primary keys, no matter which rows exist
+        upload = Upload.objects.create(pk=12345, jid=self.jid, name='example.txt', size=1, hash='a')
+        self.assertEqual(list(reaper.get_queryset(Upload, 12)), [upload])
+        self.assertEqual(reaper.get_partitions()[-1], 12)
+        Slot.objects.all().delete()
+        self.assertEqual(reaper.get_partitions()[-1], 12)
+
+        Upload.objects.all().delete()
+        self.assertEqual(reaper.get_partitions(), range(0))
+        self.assertEqual(reaper.reap(), {'slots': 0, 'files': 0, 'skipped': []})
+
+    def test_lost_lease(self):
+        reaper = Reaper()
+
+        with freeze_time(timezone.now() + timedelta(seconds=361)):
+            Lease(0, 'other-node', 10).acquire()
+            self.assertEqual(reaper.reap_partition(0, Lease(0, reaper.owner, 10)), (0, 0))
+        self.assertEqual(Slot.objects.count(), 2)
+        self.assertEqual(Upload.objects.count(), 3)
+
+    def test_remove_file_without_file(self):
+        Upload(jid=self.jid, name='example.txt', size=1).remove_file()  # does nothing, as there is no file
+
+    @mock.patch('xmpp_http_upload.reaper.time.sleep')
+    def test_run(self, sleep):
+        callback = mock.Mock()
+        reaper = Reaper(interval=30)
+        with freeze_time(self.files_expired):
+            reaper.run(passes=2, callback=callback)
+        sleep.assert_called_once_with(30)
+        self.assertEqual(callback.call_args_list, [
+            mock.call({'slots': 2, 'files': 3, 'skipped': []}),
+            mock.call({'slots': 0, 'files': 0, 'skipped': []}),
+        ])
+
+        reaper.run(passes=1)  # no callback
+
+    @override_settings(XMPP_HTTP_UPLOAD_REAPER={'partition_size': 2})
+    def test_command(self):
+        stdout = StringIO()
+        partition = self.uploads[0].pk // 2
+        with freeze_time(self.files_expired):
+            Lease(partition, 'other-node', 10).acquire()
+            call_command('reap_http_uploads', once=True, verbosity=3, stdout=stdout)
+        slots = len([slot for slot in self.slots if slot.pk // 2 != partition])
+        files = len([upload for upload in self.uploads if upload.pk // 2 != partition])
+        self.assertEqual(stdout.getvalue(), 'Removed %s expired slots and %s files.\n'
+                                            'Partitions leased by other nodes: %s\n' % (
+                                                slots, files, partition))
+
+        cache.clear()
+        stdout = StringIO()
+        call_command('reap_http_uploads', once=True, verbosity=3, stdout=stdout)
+        call_command('reap_http_uploads', once=True, stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'Removed 0 expired slots and 0 files.\n')
+
+    @mock.patch('xmpp_http_upload.tasks.reap_http_uploads.apply_async')
+    def test_task(self, apply_async):
+        with freeze_time(self.files_expired):
+            reap_http_uploads(reschedule=False)
+        self.assertFalse(Upload.objects.exists())
+        apply_async.assert_not_called()
+
+        reap_http_uploads()
+        apply_async.assert_called_once_with(kwargs={'reschedule': True}, countdown=60)
+
+
+class NoopMetricsTestCase(TestCase):
+    @mock.patch('xmpp_http_upload.metrics.prometheus_client', None)
+    def test_noop(self):
+        metric = metrics._metric('Counter', 'xmpp_http_upload_test', 'Test.', labelnames=['view'])
+        self.assertIsInstance(metric, metrics._NoopMetric)
+        self.assertIs(metric.labels(view='slot'), metric)
+        metric.inc()
+        metric.dec(2)
+        metric.observe(3)
+        with metric.time(), metric.track_inprogress():
+            pass
+        self.assertFalse(metrics.enabled())
+
+
+@skipUnless(metrics.prometheus_client, 'prometheus_client is not installed.')
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()  # rate limits and storage totals are kept in the cache
+
+    def sample(self, name, **labels):
+        return metrics.prometheus_client.REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_slot_requests(self):
+        name = 'xmpp_http_upload_slot_requests_total'
+        granted = self.sample(name, status='200', reason='granted')
+        denied = self.sample(name, status='403', reason='denied')
+        too_large = self.sample(name, status='413', reason='max_file_size')
+        latency = self.sample('xmpp_http_upload_request_duration_seconds_count', view='slot')
+
+        slot(jid=user_jid, name='example.jpg', size=10)
+        slot(jid='blocked@jabber.at', name='example.jpg', size=10)
+        slot(jid=user_jid, name='example.jpg', size=1024 * 1024)
+
+        self.assertEqual(self.sample(name, status='200', reason='granted'), granted + 1)
+        self.assertEqual(self.sample(name, status='403', reason='denied'), denied + 1)
+        self.assertEqual(self.sample(name, status='413', reason='max_file_size'), too_large + 1)
+        self.assertEqual(self.sample('xmpp_http_upload_request_duration_seconds_count', view='slot'),
+                         latency + 3)
+
+    def test_upload(self):
+        uploaded = self.sample('xmpp_http_upload_uploaded_bytes_total')
+        count = self.sample('xmpp_http_upload_upload_throughput_bytes_per_second_count')
+
+        content = 'foobar'
+        put_url, get_url = slot(jid=user_jid, name='example.txt', size=len(content)).content.decode(
+            'utf-8').split()
+        response = put(urlsplit(put_url).path, content)
+        self.assertEqual(response.status_code, 201)
+        Upload.objects.get().file.delete(save=False)
+
+        self.assertEqual(self.sample('xmpp_http_upload_uploaded_bytes_total'), uploaded + len(content))
+        self.assertEqual(self.sample('xmpp_http_upload_upload_throughput_bytes_per_second_count'),
+                         count + 1)
+        self.assertEqual(self.sample('xmpp_http_upload_uploads_in_progress'), 0)
+
+    def test_cleanup(self):
+        name = 'xmpp_http_upload_cleanup_removed_total'
+        slots = self.sample(name, kind='slots')
+        files = self.sample(name, kind='files')
+
+        Slot.objects.create(jid=user_jid, name='example.txt', size=10, hash=get_random_string(32))
+        with freeze_time(timezone.now() + timedelta(seconds=361)):
+            Upload.objects.cleanup()
+        self.assertEqual(self.sample(name, kind='slots'), slots + 1)
+        self.assertEqual(self.sample(name, kind='files'), files)
+
+    def test_view(self):
+        url = reverse('xmpp-http-upload:metrics')
+        self.assertEqual(get(url).status_code, 404)
+
+        Upload.objects.create(jid='a@example.com', name='a.txt', size=10, file='a.txt', hash='a')
+        Upload.objects.create(jid='b@example.com', name='b.txt', size=20, file='b.txt', hash='b')
+        Upload.objects.create(jid='c@example.net', name='c.txt', size=30, file='c.txt', hash='c')
+        Slot.objects.create(jid='c@example.net', name='d.txt', size=40, hash='d')  # not uploaded
+
+        with self.settings(XMPP_HTTP_UPLOAD_METRICS=True):
+            response = get(url)
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode('utf-8')
+        self.assertIn('xmpp_http_upload_storage_bytes{domain="example.com"} 30.0\n', content)
+        self.assertIn('xmpp_http_upload_storage_bytes{domain="example.net"} 30.0\n', content)
+        self.assertIn('xmpp_http_upload_uploads_in_progress', content)
+
+    def storage(self):
+        metric = list(StorageCollector().collect())[0]
+        return {s.labels['domain']: s.value for s in metric.samples}
+
+    def test_storage_interval(self):
+        Upload.objects.create(jid='a@example.com', name='a.txt', size=10, file='a.txt', hash='a')
+        self.assertEqual(self.storage(), {'example.com': 10})
+
+        # totals are cached
+        Upload.objects.create(jid='b@example.com', name='b.txt', size=20, file='b.txt', hash='b')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.storage(), {'example.com': 10})
+
+        cache.clear()
+        with self.settings(XMPP_HTTP_UPLOAD_METRICS_STORAGE_INTERVAL=0):
+            self.assertEqual(self.storage(), {'example.com': 30})
+        Upload.objects.create(jid='c@example.net', name='c.txt', size=30, file='c.txt', hash='c')
+        self.assertEqual(self.storage(), {'example.com': 30, 'example.net': 30})
+
+        # the database is queried every time if the cache is unavailable
+        with mock.patch('xmpp_http_upload.metrics.get_cache', side_effect=Exception('down')), \
+                self.assertLogs('xmpp_http_upload.metrics', level='ERROR') as logs:
+            self.assertEqual(self.storage(), {'example.com': 30, 'example.net': 30})
+        self.assertEqual(len(logs.output), 2)
+
+    def test_multiprocess(self):
+        url = reverse('xmpp-http-upload:metrics')
+        with tempfile.TemporaryDirectory() as tempdir, \
+                mock.patch.dict(os.environ, {'prometheus_multiproc_dir': tempdir}), \
+                self.settings(XMPP_HTTP_UPLOAD_METRICS=True):
+            response = get(url)
+        self.assertEqual(response.status_code, 200)
+
+        # metrics of this process are not written to the directory, so we get only storage metrics
+        self.assertNotIn(b'xmpp_http_upload_uploads_in_progress', response.content)
+        self.assertIn(b'xmpp_http_upload_storage_bytes', response.content)
+
+
+class SingleThreadedLiveServerThread(LiveServerThread):
+    # The live server shares a single database connection with the test case (in-memory SQLite), so
+    # requests must not be handled concurrently.
+    def _create_server(self):
+        return WSGIServer((self.host, self.port), QuietWSGIRequestHandler, allow_reuse_address=False)
+
+
+@override_settings(XMPP_HTTP_UPLOAD_ACCESS=[(r'^blocked@', False), ('.*', {})],
+                   XMPP_HTTP_UPLOAD_WEBSERVER_DOWNLOAD=False)
+class LoadtestCommandTestCase(LiveServerTestCase):
+    server_thread_class = SingleThreadedLiveServerThread
+
+    def test_parse_size(self):
+        self.assertEqual(parse_size('10'), 10)
+        self.assertEqual(parse_size('2k'), 2048)
+        self.assertEqual(parse_size('1M'), 1024 * 1024)
+
+    def loadtest(self, **kwargs):
+        stdout = StringIO()
+        kwargs.setdefault('url', self.live_server_url + reverse('xmpp-http-upload:slot'))
+        call_command('loadtest_http_uploads', stdout=stdout, **kwargs)
+        return stdout.getvalue()
+
+    def test_loadtest(self):
+        output = self.loadtest(users=1, uploads=6, sizes=[100, 10000], slow=0.5, abandon=0.5, fanout=2,
+                               seed=0, json=True, cleanup=True)
+        report = json.loads(output)['endpoints']
+        self.assertEqual(set(report), {'slot', 'put', 'get'})
+        self.assertEqual(report['slot']['requests'], 6)
+        self.assertEqual(report['slot']['errors'], 0)
+        self.assertEqual(report['slot']['queries'], None)
+
+        # Every upload was either abandoned or sent slowly
+        self.assertEqual(report['put']['abandoned'] + report['put']['requests'], 6)
+        self.assertGreater(report['put']['abandoned'], 0)
+        self.assertEqual(report['get']['requests'], report['put']['requests'] * 2)
+        self.assertEqual(report['get']['statuses'], {'200': report['get']['requests']})
+        self.assertFalse(Upload.objects.filter(file='').exclude(jid__startswith='loadtest-').exists())
+        self.assertFalse(Upload.objects.exclude(file='').exists())  # cleanup removed uploaded files
+
+    def test_errors(self):
+        output = self.loadtest(users=1, uploads=2, jid='blocked@%d')
+        self.assertIn('slot            2         0 100.00%', output)
+
+    def test_connection_refused(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        url = 'http://127.0.0.1:%s/http_upload/slot/' % sock.getsockname()[1]
+        sock.close()
+
+        output = self.loadtest(users=1, uploads=1, url=url)
+        self.assertIn('slot            1         0 100.00%', output)
+
+
+@override_settings(XMPP_HTTP_UPLOAD_ACCESS=[('.*', {})], ALLOWED_HOSTS=['127.0.0.1'])
+class LoadtestLocalServerTestCase(TransactionTestCase):
+    def test_local_server(self):
+        stdout = StringIO()
+        call_command('loadtest_http_uploads', users=1, uploads=2, sizes=[100], slow=0, abandon=0, fanout=0,
+                     stdout=stdout)
+        output = stdout.getvalue()
+        self.assertIn('slot            2         0   0.00%', output)
+        self.assertIn('put             2         0   0.00%', output)
+        self.assertRegex(output, r'slot .* [1-9]\.00\n')  # queries were counted
+
+        for upload in Upload.objects.all():
+            upload.remove_file()
+
+
+class ClusterLiveServerTestCase(LiveServerTestCase):
+    server_thread_class = SingleThreadedLiveServerThread
+
+    def test_push(self):
+        cache.clear()
+        nodes = {'a': 'http://a.invalid', 'b': self.live_server_url}
+        upload = Upload.objects.create(jid=user_jid, name='example.txt', size=4, node='a', hash='0' * 32)
+        with self.settings(XMPP_HTTP_UPLOAD_CLUSTER={'nodes': nodes, 'node': 'a'},
+                           XMPP_HTTP_UPLOAD_REMOVE_DELAY=0):
+            upload.hash = hash_for('b')
+            upload.save()
+            upload.file.save(upload.name, ContentFile(b'test'))
+            self.assertEqual(Rebalancer().rebalance(), {'moved': 1, 'failed': 0})
+
+        received = Upload.objects.get()
+        try:
+            self.assertEqual(received.node, 'b')
+            self.assertFalse(os.path.exists(upload.file.path))
+            with received.file.open('rb') as stream:
+                self.assertEqual(stream.read(), b'test')
+        finally:
+            received.remove_file()
+
+
+@modify_settings(MIDDLEWARE={'append': 'xmpp_http_upload.middleware.ProfilingMiddleware'})
+class ProfilingMiddlewareTestCase(TestCase):
+    databases = {'default', 'shard'}
+
+    def setUp(self):
+        cache.clear()  # rate limits are counted in the cache
+
+    def test_disabled(self):
+        response = slot(jid='admin@example.com', name='example.jpg', size=10)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Server-Timing', response)
+
+    @override_settings(XMPP_HTTP_UPLOAD_PROFILING={'sample_rate': 1})
+    def test_sampled(self):
+        with self.assertLogs('xmpp_http_upload.middleware', level='INFO') as logs:
+            response = slot(jid=user_jid, name='example.jpg', size=10)
+        self.assertEqual(response.status_code, 200)
+
+        timing = response['Server-Timing']
+        self.assertRegex(timing, r'^acl;dur=[0-9.]+, quota;dur=[0-9.]+, urls;dur=[0-9.]+, '
+                                 r'insert;dur=[0-9.]+, db;dur=[0-9.]+;desc="11 queries", total;dur=[0-9.]+$')
+        self.assertEqual(logs.output, [
+            'INFO:xmpp_http_upload.middleware:GET /http_upload/slot/: %s' % timing,
+        ])
+
+        # Other views are not profiled
+        self.assertNotIn('Server-Timing', get(reverse('admin:login')))
+
+    @override_settings(XMPP_HTTP_UPLOAD_PROFILING={'query_budgets': {'slot': 3, 'get': 5}})
+    def test_query_budget(self):
+        with self.assertLogs('xmpp_http_upload.middleware', level='WARNING') as logs:
+            response = slot(jid=user_jid, name='example.jpg', size=10)
+            slot(jid=user_jid, name='example.jpg', size=10)  # rate limits are cached, so only three queries
+            slot(jid='admin@example.com', name='example.jpg', size=10)  # only one query
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(logs.output, [
+            'WARNING:xmpp_http_upload.middleware:GET /http_upload/slot/: 11 queries exceed the budget of 3 '
+            'queries.'
+        ])
+
+    @override_settings(XMPP_HTTP_UPLOAD_PROFILING={'query_budgets': {'slot': 1}})
+    def test_all_databases(self):
+        def get_response(request):
+            Upload.objects.using('default').count()
+            Upload.objects.using('shard').count()
+            return HttpResponse()
+
+        middleware = ProfilingMiddleware(get_response)
+        request = RequestFactory().get(reverse('xmpp-http-upload:slot'))
+        request.resolver_match = resolve(request.path)
+        middleware.process_view(request, None, (), {})
+        with self.assertLogs('xmpp_http_upload.middleware', level='WARNING') as logs:
+            middleware(request)
+        self.assertEqual(logs.output, [
+            'WARNING:xmpp_http_upload.middleware:GET /http_upload/slot/: 2 queries exceed the budget of 1 '
+            'queries.'
+        ])
+        for alias in settings.DATABASES:  # wrappers are removed again
+            self.assertEqual(connections[alias].execute_wrappers, [])
+
+    def test_cprofile(self):
+        client = Client()  # the middleware keeps track of the slowest requests
+        url = reverse('xmpp-http-upload:slot')
+        params = {'jid': 'admin@example.com', 'name': 'example.jpg', 'size': 10}
+
+        with tempfile.TemporaryDirectory() as tempdir, self.settings(XMPP_HTTP_UPLOAD_PROFILING={
+                'sample_rate': 1, 'cprofile': True, 'cprofile_dir': tempdir, 'slowest': 2}):
+            for duration in [3, 1, 2, 5, 4, 1]:
+                with mock.patch('xmpp_http_upload.profiling.Profile.finish', autospec=True,
+                                side_effect=lambda p: setattr(p, 'duration', duration)):
+                    client.get(url, params)
+
+            self.assertEqual(sorted(f.split('-')[-1] for f in os.listdir(tempdir)),
+                             ['4.000.prof', '5.000.prof'])
+
+            # upload and download are also profiled
+            content = 'foobar'
+            put_url, get_url = slot(jid=user_jid, name='example.txt', size=len(content)).content.decode(
+                'utf-8').split()
+            response = put(urlsplit(put_url).path, content)
+            self.assertRegex(response['Server-Timing'], r'^lookup;dur=[0-9.]+, receive;dur=[0-9.]+, ')
+
+            with self.settings(XMPP_HTTP_UPLOAD_WEBSERVER_DOWNLOAD=False):
+                response = get(urlsplit(put_url).path)
+            self.assertRegex(response['Server-Timing'], r'^lookup;dur=[0-9.]+, db;dur=')
+            Upload.objects.uploaded().get().file.delete(save=False)
+
+    def test_phase_without_profile(self):
+        with phase('foo'):
+            pass
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-http-upload
+# (https://github.com/mathiasertl/django-xmpp-http-upload).
+#
+# django-xmpp-http-upload is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# django-xmpp-http-upload is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# django-xmpp-http-upload.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Move uploads that are not downloaded anymore to cold storage.
+
+Downloads record the time of the last access of an upload in a buffer of the process, which is written
+to the database with one ``UPDATE`` per shard every ``flush_interval`` seconds (or when it holds
+``max_buffered`` uploads). The access time is only precise to ``resolution`` seconds.
+
+The :py:class:`Tierer` moves uploads that were not downloaded for ``days`` days to cold storage (see the
+``XMPP_HTTP_UPLOAD_TIERING`` setting): it compresses them (if ``compress`` is set), moves them to the
+directory ``root`` (if set) and sets their ``cold`` field. Downloads read cold uploads from ``root``, so
+never change it while cold uploads exist.
+"""
+
+import atexit
+import logging
+import os
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .shards import get_aliases
+from .utils import Throttle
+from .utils import remove_files
+from .utils import remove_later
+from .utils import ws_download
+
+log = logging.getLogger(__name__)
+
+_TIERING_DEFAULTS = {
+    'days': None,  # move uploads not downloaded for this many days, None disables tiering
+    'root': None,  # directory for cold uploads
+    'compress': False,  # compress cold uploads with gzip
+    'batch_size': 100,
+    'bytes_per_second': None,  # bandwidth used to move uploads
+    'flush_interval': 60,  # seconds between two writes of buffered access times
+    'max_buffered': 1000,  # uploads buffered before access times are written
+    'resolution': 3600,  # seconds, more recent access times are not updated
+}
+
+
+def get_tiering_config():
+    config = dict(_TIERING_DEFAULTS)
+    config.update(getattr(settings, 'XMPP_HTTP_UPLOAD_TIERING', {}))
+    return config
+
+
+def get_cold_root():
+    """Get the directory of cold uploads, ``None`` if they stay in ``MEDIA_ROOT``."""
+    return get_tiering_config()['root']
+
+
+class AccessBuffer:
+    """Buffer of the time of the last download of uploads, written to the database in batches."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pks = {}  # set of primary keys per shard
+        self.last_flush = time.monotonic()
+
+    def touch(self, upload):
+        """Record a download of ``upload``."""
+        config = get_tiering_config()
+        if config['days'] is None:
+            return
+
+        now = timezone.now()
+        if upload.accessed is not None and now - upload.accessed < timedelta(seconds=config['resolution']):
+            return
+
+        alias = upload._state.db if upload._state.db in get_aliases() else None  # not a read replica
+        with self.lock:
+            self.pks.setdefault(alias, set()).add(upload.pk)
+            size = sum(len(pks) for pks in self.pks.values())
+        if size >= config['max_buffered'] or time.monotonic() - self.last_flush >= config['flush_interval']:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered access times, returns the number of updated uploads."""
+        from .models import Upload
+
+        with self.lock:
+            buffered, self.pks = self.pks, {}
+            self.last_flush = time.monotonic()
+
+        now = timezone.now()
+        updated = 0
+        for alias, pks in buffered.items():
+            try:
+                updated += Upload.objects.using(alias).filter(pk__in=pks).update(accessed=now)
+            except Exception:  # never fail a download because of the buffer
+                log.exception('Cannot record the last access of %s uploads.', len(pks))
+        return updated
+
+
+_buffer = AccessBuffer()
+atexit.register(_buffer.flush)
+
+
+def touch(upload):
+    """Record a download of ``upload``, see :py:class:`AccessBuffer`."""
+    _buffer.touch(upload)
+
+
+class Tierer:
+    """Move uploads not downloaded for ``days`` days to cold storage on the shard ``using``.
+
+    All parameters default to the respective value in the ``XMPP_HTTP_UPLOAD_TIERING`` setting.
+    """
+
+    def __init__(self, days=None, batch_size=None, bytes_per_second=None, using=None):
+        config = get_tiering_config()
+        self.days = config['days'] if days is None else days
+        self.root = config['root']
+        self.compress = config['compress'] and ws_download() is False  # the webserver cannot decompress
+        self.batch_size = batch_size or config['batch_size']
+        self.throttle = Throttle(config['bytes_per_second'] if bytes_per_second is None else bytes_per_second)
+        self.using = using
+
+    def get_queryset(self):
+        from .models import Upload
+
+        cutoff = timezone.now() - timedelta(days=self.days)
+        qs = Upload.objects.using(self.using).uploaded().local().filter(cold=False, offset__isnull=True)
+        return qs.filter(Q(accessed__lt=cutoff) | Q(accessed__isnull=True, uploaded__lt=cutoff))
+
+    def tier(self, upload):
+        """Compress and/or move a single upload, returns ``True`` if it is now in cold storage."""
+        from .compression import compress_stored
+        from .metadata import remove as remove_metadata
+        from .mirrors import copy_file
+        from .models import Upload
+
+        if self.compress and upload.compressed_size is None:
+            self.throttle(upload.size)
+            compress_stored(upload, self.using)
+
+        names = [upload.file.name]
+        if upload.compressed_size is not None and upload.encoding == '':
+            names.append('%s.gz' % upload.file.name)
+        sources = [upload.file.storage.path(name) for name in names]
+        targets = [os.path.join(self.root, name) for name in names] if self.root else []
+        for source, target in zip(sources, targets):
+            copy_file(source, target)
+            self.throttle(os.path.getsize(target))
+
+        updated = Upload.objects.using(self.using).filter(
+            pk=upload.pk, file=upload.file.name, cold=False).update(cold=True)
+        if targets:  # remove the files that are not used, e.g. if the upload was removed in the meantime
+            if updated:
+                remove_metadata(upload)  # cold uploads are served using the database
+                remove_later(*sources)  # downloads may still be about to open the sources
+            else:
+                remove_files(*targets)
+        return bool(updated)
+
+    def run(self):
+        """Tier all matching uploads, returns the number of moved uploads and of errors."""
+        from .mirrors import get_roots
+        from .mirrors import mirror_upload
+
+        stats = {'moved': 0, 'failed': 0}
+        if self.days is None:
+            return stats
+
+        qs = self.get_queryset().order_by('pk')
+        last_pk = 0
+        for batch in iter(lambda: list(qs.filter(pk__gt=last_pk)[:self.batch_size]), []):
+            last_pk = batch[-1].pk
+            for upload in batch:
+                try:
+                    moved = self.tier(upload)
+                except OSError:
+                    log.exception('Cannot move %s to cold storage.', upload.file.name)
+                    stats['failed'] += 1
+                    continue
+
+                stats['moved'] += moved
+                if moved and get_roots():  # a compressed file is copied again
+                    mirror_upload(upload.pk, using=self.using)
+        return stats
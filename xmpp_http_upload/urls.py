@@ -24,8 +24,11 @@ app_name = 'xmpp-http-upload'
 urlpatterns = [
     url(r'^slot/$', views.RequestSlotView.as_view(), name='slot'),
     url(r'^max_size/$', views.MaxSizeView.as_view(), name='max_size'),
+    url(r'^metrics/$', views.MetricsView.as_view(), name='metrics'),
 
     # TODO: The filename regex should exclude unsafe characters
     url(r'^share/(?P<hash>[a-zA-Z0-9]{32})/(?P<filename>.*)$', views.UploadView.as_view(),
         name='share'),
+    url(r'^cluster/(?P<hash>[a-zA-Z0-9]{32})/(?P<filename>.*)$', views.ClusterView.as_view(),
+        name='cluster'),
 ]
@@ -16,15 +16,99 @@
 
 from __future__ import unicode_literals
 
+import base64
+import binascii
+import bisect
+import fcntl
+import functools
+import hashlib
+import logging
+import os
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from django.conf import settings
+from django.core.cache import caches
+from django.core.files.uploadedfile import UploadedFile
+from django.db import connections
+
+log = logging.getLogger(__name__)
 
 
 def ws_download():
     return getattr(settings, 'XMPP_HTTP_UPLOAD_WEBSERVER_DOWNLOAD', True)
 
 
+def progressive_download():
+    return getattr(settings, 'XMPP_HTTP_UPLOAD_PROGRESSIVE_DOWNLOAD', False)
+
+
+def progressive_timeout():
+    return getattr(settings, 'XMPP_HTTP_UPLOAD_PROGRESSIVE_TIMEOUT', 30)
+
+
+def remove_delay():
+    return getattr(settings, 'XMPP_HTTP_UPLOAD_REMOVE_DELAY', 60)
+
+
+def get_cache():
+    """Get the cache used to coordinate multiple processes or nodes.
+
+    The cache alias is configured by the XMPP_HTTP_UPLOAD_CACHE setting. Note that a process-local cache
+    (like Djangos default ``LocMemCache``) only coordinates threads of a single process.
+    """
+    return caches[getattr(settings, 'XMPP_HTTP_UPLOAD_CACHE', 'default')]
+
+
+def cache_key(prefix, jid):
+    """Get a cache key for ``jid``, which is hashed as JIDs are not valid memcached keys."""
+    return 'xmpp-http-upload:%s:%s' % (prefix, hashlib.sha256(jid.encode('utf-8')).hexdigest())
+
+
+def try_cache(func, default, logger, message):
+    """Call ``func`` (which uses the cache), returns ``default`` and logs ``message`` if it fails.
+
+    Cache backends raise all kinds of exceptions if the server is unavailable.
+    """
+    try:
+        return func()
+    except Exception:
+        logger.exception(message)
+        return default
+
+
+_units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(value):
+    """Parse a size like ``"64K"`` or ``"1M"``, used by management commands."""
+    value = value.strip().upper()
+    if value[-1] in _units:
+        return int(value[:-1]) * _units[value[-1]]
+    return int(value)
+
+
+def _point(key):
+    return int(hashlib.sha256(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+@functools.lru_cache(maxsize=128)  # one ring for every prefix of the shards, see shards_for_jid()
+def _ring(names):
+    return sorted((_point('%s-%s' % (name, i)), name) for name in names for i in range(100))
+
+
+def ring_lookup(names, key):
+    """Get the name (e.g. of a shard or node) for ``key`` by consistent hashing.
+
+    Every name has 100 points on a hash ring, so adding a name moves only few keys (all to the new name).
+    """
+    ring = _ring(tuple(names))
+    index = bisect.bisect(ring, (_point(key), )) % len(ring)
+    return ring[index][1]
+
+
 def get_config(jid):
     """Get the configuration for the given JID based on XMPP_HTTP_UPLOAD_ACCESS.
 
@@ -42,3 +126,256 @@ def get_config(jid):
                 return config
 
     return False
+
+
+def get_request_digest(request):
+    """Get the SHA-256 digest (as hex) from the ``Content-Digest`` or ``Digest`` header, if any.
+
+    ``Content-Digest`` is defined in RFC 9530 (e.g. ``sha-256=:base64:``), ``Digest`` in RFC 3230 (e.g.
+    ``SHA-256=base64``). Raises ``ValueError`` if the digest is not valid base64.
+    """
+    for header in ('HTTP_CONTENT_DIGEST', 'HTTP_DIGEST'):
+        for value in request.META.get(header, '').split(','):
+            algorithm, sep, digest = value.strip().partition('=')
+            if sep and algorithm.lower() == 'sha-256':
+                try:
+                    digest = base64.b64decode(digest.strip(':'), validate=True)
+                except binascii.Error:
+                    raise ValueError('%s: Invalid base64.' % digest)
+                return binascii.hexlify(digest).decode('ascii')
+    return None
+
+
+class Throttle:
+    """Token bucket limiting an operation to ``rate`` operations per second.
+
+    Call the instance after every operation (or pass the number of operations, e.g. bytes written). It
+    sleeps as long as necessary to stay within the configured rate, allowing bursts of at most one
+    second worth of operations. A ``rate`` of ``None`` or ``0`` disables throttling. An instance may be
+    shared by multiple threads (e.g. the reaper shares its budget by all shards).
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate or 0
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __call__(self, ops=1):
+        if not self.rate:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= ops
+            tokens = self.tokens
+
+        if tokens < 0:
+            time.sleep(-tokens / self.rate)
+
+
+class SharedThrottle:
+    """Limit an operation to ``rate`` operations per second for all instances using the same ``key``.
+
+    Operations are counted in the cache (see :py:func:`get_cache`) in windows of one second, so the limit
+    is shared by all threads, processes and nodes. An instance sleeps until the operations counted in the
+    current window fit into the rate. If the cache is unavailable, the instance falls back to a
+    :py:class:`Throttle` of its own.
+    """
+
+    def __init__(self, rate, key):
+        self.rate = rate
+        self.key = key
+        self.fallback = Throttle(rate)
+
+    def count(self, window, ops):
+        cache = get_cache()
+        key = '%s:%s' % (self.key, window)
+        cache.add(key, 0, 2)
+        return cache.incr(key, ops)
+
+    def __call__(self, ops=1):
+        if not self.rate or not ops:
+            return
+
+        now = time.time()
+        window = int(now)
+        count = try_cache(lambda: self.count(window, ops), None, log,
+                          'Cannot use cache for bandwidth limits, using a local limit.')
+        if count is None:
+            self.fallback(ops)
+        elif count > self.rate:
+            time.sleep(window + count / self.rate - now)
+
+
+class ThrottledFile:
+    """Wrap a file object so that reading it is limited to ``rate`` bytes per second.
+
+    The rate is shared by all files using the same ``key`` (see :py:class:`SharedThrottle`). The wrapper
+    deliberately has no ``fileno()``, as a WSGI server would otherwise send the file with ``sendfile()``
+    and bypass the limit.
+    """
+
+    def __init__(self, file, rate, key):
+        self.file = file
+        self.throttle = SharedThrottle(rate, key)
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.throttle(len(data))
+        return data
+
+    def __getattr__(self, name):
+        if name == 'fileno':
+            raise AttributeError(name)
+        return getattr(self.file, name)
+
+
+def lock_file(path, create=False):
+    """Open ``path`` and lock it exclusively, returns the file descriptor.
+
+    Returns ``None`` if another request holds the lock. The lock is released when the file descriptor is
+    closed, also if the process is killed. If ``create`` is ``False``, ``FileNotFoundError`` is raised if
+    the file does not exist (or was removed before it could be locked).
+    """
+    flags = (os.O_RDWR | os.O_CREAT) if create else os.O_RDWR
+    while True:
+        fd = os.open(path, flags, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+
+        # The previous holder may have moved or removed the file before releasing the lock
+        try:
+            if os.path.samestat(os.fstat(fd), os.stat(path)):
+                return fd
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+        if not create:
+            raise FileNotFoundError(path)
+
+
+def remove_partial_file(path):
+    """Remove a partial file left behind by an aborted upload and its (then empty) directory.
+
+    Returns ``False`` if there is no such file or if an upload is still writing it.
+    """
+    try:
+        fd = lock_file(path)
+    except FileNotFoundError:
+        return False
+    if fd is None:
+        return False
+
+    try:
+        remove_files(path)
+    finally:
+        os.close(fd)
+    return True
+
+
+class PartialUploadedFile(UploadedFile):
+    """An uploaded file written directly to ``path``, so it can be read while it is being uploaded.
+
+    Like with a :py:class:`~django.core.files.uploadedfile.TemporaryUploadedFile`, the file storage moves
+    the file to its final location, and closing the file removes it if it was not moved. The file is locked
+    while it is written: Raises ``FileExistsError`` if the same slot is already being uploaded. A partial
+    file left behind by an aborted upload is not locked and is overwritten.
+    """
+
+    def __init__(self, path, name, content_type, size):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = lock_file(path, create=True)
+        if fd is None:
+            raise FileExistsError(path)
+        os.ftruncate(fd, 0)
+        self.path = path
+        super().__init__(open(fd, 'w+b'), name, content_type, size, None)
+
+    def temporary_file_path(self):
+        return self.path
+
+    def close(self):
+        try:  # remove the file before releasing the lock, so no other request can lock it
+            os.remove(self.path)
+        except FileNotFoundError:  # the file was moved to its final location
+            pass
+        self.file.close()
+
+
+class BackgroundExecutor:
+    """Run functions in background threads of the current process, used by the "thread" backends.
+
+    Functions are run one after another, unless ``max_workers`` is greater than one.
+    """
+
+    def __init__(self, max_workers=1):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def run(self, func, *args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            connections.close_all()  # the thread would otherwise leak its database connections
+
+    def submit(self, func, *args, **kwargs):
+        """Call ``func(*args, **kwargs)`` in a background thread."""
+        return self.executor.submit(self.run, func, *args, **kwargs)
+
+
+def remove_files(*paths):
+    """Remove files (if they still exist) and their (then empty) directories."""
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        directory = os.path.dirname(path)
+        if os.path.isdir(directory) and not os.listdir(directory):
+            os.rmdir(directory)
+
+
+def remove_later(*paths):
+    """Remove files that were replaced by another file after ``XMPP_HTTP_UPLOAD_REMOVE_DELAY`` seconds.
+
+    Requests that looked up an upload before it was updated may still open the old file in the meantime.
+    The files are removed by a timer thread of the current process, so they are left behind if the process
+    exits before.
+    """
+    delay = remove_delay()
+    if not delay:
+        remove_files(*paths)
+        return
+
+    timer = threading.Timer(delay, remove_files, paths)
+    timer.daemon = True
+    timer.start()
+
+
+def follow_file(file, size, timeout, poll_interval=0.1, chunk_size=64 * 1024):
+    """Read ``size`` bytes from a file that is still being written.
+
+    Yields chunks as soon as they are written and stops if no data was written for ``timeout`` seconds.
+    """
+
+    remaining = size
+    last = time.monotonic()
+    try:
+        while remaining > 0:
+            chunk = file.read(min(chunk_size, remaining))
+            if chunk:
+                remaining -= len(chunk)
+                last = time.monotonic()
+                yield chunk
+            elif time.monotonic() - last > timeout:
+                log.warning('%s: No data written for %s seconds, aborting download.', file.name, timeout)
+                return
+            else:
+                time.sleep(poll_interval)
+    finally:
+        file.close()
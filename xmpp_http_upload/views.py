@@ -15,26 +15,69 @@
 
 from __future__ import unicode_literals
 
+import hashlib
 import json
+import math
+import os
 import re
+import time
+from io import BytesIO
+from urllib.parse import quote
 
 from django.conf import settings
+from django.core import signing
+from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.db import transaction
+from django.db.models import Count
 from django.db.models import Sum
 from django.http import FileResponse
+from django.http import Http404
 from django.http import HttpResponse
 from django.http import HttpResponseForbidden
+from django.http import HttpResponseNotFound
+from django.http import StreamingHttpResponse
 from django.http import UnreadablePostError
 from django.utils import timezone
-from django.utils.crypto import get_random_string
+from django.utils.cache import get_conditional_response
+from django.utils.cache import patch_vary_headers
+from django.utils.decorators import method_decorator
 from django.utils.text import get_valid_filename
+from django.views.decorators.csrf import csrf_exempt
 from django.views.generic.base import View
 
-from rest_framework.parsers import FileUploadParser
-from rest_framework.response import Response
-from rest_framework.views import APIView
-
+from . import cluster
+from . import compression
+from . import metadata
+from . import metrics
+from . import offload
+from . import packs
+from . import pipeline
+from . import tiering
+from .admission import Admission
+from .compression import accepts_gzip
+from .compression import open_compressed
+from .models import Slot
 from .models import Upload
+from .offload import OffloadedFile
+from .profiling import phase
+from .ratelimit import RateLimit
+from .routers import get_replica_config
+from .routers import is_pinned
+from .routers import pin
+from .routers import replica_reads
+from .shards import new_hash
+from .shards import shards_for_hash
+from .shards import shards_for_jid
+from .utils import PartialUploadedFile
+from .utils import Throttle
+from .utils import ThrottledFile
+from .utils import cache_key
+from .utils import follow_file
 from .utils import get_config
+from .utils import get_request_digest
+from .utils import progressive_download
+from .utils import progressive_timeout
 from .utils import ws_download
 
 _upload_base = getattr(settings, 'XMPP_HTTP_UPLOAD_ROOT', 'http_upload')
@@ -47,6 +90,46 @@ def _add_content_length():
 # regex of ascii control chars:
 control_chars = ''.join(map(chr, list(range(0, 32)) + list(range(127, 160))))
 control_char_re = re.compile('[%s]' % re.escape(control_chars))
+sha256_re = re.compile('^[0-9a-fA-F]{64}$')
+
+
+class ThrottledFileResponse(FileResponse):
+    # Every block read from a throttled file is counted in the cache, so read larger blocks
+    block_size = 64 * 1024
+
+
+def _slot_response(content, status, reason, **kwargs):
+    metrics.SLOT_REQUESTS.labels(status=status, reason=reason).inc()
+    return HttpResponse(content, status=status, **kwargs)
+
+
+def _lookup(queryset, hash, replicas=True, **kwargs):
+    """Get an instance from the shards that may contain ``hash``.
+
+    If ``replicas`` is ``True``, the query goes to a read replica and is repeated on the primary if the
+    replica misses it.
+    """
+    for alias in shards_for_hash(hash):
+        qs = queryset.using(alias).filter(hash=hash, **kwargs)
+        with replica_reads(replicas):
+            obj = qs.first()
+        if obj is None and replicas and alias is None and get_replica_config()['aliases']:
+            obj = qs.first()  # the replica may lag behind the primary
+        if obj is not None:
+            return obj
+    return None
+
+
+def _overloaded(view, admission):
+    """Response if an upload is not admitted because the server is too busy."""
+    metrics.ADMISSION_REJECTED.labels(view=view).inc()
+    message = 'Too many uploads in progress, please try again later.'
+    if view == 'slot':
+        response = _slot_response(message, 503, 'overloaded')
+    else:
+        response = HttpResponse(message, status=503)
+    response['Retry-After'] = admission.config['retry_after']
+    return response
 
 
 class RequestSlotView(View):
@@ -54,93 +137,124 @@ class RequestSlotView(View):
 
     # TODO: do some general checks (e.g. origin of request?) in the dispatch method
 
+    def check_quota(self, jid, size, config):
+        """Check the quotas of the user, returns a response if the slot is denied."""
+        now = timezone.now()
+        aliases = shards_for_jid(jid)
+        slots = [Slot.objects.using(alias).filter(jid=jid) for alias in aliases]
+        uploads = [Upload.objects.using(alias).filter(jid=jid) for alias in aliases]
+
+        # deny if total size of uploaded files (and slots that may still be uploaded) is too large
+        if 'max_total_size' in config:
+            message = 'User may not upload more than %s bytes.' % config['max_total_size']
+
+            total = 0
+            for qs in uploads + [qs.for_upload() for qs in slots]:
+                total += qs.aggregate(total=Sum('size'))['total'] or 0
+            if total + size > config['max_total_size']:
+                return _slot_response(message, 403, 'max_total_size')
+
+        limits = []
+        querysets = slots + uploads
+        if 'bytes_per_timedelta' in config:
+            quota = config['bytes_per_timedelta']
+            limit = RateLimit('bytes', jid, querysets, quota['delta'], quota['bytes'], Sum('size'))
+            limits.append((limit, size, 'bytes_per_timedelta'))
+        if 'uploads_per_timedelta' in config:
+            quota = config['uploads_per_timedelta']
+            limit = RateLimit('uploads', jid, querysets, quota['delta'], quota['uploads'], Count('pk'))
+            limits.append((limit, 1, 'uploads_per_timedelta'))
+
+        for i, (limit, amount, reason) in enumerate(limits):
+            retry_after = limit.hit(amount, now)
+            if retry_after is not None:
+                for previous, _amount, _reason in limits[:i]:
+                    previous.undo()
+
+                response = _slot_response("User is temporarily out of quota.", 402, reason)
+                response['Retry-After'] = max(1, int(math.ceil(retry_after)))
+                return response
+
+    @metrics.timed('slot')
     def get(self, request, *args, **kwargs):
         try:
             jid = request.GET['jid']  # jid of the uploader
             name = get_valid_filename(request.GET['name'])  # filename
             size = int(request.GET['size'])  # filesize
 
-            # type is optional:
+            # type and digest are optional:
             content_type = request.GET.get('type')
+            sha256 = request.GET.get('sha256')
         except (KeyError, IndexError, ValueError):
-            return HttpResponse(status=400)
+            return _slot_response('', 400, 'bad_request')
+
+        if sha256 is not None:
+            if not sha256_re.match(sha256):
+                return _slot_response("sha256 must be a hex-encoded SHA-256 digest.", 400, 'bad_request')
+            sha256 = sha256.lower()
 
         if not jid or not size or not name or size <= 0:
-            return HttpResponse("Empty JID or size passed.", status=400)
+            return _slot_response("Empty JID or size passed.", 400, 'bad_request')
         if '/' in name:  # pragma: no cover - assured by get_valid_filename, but just to be sure
-            return HttpResponseForbidden('No slashes in filenames allowed.')
+            return _slot_response('No slashes in filenames allowed.', 403, 'bad_request')
 
         # replace control characters from jid and name, just to be sure
         jid = control_char_re.sub('', jid)
         name = control_char_re.sub('', name)
 
-        # shortcuts
-        now = timezone.now()
-        qs = Upload.objects.filter(jid=jid)
-
-        # TODO: Exclude expired slots (client requested slot but did not upload a file) here.
-
-        config = get_config(jid)
+        with phase('acl'):
+            config = get_config(jid)
 
         # If the config is set to False, everything should be denied.
         if config is False:
-            return HttpResponseForbidden("You are not allowed to upload files.")
+            return _slot_response("You are not allowed to upload files.", 403, 'denied')
 
         # deny if file is to large
         if 'max_file_size' in config and size > config['max_file_size']:
             message = 'Files may not be larger than %s bytes.' % config['max_file_size']
-            return HttpResponse(message, status=413)
-
-        # deny if total size of uploaded files is too large
-        if 'max_total_size' in config:
-            message = 'User may not upload more than %s bytes.' % config['max_total_size']
-
-            uploaded = qs.aggregate(total=Sum('size'))
-            if uploaded['total'] is None:  # no uploads by this user yet
-                uploaded['total'] = 0
-            if uploaded['total'] + size > config['max_total_size']:
-                return HttpResponseForbidden(message)
+            return _slot_response(message, 413, 'max_file_size')
 
-        if 'bytes_per_timedelta' in config:
-            delta = config['bytes_per_timedelta']['delta']
-            quota = config['bytes_per_timedelta']['bytes']
-            uploaded = qs.filter(created__gt=now - delta).aggregate(total=Sum('size'))
-            if uploaded['total'] is None:  # no uploads by this user yet
-                uploaded['total'] = 0
-
-            if uploaded['total'] + size > quota:
-                return HttpResponse("User is temporarily out of quota.", status=402)
-
-        if 'uploads_per_timedelta' in config:
-            delta = config['uploads_per_timedelta']['delta']
-            quota = config['uploads_per_timedelta']['uploads']
-            if qs.filter(created__gt=now - delta).count() + 1 > quota:
-                return HttpResponse("User is temporarily out of quota.", status=402)
-
-        hash = get_random_string(32)
-        upload = Upload(jid=jid, name=name, size=size, type=content_type, hash=hash)
+        alias, hash = new_hash(jid)
+        slot = Slot(jid=jid, name=name, size=size, type=content_type, hash=hash, sha256=sha256)
+        if cluster.enabled():
+            slot.node = cluster.get_owner(hash)
 
         # Test if the filename is to long. Djangos FileField silently truncates to max_length,
         # so if the filename is too long, users will get a HTTP 404 when downloading the file.
         file_field = Upload._meta.get_field('file')
-        if len(file_field.upload_to(upload, name)) > file_field.max_length:
+        if len(file_field.upload_to(slot, name)) > file_field.max_length:
             message = 'Filename must not be longer then %s characters.' % file_field.max_length
-            return HttpResponse(message, status=413)
-
-        put_url, get_url = upload.get_urls(request)
+            return _slot_response(message, 413, 'filename_length')
 
         output = request.GET.get('output', 'text/plain')
+        if output not in ('text/plain', 'application/json'):
+            return _slot_response("Unsupported content type in output.", 400, 'bad_request')
+
+        # Do not hand out new slots if the server is too busy
+        admission = Admission(size)
+        if not admission.check():
+            return _overloaded('slot', admission)
+
+        # Check quotas last, as rate limits count the slot as soon as they are checked.
+        with phase('quota'), replica_reads(not is_pinned(jid)):
+            response = self.check_quota(jid, size, config)
+        if response is not None:
+            return response
+
+        with phase('urls'):
+            put_url, get_url = slot.get_urls(request)
+
         if output == 'text/plain':
             content = '%s\n%s' % (put_url, get_url)
-        elif output == 'application/json':
-            content = json.dumps({'get': get_url, 'put': put_url})
         else:
-            return HttpResponse("Unsupported content type in output.", status=400)
+            content = json.dumps({'get': get_url, 'put': put_url})
 
-        # Finally sure we will have a response, so save upload to database.
-        upload.save()
+        # Finally sure we will have a response, so save slot to database.
+        with phase('insert'):
+            slot.save(using=alias)
+        pin(jid)
 
-        response = HttpResponse(content, content_type=output)
+        response = _slot_response(content, 200, 'granted', content_type=output)
         if _add_content_length() is True:
             response['Content-Length'] = len(content)
         return response
@@ -174,43 +288,303 @@ class MaxSizeView(View):
         return response
 
 
-class UploadView(APIView):
-    parser_classes = (FileUploadParser, )
+@method_decorator(csrf_exempt, name='dispatch')  # clients upload without a CSRF token
+class UploadView(View):
+    chunk_size = 64 * 1024
 
+    @metrics.timed('get')
     def get(self, request, hash, filename):
         """Download a file."""
         if ws_download() is True:
             return HttpResponseForbidden()
-        upload = Upload.objects.uploaded().get(hash=hash, name=filename)
+        upload = None
+        if metadata.enabled():  # serve the file without any database query
+            with phase('metadata'):
+                upload = metadata.load(hash, filename)
+        if upload is None:
+            with phase('lookup'):
+                upload = _lookup(Upload.objects.all(), hash, name=filename)
+                if upload is None:  # the file may still be uploaded
+                    slot = _lookup(Slot.objects.all(), hash, name=filename)
+                    if slot is None:
+                        raise Http404
+                    if cluster.is_remote(slot):
+                        return self.redirect(request, slot)
+                    return self.get_partial(slot, get_config(slot.jid) or {})
+            if cluster.is_remote(upload):
+                return self.redirect(request, upload)
+
+        config = get_config(upload.jid) or {}
+
+        # Serve the compressed file if there is one and the client accepts it
+        compressed = upload.compressed_size is not None and accepts_gzip(request)
+        etag = None
+        if upload.sha256:
+            etag = '"%s-gzip"' % upload.sha256 if compressed else '"%s"' % upload.sha256
+        if etag is not None:
+            # "304 Not Modified" or "412 Precondition Failed", depending on the request headers
+            response = get_conditional_response(request, etag=etag)
+            if response is not None:
+                response['ETag'] = etag
+                return response
+
+        if compressed:
+            file = open_compressed(upload)
+            if file is None and upload.encoding == '':  # send the original (or one of its copies) instead
+                compressed = False
+                file = upload.open_file()
+                if etag is not None:
+                    etag = '"%s"' % upload.sha256
+        else:
+            file = upload.open_file()
+        if file is None:
+            raise Http404
+        if config.get('download_bandwidth'):
+            key = cache_key('download-bandwidth', upload.jid)
+            file = ThrottledFile(file, config['download_bandwidth'], key)
+            resp = ThrottledFileResponse(file, content_type=upload.type, filename=filename)
+        else:
+            resp = FileResponse(file, content_type=upload.type, filename=filename)
+        if compressed:
+            resp['Content-Length'] = upload.compressed_size
+            resp['Content-Encoding'] = 'gzip'
+        else:
+            resp['Content-Length'] = upload.size
+        if upload.compressed_size is not None:
+            patch_vary_headers(resp, ('Accept-Encoding', ))
+        if etag is not None:
+            resp['ETag'] = etag
+        tiering.touch(upload)
+        return resp
+
+    def redirect(self, request, instance):
+        """Send the request to the node storing the file in cluster mode."""
+        response = cluster.redirect(request, instance.node)
+        if response is None:  # the node left the cluster
+            raise Http404
+        return response
 
-        resp = FileResponse(upload.file, content_type=upload.type, filename=filename)
-        resp['Content-Length'] = upload.file.size
+    def get_partial(self, slot, config):
+        """Stream a file that is still being uploaded."""
+
+        if not progressive_download():
+            raise Http404
+        try:
+            file = open(slot.get_partial_path(), 'rb')
+        except FileNotFoundError:  # upload did not start yet or just finished
+            upload = Upload.objects.using(slot._state.db).filter(hash=slot.hash, name=slot.name).first()
+            if upload is None:
+                raise Http404
+            file = upload.open_file()
+            if file is None:
+                raise Http404
+
+        if config.get('download_bandwidth'):
+            key = cache_key('download-bandwidth', slot.jid)
+            file = ThrottledFile(file, config['download_bandwidth'], key)
+
+        content = follow_file(file, slot.size, timeout=progressive_timeout())
+        resp = StreamingHttpResponse(content, content_type=slot.type or 'application/octet-stream')
+        resp['Content-Length'] = slot.size
+        resp['Content-Disposition'] = 'inline; filename="%s"' % quote(slot.name)
         return resp
 
+    @metrics.timed('put')
     def put(self, request, hash, filename):
-        try:
-            upload = Upload.objects.for_upload().get(hash=hash, name=filename)
-        except Upload.DoesNotExist:
+        with metrics.UPLOADS_IN_PROGRESS.track_inprogress():
+            return self._put(request, hash, filename)
+
+    def _put(self, request, hash, filename):
+        start = time.monotonic()
+        with phase('lookup'):
+            slot = _lookup(Slot.objects.for_upload(), hash, replicas=False, name=filename)
+        if slot is None:
             return HttpResponseForbidden()
+        if cluster.is_remote(slot):
+            return self.redirect(request, slot)
         content_type = request.META.get('CONTENT_TYPE', 'application/octet-stream')
 
-        if int(request.META.get('CONTENT_LENGTH', -1)) != upload.size:
-            return HttpResponse("File size (%s) does not match requested size (%s)." % (
-                request.META['CONTENT_LENGTH'], upload.size),
-                status=400)
-        if upload.type is not None and content_type != upload.type:
+        try:
+            body_path = offload.get_body_path(request)
+        except ValueError:
+            return HttpResponse('Invalid request body file.', status=400)
+
+        if body_path is not None:  # the web server already received the body
+            try:
+                size = os.path.getsize(body_path)
+            except FileNotFoundError:
+                return HttpResponse('Request body file does not exist.', status=400)
+        else:
+            size = int(request.META.get('CONTENT_LENGTH', -1))
+
+        if size != slot.size:
+            return HttpResponse("File size (%s) does not match requested size (%s)." % (size, slot.size),
+                                status=400)
+        if slot.type is not None and content_type != slot.type:
             return HttpResponse(
                 'Content type (%s) does not match requested type.' % request.META['CONTENT_TYPE'],
                 status=400)
 
         try:
-            file_obj = request.FILES['file']
-        except UnreadablePostError:  # pragma: no cover
-            # This seems to happen if the client never actually posts any data.
+            digest = get_request_digest(request)
+        except ValueError:
+            return HttpResponse('Invalid digest header.', status=400)
+
+        if body_path is not None:
+            with phase('receive'):
+                file_obj = OffloadedFile(body_path, slot.name, content_type)
+                if offload.get_offload_config()['verify']:
+                    sha256 = offload.hash_file(file_obj)
+                else:  # trust the digest given by the client, if any
+                    sha256 = slot.sha256 or digest
+            return self.store(slot, file_obj, sha256, digest, start)
+
+        config = get_config(slot.jid) or {}
+        max_uploads = config.get('max_concurrent_uploads')
+        user_admission = Admission(slot.size, jid=slot.jid, max_uploads=max_uploads)
+        if not user_admission.acquire():
+            response = HttpResponse('Too many concurrent uploads.', status=429)
+            response['Retry-After'] = user_admission.config['retry_after']
+            return response
+
+        admission = Admission(slot.size)
+        if not admission.acquire():
+            user_admission.release()
+            return _overloaded('put', admission)
+
+        try:
+            with phase('receive'):
+                bandwidth = config.get('upload_bandwidth')
+                file_obj, sha256 = self.receive(request, slot, content_type, bandwidth)
+        except UnreadablePostError:
             # Django docs: "UnreadablePostError is raised when a user cancels an upload."
             return HttpResponse('Could not read post request.', status=400)
+        except FileExistsError:  # another request is writing the partial file
+            return HttpResponse('Upload is already in progress.', status=409)
+        finally:
+            admission.release()
+            user_admission.release()
+        return self.store(slot, file_obj, sha256, digest, start)
+
+    def store(self, slot, file_obj, sha256, digest, start):
+        """Verify the digest of a received file and store it as the upload of ``slot``."""
+
+        # Verify the digest passed when requesting the slot and/or in the request headers
+        for expected in (slot.sha256, digest):
+            if expected is not None and expected != sha256:
+                file_obj.close()
+                return HttpResponse('SHA-256 digest (%s) does not match expected digest (%s).' % (
+                    sha256, expected), status=400)
+
+        storage = {'file': file_obj}
+        if packs.should_pack(slot.size):
+            with phase('pack'):
+                storage['file'], storage['offset'] = packs.append(file_obj)
+        upload = Upload.from_slot(slot, type=file_obj.content_type, sha256=sha256, uploaded=timezone.now(),
+                                  **storage)
+        using = slot._state.db
+        with phase('save'), transaction.atomic(using=using):
+            upload.save(using=using)
+            slot.delete(using=using)
+            event = pipeline.create_event(upload, using)
+            transaction.on_commit(lambda: compression.schedule(upload), using=using)
+            if event is not None:
+                transaction.on_commit(lambda: pipeline.schedule(event.pk, using), using=using)
+        file_obj.close()  # removes the temporary file, if it was not moved
+        metadata.write(upload)
+        pin(upload.jid)
+
+        metrics.UPLOAD_BYTES.inc(upload.size)
+        metrics.UPLOAD_THROUGHPUT.observe(upload.size / max(time.monotonic() - start, 1e-6))
+        response = HttpResponse(status=201)
+        if sha256 is not None:  # offloaded bodies are not hashed if verify is False
+            response['ETag'] = '"%s"' % sha256
+        return response
+
+    def receive(self, request, slot, content_type, bandwidth=None):
+        """Read the request body into an uploaded file, at most ``bandwidth`` bytes per second.
+
+        Returns the file and the SHA-256 hex digest of the body.
+        """
+
+        if progressive_download():
+            file_obj = PartialUploadedFile(slot.get_partial_path(), slot.name, content_type, slot.size)
+        elif slot.size > settings.FILE_UPLOAD_MAX_MEMORY_SIZE:
+            file_obj = TemporaryUploadedFile(slot.name, content_type, slot.size, None)
+        else:
+            file_obj = InMemoryUploadedFile(BytesIO(), None, slot.name, content_type, slot.size, None)
+
+        throttle = Throttle(bandwidth)
+        sha256 = hashlib.sha256()
+        remaining = slot.size
+        try:
+            while remaining > 0:
+                chunk = request.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    raise UnreadablePostError(
+                        'Request body ended after %s bytes.' % (slot.size - remaining))
+
+                file_obj.write(chunk)
+                file_obj.flush()  # make the chunk visible to progressive downloads
+                sha256.update(chunk)
+                remaining -= len(chunk)
+                throttle(len(chunk))
+        except BaseException:  # also if the worker is stopped (e.g. on a timeout)
+            file_obj.close()  # also removes temporary or partial files
+            raise
+
+        file_obj.seek(0)
+        return file_obj, sha256.hexdigest()
+
 
-        upload.file = file_obj
-        upload.type = content_type
-        upload.save()
-        return Response(status=201)
+class ClusterView(UploadView):
+    """Receive a file pushed by another node in cluster mode.
+
+    See :py:class:`~xmpp_http_upload.cluster.Rebalancer`.
+    """
+
+    http_method_names = ['put']
+
+    def put(self, request, hash, filename):
+        try:
+            node = cluster.load_token(request.META.get('HTTP_X_CLUSTER_TOKEN', ''), hash, filename)
+        except signing.BadSignature:
+            return HttpResponseForbidden()
+
+        upload = _lookup(Upload.objects.uploaded(), hash, replicas=False, name=filename)
+        if upload is None:
+            return HttpResponseNotFound()
+        if int(request.META.get('CONTENT_LENGTH', -1)) != upload.size:
+            return HttpResponse('File size does not match.', status=400)
+
+        file_obj, sha256 = self.receive(request, upload, upload.type)
+        if upload.sha256 is not None and upload.sha256 != sha256:
+            file_obj.close()
+            return HttpResponse('SHA-256 digest does not match.', status=400)
+
+        # Store the file (under a new name, if the nodes share a disk) and take it over
+        previous = upload.node
+        upload.file.save(upload.name, file_obj, save=False)
+        file_obj.close()
+        updated = Upload.objects.using(upload._state.db).filter(pk=upload.pk, node=previous).update(
+            file=upload.file.name, offset=None, encoding='', compressed_size=None, cold=False, node=node,
+            mirrors=0)
+        if not updated:  # pushed by two nodes at the same time
+            upload.remove_file()
+            return HttpResponse(status=409)
+        upload.offset = upload.compressed_size = None
+        upload.encoding = ''
+        upload.cold = False
+        metadata.write(upload)
+        compression.schedule(upload)
+        return HttpResponse(status=201)
+
+
+class MetricsView(View):
+    """Expose metrics to Prometheus, if enabled with the XMPP_HTTP_UPLOAD_METRICS setting."""
+
+    def get(self, request):
+        if not metrics.enabled():
+            return HttpResponseNotFound()
+        content_type = metrics.prometheus_client.CONTENT_TYPE_LATEST
+        return HttpResponse(metrics.generate_latest(), content_type=content_type)